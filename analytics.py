@@ -0,0 +1,153 @@
+import os
+import threading
+
+# Bot-wide analytics updated as searches are recorded: running search and match
+# totals per file type, and the most found tracks and artists kept by
+# Space-Saving sketches in a fixed number of counters. Every update and read is
+# constant time, so /top costs the same however much traffic the bot has seen.
+# Totals are per process and start at zero; the top charts are seeded from the
+# stored history so they survive restarts. Each webhook worker keeps its own
+# counts, so its live counts cover only the chats it serves.
+ANALYTICS_CAPACITY = int(os.getenv('ANALYTICS_CAPACITY', '1000'))
+ANALYTICS_TOP = int(os.getenv('ANALYTICS_TOP', '10'))
+ANALYTICS_SEED = os.getenv('ANALYTICS_SEED', '1') != '0'
+
+SEARCH_KINDS = ('audio', 'voice', 'video', 'lyrics')
+
+class SpaceSaving:
+    """Approximate counts of the most frequent keys of a stream, in `capacity` counters.
+
+    When every counter is taken, a new key replaces a key with the smallest
+    count and inherits that count, so counts are overestimates by at most
+    `error`. Any key seen more than total/capacity times is guaranteed to be
+    kept. Keys are grouped by count, so the smallest count is always at hand,
+    and the largest `top_size` keys are kept in order as counts change.
+    """
+
+    def __init__(self, capacity, top_size=10):
+        self.capacity = max(capacity, top_size)
+        self.top_size = top_size
+        self.total = 0
+        self._counts = {}
+        self._errors = {}
+        # count -> keys with that count, in the order they reached it
+        self._buckets = {}
+        self._min = 0
+        self._top = []
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key):
+        self.total += 1
+        count = self._counts.get(key)
+        if count is None:
+            if len(self._counts) < self.capacity:
+                count = 0
+                self._errors[key] = 0
+            else:
+                count = self._min
+                self._evict(next(iter(self._buckets[count])))
+                self._errors[key] = count
+        else:
+            self._unlink(key, count)
+        count += 1
+        self._counts[key] = count
+        self._buckets.setdefault(count, {})[key] = None
+        if count == 1:
+            self._min = 1
+        self._promote(key, count)
+
+    def _unlink(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if count == self._min:
+                self._min = count + 1
+
+    def _evict(self, key):
+        self._unlink(key, self._counts.pop(key))
+        del self._errors[key]
+        if key in self._top:
+            self._top.remove(key)
+
+    def _promote(self, key, count):
+        top = self._top
+        if key in top:
+            i = top.index(key)
+        elif len(top) < self.top_size:
+            top.append(key)
+            i = len(top) - 1
+        elif count > self._counts[top[-1]]:
+            top[-1] = key
+            i = len(top) - 1
+        else:
+            return
+        while i and self._counts[top[i - 1]] < count:
+            top[i - 1], top[i] = top[i], top[i - 1]
+            i -= 1
+
+    def top(self, n=None):
+        """Return up to `n` (key, count, error) tuples, most frequent first."""
+        return [(key, self._counts[key], self._errors[key]) for key in self._top[:n]]
+
+class Analytics:
+    """Search totals per file type and the most found tracks and artists."""
+
+    def __init__(self, capacity=ANALYTICS_CAPACITY, top_size=ANALYTICS_TOP):
+        self.tracks = SpaceSaving(capacity, top_size)
+        self.artists = SpaceSaving(capacity, top_size)
+        self._searches = {kind: 0 for kind in SEARCH_KINDS}
+        self._matches = {kind: 0 for kind in SEARCH_KINDS}
+        # (index, count) when this process is one of several webhook workers
+        self.worker = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls()
+
+    def record(self, kind, song=None):
+        """Count a search of `kind` and, when it found a song, the song."""
+        with self._lock:
+            self._searches[kind] = self._searches.get(kind, 0) + 1
+            if song:
+                self._matches[kind] = self._matches.get(kind, 0) + 1
+                self._add_song(song)
+
+    def _add_song(self, song):
+        self.tracks.add((song['title'], song['artist']))
+        self.artists.add(song['artist'])
+
+    def seed(self, history):
+        """Count songs from stored history entries in the top tracks and artists."""
+        seeded = 0
+        for item in history:
+            with self._lock:
+                self._add_song(item)
+            seeded += 1
+        return seeded
+
+    def top_tracks(self, n=None):
+        with self._lock:
+            return [
+                {'title': title, 'artist': artist, 'count': count}
+                for (title, artist), count, _ in self.tracks.top(n)
+            ]
+
+    def top_artists(self, n=None):
+        with self._lock:
+            return [{'artist': artist, 'count': count} for artist, count, _ in self.artists.top(n)]
+
+    def hit_rates(self):
+        """Return {kind: {'searches', 'matches', 'rate'}} for each kind searched so far."""
+        with self._lock:
+            return {
+                kind: {
+                    'searches': searches,
+                    'matches': self._matches[kind],
+                    'rate': self._matches[kind] / searches
+                }
+                for kind, searches in self._searches.items() if searches
+            }
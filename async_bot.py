@@ -0,0 +1,505 @@
+import io
+import os
+import startup
+import asyncio
+import logging
+import tempfile
+import aiohttp
+from datetime import datetime
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+import messages
+import event_log
+import metrics
+from http_client import get_client, setting
+import audio_preprocess
+import multi_window
+from recognition_cache import MISS, file_key, file_content_key
+from downloads import FileTooLarge, check_media
+from rate_limit import RateLimited, QuotaExhausted
+from singleflight import AsyncSingleFlight
+from outbound import AsyncOutboundDispatcher
+from services import (
+    BOT_TOKEN, AUDD_API_KEY, AUDD_API_URL, TELEGRAM_API_URL, telegram_files,
+    lyrics_search, recognition_cache, fingerprint_index, index_writer, local_lookup,
+    local_lookup_windows, decode_samples,
+    user_store, analytics, log_user_action, rate_limiter, genius_guard, limit_text, file_too_large_text
+)
+
+# asyncio runtime: one event loop serves every update, and each upstream gets
+# its own concurrency limit so a slow service cannot starve the others. The
+# user store, caches and rate limiter may be backed by SQLite, so they are
+# called from worker threads rather than on the loop.
+AUDD_CONCURRENCY = int(os.getenv('AUDD_CONCURRENCY', '20'))
+GENIUS_CONCURRENCY = int(os.getenv('GENIUS_CONCURRENCY', '10'))
+TELEGRAM_FILE_CONCURRENCY = int(os.getenv('TELEGRAM_FILE_CONCURRENCY', '20'))
+
+asyncio_helper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+asyncio_helper.FILE_URL = TELEGRAM_API_URL + '/file/bot{0}/{1}'
+# Bot API calls do not go through http_client here. asyncio_helper retries
+# connection errors and timeouts itself, at a fixed delay; 429s are left to
+# the outbound dispatcher, and 5xx responses are not retried.
+asyncio_helper.RETRY_ON_ERROR = True
+asyncio_helper.MAX_RETRIES = int(setting('telegram', 'RETRIES', 3)) + 1
+asyncio_helper.RETRY_TIMEOUT = setting('telegram', 'BACKOFF', 0.5)
+
+# asyncio_helper has no request hook, so its request function is wrapped to
+# pace chat messages and callback answers to Telegram's flood limits
+outbound = AsyncOutboundDispatcher.from_env()
+_process_request = asyncio_helper._process_request
+
+async def dispatched_request(token, url, method='get', params=None, files=None, **kwargs):
+    return await outbound.call(
+        url, params, lambda: _process_request(token, url, method, params, files, **kwargs)
+    )
+
+if outbound is not None:
+    asyncio_helper._process_request = dispatched_request
+
+class TracedAsyncTeleBot(AsyncTeleBot):
+    """AsyncTeleBot that handles each update in its own task tagged with the update id."""
+
+    async def process_new_updates(self, updates):
+        await asyncio.gather(*(self._process_update(update) for update in updates))
+
+    async def _process_update(self, update):
+        event_log.bind(update.update_id)
+        await super().process_new_updates([update])
+
+bot = TracedAsyncTeleBot(BOT_TOKEN)
+
+audd_limit = asyncio.Semaphore(AUDD_CONCURRENCY)
+genius_limit = asyncio.Semaphore(GENIUS_CONCURRENCY)
+telegram_file_limit = asyncio.Semaphore(TELEGRAM_FILE_CONCURRENCY)
+recognition_flight = AsyncSingleFlight()
+
+_http_session = None
+
+def get_http_session():
+    """Return the shared aiohttp session, creating it inside the running loop."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=60, sock_connect=10)
+        )
+    return _http_session
+
+class AsyncLoadingAnimation:
+    """Animate a progress message from a background task while a file is processed."""
+
+    interval = 0.5
+
+    def __init__(self, msg, text="🎵 Analyzing your file"):
+        self.msg = msg
+        self.text = text
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def stage(self, text):
+        """Switch the animated text to the current pipeline stage."""
+        self.text = text
+
+    async def _run(self):
+        dots = 1
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await bot.edit_message_text(
+                    self.text + "." * dots,
+                    chat_id=self.msg.chat.id,
+                    message_id=self.msg.message_id
+                )
+            except Exception:
+                pass
+            dots = dots % 3 + 1
+
+@bot.message_handler(commands=['start'])
+async def send_welcome(message):
+    await asyncio.to_thread(user_store.ensure_user, message.from_user.id)
+    log_user_action(message.from_user, "started using the bot")
+    await bot.send_message(
+        message.chat.id,
+        messages.WELCOME_TEXT,
+        parse_mode="Markdown",
+        reply_markup=messages.MENU_KEYBOARD
+    )
+
+@bot.message_handler(commands=['help'])
+async def send_help(message):
+    log_user_action(message.from_user, "requested help")
+    await bot.reply_to(
+        message,
+        messages.HELP_TEXT,
+        parse_mode="Markdown",
+        reply_markup=messages.HELP_KEYBOARD
+    )
+
+@bot.message_handler(commands=['about'])
+async def send_about(message):
+    log_user_action(message.from_user, "viewed about info")
+    await bot.reply_to(
+        message,
+        messages.ABOUT_TEXT,
+        parse_mode="Markdown",
+        reply_markup=messages.ABOUT_KEYBOARD
+    )
+
+@bot.message_handler(commands=['stats'])
+async def send_stats(message):
+    log_user_action(message.from_user, "checked their stats")
+    stats = await asyncio.to_thread(user_store.get_stats, message.from_user.id)
+    await bot.reply_to(
+        message,
+        messages.format_stats(stats),
+        parse_mode="Markdown",
+        reply_markup=messages.STATS_KEYBOARD
+    )
+
+@bot.message_handler(commands=['history'])
+async def send_history(message):
+    log_user_action(message.from_user, "viewed their history")
+    history = await asyncio.to_thread(user_store.get_history, message.from_user.id, 10)
+    text = messages.format_history(history) if history else messages.NO_HISTORY_TEXT
+    await bot.reply_to(
+        message,
+        text,
+        parse_mode="Markdown",
+        reply_markup=messages.HISTORY_KEYBOARD
+    )
+
+@bot.message_handler(commands=['top'])
+async def send_top(message):
+    log_user_action(message.from_user, "viewed the top charts")
+    await bot.reply_to(
+        message,
+        messages.format_top(
+            analytics.top_tracks(), analytics.top_artists(5), analytics.hit_rates(), analytics.worker
+        ),
+        parse_mode="Markdown",
+        reply_markup=messages.TOP_KEYBOARD
+    )
+
+async def spool_file(file_info, tmp):
+    """Download a file into an open temp file so large videos never sit in memory."""
+    async with telegram_file_limit:
+        chunks = telegram_files.stream_async(get_http_session(), file_info.file_path, file_info.file_size)
+        async for chunk in chunks:
+            tmp.write(chunk)
+    tmp.flush()
+
+async def fetch_clip(media, file_info):
+    """Return a file object to recognize: a short mono excerpt, or the whole file without ffmpeg."""
+    if not audio_preprocess.is_available():
+        tmp = tempfile.SpooledTemporaryFile(max_size=telegram_files.spool_memory)
+        try:
+            await spool_file(file_info, tmp)
+        except BaseException:
+            tmp.close()
+            raise
+        tmp.seek(0)
+        return tmp
+
+    with tempfile.NamedTemporaryFile() as tmp:
+        await spool_file(file_info, tmp)
+        return io.BytesIO(await asyncio.to_thread(
+            audio_preprocess.transcode_file,
+            tmp.name,
+            audio_preprocess.clip_offset(media.duration)
+        ))
+
+async def recognize_file(media, file_info, animation):
+    """Recognize a Telegram file via the caches, the local fingerprint index and then AuDD."""
+    if multi_window.should_split(media.duration):
+        with tempfile.NamedTemporaryFile() as tmp:
+            await spool_file(file_info, tmp)
+            hash_key = await asyncio.to_thread(file_content_key, tmp)
+            song = await asyncio.to_thread(recognition_cache.get, hash_key)
+            if song is not MISS:
+                return hash_key, song
+            # The local index is checked against the windows AuDD would hear
+            starts = await asyncio.to_thread(multi_window.pick_file_windows, tmp.name)
+            song = await asyncio.to_thread(local_lookup_windows, tmp.name, starts)
+            if song:
+                return hash_key, song
+            animation.stage("🎵 Identifying the song")
+            with metrics.span('multi_window'):
+                result, _, clip = await multi_window.recognize_file_async(
+                    tmp.name, recognize_song, starts=starts
+                )
+            # Only the window AuDD matched is indexed under the song
+            samples = await asyncio.to_thread(decode_samples, clip) if clip is not None else None
+    else:
+        with metrics.span('fetch_clip'):
+            content = await fetch_clip(media, file_info)
+        with content:
+            hash_key = await asyncio.to_thread(file_content_key, content)
+            song = await asyncio.to_thread(recognition_cache.get, hash_key)
+            if song is not MISS:
+                return hash_key, song
+            samples, song = await asyncio.to_thread(local_lookup, content)
+            if song:
+                return hash_key, song
+            animation.stage("🎵 Identifying the song")
+            content.seek(0)
+            result = await recognize_song(content)
+
+    if result['status'] != 'success':
+        return hash_key, MISS
+    song = result.get('result')
+    if song and samples is not None:
+        index_writer.submit(fingerprint_index.get().add, song, samples)
+    return hash_key, song
+
+async def recognize_song(content):
+    """Upload a clip (bytes or a file object) to AuDD and return its JSON result."""
+    def send():
+        # A form can only be sent once, so every retry builds its own
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        form = aiohttp.FormData()
+        form.add_field('api_token', AUDD_API_KEY)
+        form.add_field('return', 'apple_music,spotify')
+        form.add_field('file', content, filename='file')
+        return get_http_session().post(AUDD_API_URL, data=form)
+
+    await asyncio.to_thread(rate_limiter.check_quota, 'audd')
+    await asyncio.to_thread(rate_limiter.record_call, 'audd')
+    async with audd_limit:
+        with metrics.span('audd'):
+            async with await get_client('audd').request_async(send) as response:
+                return await response.json(content_type=None)
+
+@bot.message_handler(content_types=['audio', 'voice', 'video'])
+@metrics.instrument('handle_audio')
+async def handle_audio(message):
+    try:
+        file_type = 'audio' if message.audio else 'voice' if message.voice else 'video'
+        log_user_action(message.from_user, "submitted a file for recognition", file_type=file_type)
+        media = message.audio or message.voice or message.video
+
+        unique_key = file_key(media.file_unique_id)
+        song = await asyncio.to_thread(recognition_cache.get, unique_key)
+        processing_msg = None
+
+        if song is MISS:
+            check_media(media)
+            # Each sender's own buckets are checked before joining a shared recognition
+            await asyncio.to_thread(
+                rate_limiter.check, 'audd', message.from_user.id, message.chat.id, scopes=('user', 'chat')
+            )
+            with metrics.span('progress_message'):
+                processing_msg = await bot.reply_to(message, "🎵 Analyzing your file")
+            async with AsyncLoadingAnimation(processing_msg) as animation:
+                song = await recognition_flight.do(
+                    unique_key,
+                    lambda: recognize_upload(message, media, unique_key, animation)
+                )
+        else:
+            log_user_action(message.from_user, "answered from recognition cache")
+
+        user_id = message.from_user.id
+        analytics.record(file_type, song)
+
+        if song:
+            await asyncio.to_thread(user_store.record_search, user_id, song, True)
+            log_user_action(message.from_user, "found song", title=song['title'], artist=song['artist'])
+            response_text, keyboard = messages.format_song(song)
+            await send_recognition_reply(
+                message,
+                processing_msg,
+                response_text,
+                parse_mode="Markdown",
+                reply_markup=keyboard
+            )
+        else:
+            await asyncio.to_thread(user_store.record_search, user_id)
+            log_user_action(message.from_user, "no song match found")
+            await send_recognition_reply(message, processing_msg, messages.NO_MATCH_TEXT)
+
+    except (RateLimited, QuotaExhausted) as e:
+        log_user_action(message.from_user, "was refused", level=logging.WARNING, reason=str(e))
+        await send_recognition_reply(message, processing_msg, limit_text(e))
+
+    except FileTooLarge as e:
+        log_user_action(message.from_user, "sent a file over the limits", level=logging.WARNING, reason=str(e))
+        await send_recognition_reply(message, processing_msg, file_too_large_text())
+
+    except Exception as e:
+        log_user_action(message.from_user, "encountered an error", level=logging.ERROR, error=str(e))
+        await bot.reply_to(message, messages.RECOGNITION_ERROR_TEXT)
+
+async def recognize_upload(message, media, unique_key, animation):
+    """Fetch and recognize an uploaded file, caching the song under both of its keys."""
+    # The global bucket is spent once for everyone waiting on this recognition
+    await asyncio.to_thread(
+        rate_limiter.check, 'audd', message.from_user.id, message.chat.id, scopes=('global',)
+    )
+    animation.stage("🎵 Fetching your file")
+    async with telegram_file_limit:
+        with metrics.span('get_file'):
+            file_info = await bot.get_file(media.file_id)
+    hash_key, song = await recognize_file(media, file_info, animation)
+    if song is MISS:
+        return None
+    await asyncio.to_thread(recognition_cache.set, [unique_key, hash_key], song)
+    return song
+
+async def send_recognition_reply(message, processing_msg, text, **kwargs):
+    """Edit the progress message with the result, or reply directly when there is none."""
+    with metrics.span('reply'):
+        if processing_msg is None:
+            await bot.reply_to(message, text, **kwargs)
+        else:
+            await bot.edit_message_text(
+                text,
+                chat_id=processing_msg.chat.id,
+                message_id=processing_msg.message_id,
+                **kwargs
+            )
+
+@bot.message_handler(commands=['lyrics'])
+@metrics.instrument('handle_lyrics_search')
+async def handle_lyrics_search(message):
+    try:
+        query = message.text.replace('/lyrics', '').strip()
+        log_user_action(message.from_user, "searched lyrics" if query else "attempted lyrics search without query", query=query)
+
+        if not query:
+            await bot.reply_to(
+                message,
+                messages.LYRICS_USAGE_TEXT,
+                parse_mode="Markdown",
+                reply_markup=messages.LYRICS_EXAMPLE_KEYBOARD
+            )
+            return
+
+        loading_msg = await bot.reply_to(
+            message,
+            messages.LYRICS_SEARCHING_TEXT,
+            parse_mode="Markdown"
+        )
+
+        try:
+            async with genius_limit:
+                results = await lyrics_search.search_song_async(
+                    get_http_session(), query, guard=genius_guard(message)
+                )
+        except (RateLimited, QuotaExhausted) as e:
+            log_user_action(message.from_user, "was refused", level=logging.WARNING, reason=str(e))
+            await bot.edit_message_text(
+                limit_text(e),
+                chat_id=loading_msg.chat.id,
+                message_id=loading_msg.message_id
+            )
+            return
+
+        if not results:
+            log_user_action(message.from_user, "no lyrics matches found")
+            analytics.record('lyrics')
+            await bot.edit_message_text(
+                messages.NO_LYRICS_MATCH_TEXT,
+                chat_id=loading_msg.chat.id,
+                message_id=loading_msg.message_id,
+                parse_mode="Markdown",
+                reply_markup=messages.LYRICS_RETRY_KEYBOARD
+            )
+            return
+
+        log_user_action(message.from_user, "found songs matching lyrics", results=len(results))
+
+        previews = await lyrics_search.get_previews_async(get_http_session(), results, query)
+        response, keyboard = messages.format_lyrics_results(query, results, previews)
+        await bot.edit_message_text(
+            response,
+            chat_id=loading_msg.chat.id,
+            message_id=loading_msg.message_id,
+            parse_mode="Markdown",
+            reply_markup=keyboard
+        )
+
+        await asyncio.to_thread(user_store.record_search, message.from_user.id, results[0])
+        analytics.record('lyrics', results[0])
+
+    except Exception as e:
+        log_user_action(message.from_user, "lyrics search error", level=logging.ERROR, error=str(e))
+        await bot.reply_to(message, messages.LYRICS_ERROR_TEXT)
+
+@bot.callback_query_handler(func=lambda call: True)
+async def handle_callback_query(call):
+    """Handle inline keyboard button clicks."""
+    try:
+        log_user_action(call.from_user, "clicked button", event='button_click', button=call.data)
+
+        if call.data == "stats":
+            await send_stats(call.message)
+        elif call.data == "history":
+            await send_history(call.message)
+        elif call.data == "help":
+            await send_help(call.message)
+        elif call.data == "about":
+            await send_about(call.message)
+        elif call.data == "lyrics_help":
+            await bot.send_message(
+                call.message.chat.id,
+                messages.LYRICS_HELP_TEXT,
+                parse_mode="Markdown"
+            )
+        elif call.data == "lyrics_example":
+            await bot.send_message(call.message.chat.id, messages.LYRICS_EXAMPLE_TEXT)
+        elif call.data == "new_search":
+            await bot.send_message(
+                call.message.chat.id,
+                messages.NEW_SEARCH_TEXT,
+                parse_mode="Markdown",
+                reply_markup=messages.MENU_KEYBOARD
+            )
+
+        await bot.answer_callback_query(call.id)
+
+    except Exception as e:
+        log_user_action(call.from_user, "callback error", level=logging.ERROR, button=call.data, error=str(e))
+        await bot.answer_callback_query(call.id, messages.CALLBACK_ERROR_TEXT)
+
+@bot.message_handler(func=lambda message: True)
+async def echo_all(message):
+    log_user_action(message.from_user, "sent unrecognized message", text=message.text)
+    await bot.reply_to(
+        message,
+        messages.UNKNOWN_MESSAGE_TEXT,
+        parse_mode="Markdown",
+        reply_markup=messages.UNKNOWN_KEYBOARD
+    )
+
+async def run():
+    try:
+        await bot.infinity_polling()
+    finally:
+        if _http_session is not None:
+            await _http_session.close()
+        await bot.close_session()
+
+def main():
+    print("\n" + "=" * 50)
+    print("🎵 Music Recognition Bot Starting (asyncio)...")
+    print("=" * 50)
+    print(f"Start Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Limits: AuDD={AUDD_CONCURRENCY} Genius={GENIUS_CONCURRENCY} Telegram files={TELEGRAM_FILE_CONCURRENCY}")
+    print("=" * 50 + "\n")
+
+    metrics.start_server()
+    startup.ready('asyncio')
+    startup.warm_up()
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
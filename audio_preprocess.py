@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+
+# Recognition only needs a short excerpt, so uploads are cut down locally
+# with ffmpeg to a small mono clip before they are sent to AuDD.
+FFMPEG = os.getenv('FFMPEG_PATH') or shutil.which('ffmpeg')
+CLIP_SECONDS = float(os.getenv('CLIP_SECONDS', '12'))
+CLIP_SAMPLE_RATE = int(os.getenv('CLIP_SAMPLE_RATE', '16000'))
+CLIP_BITRATE = os.getenv('CLIP_BITRATE', '48k')
+
+# Containers ffmpeg can decode from a pipe without seeking; anything else
+# (MP4/MOV with a trailing index, most video) is spooled to a temp file.
+STREAMABLE_MIME_TYPES = {
+    'audio/mpeg', 'audio/mp3', 'audio/ogg', 'audio/opus',
+    'audio/wav', 'audio/x-wav', 'audio/flac', 'audio/x-flac'
+}
+
+class PreprocessError(Exception):
+    """Raised when ffmpeg cannot produce a clip from the input."""
+
+def is_available():
+    """Return True when preprocessing is enabled and ffmpeg is installed."""
+    return bool(FFMPEG) and os.getenv('PREPROCESS_AUDIO', '1') != '0'
+
+def clip_offset(duration, window=CLIP_SECONDS):
+    """Choose where the excerpt starts, skipping intros on longer tracks."""
+    if not duration or duration <= window * 2:
+        return 0
+    return min(duration * 0.25, 30, duration - window)
+
+def _output_args(sample_rate, bitrate):
+    # -vn/-sn/-dn keep ffmpeg from decoding anything but the first audio stream
+    return [
+        '-map', '0:a:0', '-vn', '-sn', '-dn',
+        '-ac', '1', '-ar', str(sample_rate),
+        '-c:a', 'libmp3lame', '-b:a', bitrate,
+        '-f', 'mp3', 'pipe:1'
+    ]
+
+def _run(cmd, stdin=None):
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    feeder = None
+    failure = []
+    if stdin is not None:
+        feeder = threading.Thread(target=_feed, args=(proc, stdin, failure), daemon=True)
+        feeder.start()
+
+    clip = proc.stdout.read()
+    error = proc.stderr.read()
+    proc.wait()
+    if feeder is not None:
+        feeder.join()
+
+    if failure:
+        # The download failed (FileTooLarge, DownloadError); the clip is truncated
+        raise failure[0]
+    if proc.returncode != 0 or not clip:
+        raise PreprocessError(error.decode(errors='replace').strip() or "ffmpeg produced no audio")
+    return clip
+
+def _feed(proc, chunks, failure):
+    """Copy chunks into ffmpeg's stdin, stopping the download once ffmpeg has enough.
+
+    An error raised by the download is kept in `failure` for _run to raise, and
+    ffmpeg is killed rather than left to encode the truncated input.
+    """
+    pipe = proc.stdin
+    try:
+        for chunk in chunks:
+            try:
+                pipe.write(chunk)
+            except (BrokenPipeError, ValueError):
+                break
+    except BaseException as e:
+        failure.append(e)
+        proc.kill()
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def transcode_file(path, offset=0, duration=CLIP_SECONDS,
+                   sample_rate=CLIP_SAMPLE_RATE, bitrate=CLIP_BITRATE):
+    """Cut [offset, offset + duration) from a local file into a mono MP3 clip."""
+    cmd = [
+        FFMPEG, '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-ss', str(offset), '-t', str(duration), '-i', path
+    ] + _output_args(sample_rate, bitrate)
+    return _run(cmd)
+
+def transcode_stream(chunks, offset=0, duration=CLIP_SECONDS,
+                     sample_rate=CLIP_SAMPLE_RATE, bitrate=CLIP_BITRATE):
+    """Cut a clip from a stream of byte chunks; the rest of the stream is never read."""
+    cmd = [
+        FFMPEG, '-hide_banner', '-loglevel', 'error',
+        '-i', 'pipe:0', '-ss', str(offset), '-t', str(duration)
+    ] + _output_args(sample_rate, bitrate)
+    return _run(cmd, stdin=chunks)
+
+def spool_to_tempfile(chunks, suffix=''):
+    """Write chunks to a named temporary file and return it, rewound."""
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix)
+    try:
+        for chunk in chunks:
+            tmp.write(chunk)
+        tmp.flush()
+    except BaseException:
+        tmp.close()
+        raise
+    tmp.seek(0)
+    return tmp
+
+def extract_clip(chunks, mime_type=None, offset=0, duration=CLIP_SECONDS):
+    """Turn a downloaded file, given as byte chunks, into a short clip for recognition."""
+    if mime_type in STREAMABLE_MIME_TYPES:
+        return transcode_stream(chunks, offset, duration)
+
+    with spool_to_tempfile(chunks) as tmp:
+        return transcode_file(tmp.name, offset, duration)
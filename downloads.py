@@ -0,0 +1,97 @@
+import os
+import tempfile
+import requests
+import metrics
+from http_client import get_client
+
+# Telegram files are streamed in chunks over the shared keep-alive Telegram
+# client and checked against size and duration caps before and while they
+# download. File URLs embed the bot token, so they never leave this module:
+# errors name the file path only.
+MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE', str(20 * 1024 * 1024)))
+MAX_DURATION = int(os.getenv('MAX_DURATION', '3600'))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', str(64 * 1024)))
+DOWNLOAD_SPOOL_MEMORY = int(os.getenv('DOWNLOAD_SPOOL_MEMORY', str(1024 * 1024)))
+
+class DownloadError(Exception):
+    """Raised when a Telegram file cannot be downloaded."""
+
+class FileTooLarge(DownloadError):
+    """Raised when a file is over MAX_FILE_SIZE or MAX_DURATION."""
+
+def check_media(media, max_size=MAX_FILE_SIZE, max_duration=MAX_DURATION):
+    """Refuse a message's file from its metadata, before anything is fetched."""
+    size = getattr(media, 'file_size', None)
+    duration = getattr(media, 'duration', None)
+    if max_size and size and size > max_size:
+        raise FileTooLarge(f"file is {size} bytes, the limit is {max_size}")
+    if max_duration and duration and duration > max_duration:
+        raise FileTooLarge(f"file is {duration} seconds long, the limit is {max_duration}")
+
+class TelegramFiles:
+    """Download files from the Telegram file API without exposing the bot token."""
+
+    def __init__(self, api_url, token, max_size=MAX_FILE_SIZE,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, spool_memory=DOWNLOAD_SPOOL_MEMORY):
+        self._base_url = f"{api_url}/file/bot{token}/"
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.spool_memory = spool_memory
+
+    def _check_size(self, file_path, size):
+        if self.max_size and size and int(size) > self.max_size:
+            raise FileTooLarge(f"{file_path} is over {self.max_size} bytes")
+
+    def stream(self, file_path, size=None):
+        """Yield a file in chunks, stopping with FileTooLarge as soon as it is over the cap."""
+        self._check_size(file_path, size)
+        with metrics.span('download'):
+            try:
+                response = get_client('telegram').get(self._base_url + file_path, stream=True)
+            except requests.RequestException as e:
+                raise DownloadError(f"download of {file_path} failed: {type(e).__name__}") from None
+            try:
+                if response.status_code != 200:
+                    raise DownloadError(f"download of {file_path} failed with status {response.status_code}")
+                self._check_size(file_path, response.headers.get('Content-Length'))
+                received = 0
+                for chunk in response.iter_content(self.chunk_size):
+                    received += len(chunk)
+                    self._check_size(file_path, received)
+                    yield chunk
+            except requests.RequestException as e:
+                raise DownloadError(f"download of {file_path} failed: {type(e).__name__}") from None
+            finally:
+                response.close()
+
+    def spool(self, file_path, size=None):
+        """Download a file into a temp file kept in memory up to `spool_memory` bytes, rewound."""
+        tmp = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+        try:
+            for chunk in self.stream(file_path, size):
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            raise
+        tmp.seek(0)
+        return tmp
+
+    async def stream_async(self, session, file_path, size=None):
+        """Asyncio variant of stream over an aiohttp session."""
+        self._check_size(file_path, size)
+        with metrics.span('download'):
+            try:
+                async with session.get(self._base_url + file_path) as response:
+                    if response.status != 200:
+                        raise DownloadError(f"download of {file_path} failed with status {response.status}")
+                    self._check_size(file_path, response.content_length)
+                    received = 0
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        received += len(chunk)
+                        self._check_size(file_path, received)
+                        yield chunk
+            except DownloadError:
+                raise
+            except Exception as e:
+                # aiohttp errors carry the request URL, and with it the token
+                raise DownloadError(f"download of {file_path} failed: {type(e).__name__}") from None
@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+# Structured event log: callers build a LogRecord and enqueue it; a background
+# listener thread formats it as one JSON line and writes it out. Nothing on the
+# request path formats strings or touches stdout.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# High-volume events are kept at these rates; every kept line records its rate
+SAMPLE_RATES = {
+    'button_click': float(os.getenv('LOG_BUTTON_SAMPLE_RATE', '0.1')),
+}
+
+_correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+def bind(correlation_id):
+    """Attach a correlation id (the Telegram update id) to every event logged in this context."""
+    _correlation_id.set(correlation_id)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'event': record.msg,
+            'correlation_id': getattr(record, 'correlation_id', None),
+        }
+        payload.update(getattr(record, 'fields', {}))
+        if getattr(record, 'sample_rate', None) is not None:
+            payload['sample_rate'] = record.sample_rate
+        if record.exc_info:
+            payload['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """Enqueue records untouched, dropping them instead of blocking when the writer falls behind."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+logger = logging.getLogger('tunedetective')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+_queue = queue.Queue(LOG_QUEUE_SIZE)
+handler = DroppingQueueHandler(_queue)
+logger.addHandler(handler)
+
+_output = logging.FileHandler(LOG_FILE, encoding='utf-8') if LOG_FILE else logging.StreamHandler(sys.stdout)
+_output.setFormatter(JsonFormatter())
+listener = QueueListener(_queue, _output)
+listener.start()
+atexit.register(listener.stop)
+
+def event(name, level=logging.INFO, exc_info=None, **fields):
+    """Log a structured event; events listed in SAMPLE_RATES are randomly sampled."""
+    if not logger.isEnabledFor(level):
+        return
+    rate = SAMPLE_RATES.get(name)
+    if rate is not None and random.random() >= rate:
+        return
+    logger.log(level, name, exc_info=exc_info, extra={
+        'fields': fields,
+        'sample_rate': rate,
+        'correlation_id': _correlation_id.get()
+    })
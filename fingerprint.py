@@ -0,0 +1,386 @@
+import os
+import json
+import glob
+import time
+import atexit
+import sqlite3
+import threading
+import logging
+import subprocess
+import contextlib
+import event_log
+import audio_preprocess
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Spectral peak-pair fingerprints (landmark hashing). Audio is decoded to 8 kHz
+# mono, spectrogram peaks are paired with a few peaks that follow them, and
+# each pair becomes a 24-bit hash of (anchor bin, target bin, time delta).
+SAMPLE_RATE = 8000
+FFT_SIZE = 1024
+HOP_SIZE = 512
+FREQ_BINS = 512
+PEAK_TIME_RADIUS = 4
+PEAK_FREQ_RADIUS = 15
+FAN_OUT = 3
+MAX_DELTA = 63
+
+FINGERPRINT_MIN_MATCHES = int(os.getenv('FINGERPRINT_MIN_MATCHES', '15'))
+FINGERPRINT_MIN_RATIO = float(os.getenv('FINGERPRINT_MIN_RATIO', '0.05'))
+FINGERPRINT_MAX_CLIPS_PER_TRACK = int(os.getenv('FINGERPRINT_MAX_CLIPS_PER_TRACK', '3'))
+FINGERPRINT_MAX_SECONDS = float(os.getenv('FINGERPRINT_MAX_SECONDS', '60'))
+FINGERPRINT_FLUSH_INTERVAL = float(os.getenv('FINGERPRINT_FLUSH_INTERVAL', '5'))
+
+# Hashes this common carry no information and would make lookups slow
+MAX_POSTINGS_PER_HASH = 2000
+
+def is_available():
+    """Return True when the local index is enabled and numpy and ffmpeg are installed."""
+    return (
+        np is not None
+        and bool(audio_preprocess.FFMPEG)
+        and os.getenv('FINGERPRINT_INDEX', '1') != '0'
+    )
+
+def decode_pcm(source, max_seconds=FINGERPRINT_MAX_SECONDS, offset=0):
+    """Decode a file path or encoded bytes to 8 kHz mono float32 samples, from `offset` seconds."""
+    cmd = [audio_preprocess.FFMPEG, '-hide_banner', '-loglevel', 'error']
+    if isinstance(source, (bytes, bytearray)):
+        cmd += ['-i', 'pipe:0']
+        if offset:
+            cmd += ['-ss', str(offset)]
+    else:
+        if offset:
+            cmd += ['-ss', str(offset)]
+        cmd += ['-nostdin', '-i', source]
+    if max_seconds:
+        cmd += ['-t', str(max_seconds)]
+    cmd += ['-map', '0:a:0', '-vn', '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', 'pipe:1']
+
+    proc = subprocess.run(
+        cmd,
+        input=source if isinstance(source, (bytes, bytearray)) else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    return np.frombuffer(proc.stdout[:len(proc.stdout) // 2 * 2], dtype='<i2').astype(np.float32)
+
+def _max_filter(a, radius, axis):
+    """Maximum over a window of 2 * radius + 1 along one axis, without extra copies per shift."""
+    out = a.copy()
+    for shift in range(1, radius + 1):
+        if axis == 0:
+            np.maximum(out[shift:], a[:-shift], out=out[shift:])
+            np.maximum(out[:-shift], a[shift:], out=out[:-shift])
+        else:
+            np.maximum(out[:, shift:], a[:, :-shift], out=out[:, shift:])
+            np.maximum(out[:, :-shift], a[:, shift:], out=out[:, :-shift])
+    return out
+
+def fingerprint(samples):
+    """Return (hashes, anchor frame times) as uint32 arrays."""
+    empty = np.empty(0, dtype=np.uint32)
+    if len(samples) < FFT_SIZE:
+        return empty, empty
+
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE)[::HOP_SIZE]
+    spec = np.abs(np.fft.rfft(frames * np.hanning(FFT_SIZE).astype(np.float32), axis=1))
+    spec = np.log1p(spec[:, :FREQ_BINS]).astype(np.float32)
+
+    local_max = _max_filter(_max_filter(spec, PEAK_TIME_RADIUS, 0), PEAK_FREQ_RADIUS, 1)
+    peak_t, peak_f = np.nonzero((spec == local_max) & (spec > spec.mean() + spec.std()))
+    if len(peak_t) < 2:
+        return empty, empty
+
+    hashes, times = [], []
+    for step in range(1, FAN_OUT + 1):
+        t1, f1 = peak_t[:-step], peak_f[:-step]
+        t2, f2 = peak_t[step:], peak_f[step:]
+        delta = t2 - t1
+        keep = (delta > 0) & (delta <= MAX_DELTA)
+        hashes.append((f1[keep] << 15) | (f2[keep] << 6) | delta[keep])
+        times.append(t1[keep])
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(times).astype(np.uint32)
+
+class Segment:
+    """An immutable run of (hash, track, time) postings sorted by hash, memory-mapped from disk."""
+
+    def __init__(self, base, hashes=None, tracks=None, times=None):
+        self.base = base
+        if hashes is None:
+            hashes = np.load(base + '.hash.npy', mmap_mode='r')
+            tracks = np.load(base + '.track.npy', mmap_mode='r')
+            times = np.load(base + '.time.npy', mmap_mode='r')
+        self.hashes, self.tracks, self.times = hashes, tracks, times
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def write(cls, base, hashes, tracks, times):
+        order = np.argsort(hashes, kind='stable')
+        # The hash file is renamed into place last; its presence marks a complete segment
+        for name, values in (('track', tracks), ('time', times), ('hash', hashes)):
+            tmp = f"{base}.{name}.tmp.npy"
+            np.save(tmp, np.ascontiguousarray(values[order]))
+            os.replace(tmp, f"{base}.{name}.npy")
+        return cls(base)
+
+    def remove(self):
+        for name in ('hash', 'track', 'time'):
+            try:
+                os.remove(f"{self.base}.{name}.npy")
+            except FileNotFoundError:
+                pass
+
+    def postings(self, query_hashes, query_times):
+        """Return (tracks, time offsets) of every posting matching a query hash."""
+        lo = np.searchsorted(self.hashes, query_hashes, 'left')
+        hi = np.searchsorted(self.hashes, query_hashes, 'right')
+        counts = hi - lo
+        keep = (counts > 0) & (counts <= MAX_POSTINGS_PER_HASH)
+        lo, counts, query_times = lo[keep], counts[keep], query_times[keep]
+        if not len(counts):
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+
+        # Expand every [lo, hi) range into flat posting indices
+        total = int(counts.sum())
+        run_starts = np.repeat(lo - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+        index = run_starts + np.arange(total)
+        offsets = self.times[index].astype(np.int64) - np.repeat(query_times, counts).astype(np.int64)
+        return self.tracks[index].astype(np.int64), offsets
+
+class FingerprintIndex:
+    """On-disk inverted index from landmark hashes to tracks.
+
+    New fingerprints collect in a small in-memory buffer and are written out as
+    sorted, memory-mapped segments; segments of similar size are merged so the
+    number of binary searches per lookup stays small. Resident memory is the
+    buffer plus whatever pages the OS keeps cached.
+
+    Several processes (webhook workers) may share one directory. The live
+    segment list is a manifest file that writers replace atomically while
+    holding a lock file, and every lookup reloads it when it has changed, so
+    each process sees segments flushed or merged by the others. Buffers are
+    flushed within `flush_interval` seconds of their first fingerprint.
+    """
+
+    def __init__(self, path, buffer_limit=200000, merge_factor=4, max_merge=8000000,
+                 flush_interval=FINGERPRINT_FLUSH_INTERVAL):
+        self.path = path
+        self.buffer_limit = buffer_limit
+        self.merge_factor = merge_factor
+        self.max_merge = max_merge
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._buffered = 0
+        self._buffer_segment = None
+        self._flush_timer = None
+        self._manifest = os.path.join(path, 'manifest.json')
+        self._manifest_stamp = None
+        self._segments = []
+
+        os.makedirs(path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, 'tracks.db'), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "id INTEGER PRIMARY KEY, song_key TEXT UNIQUE, song TEXT, clips INTEGER DEFAULT 0)"
+        )
+        self._refresh()
+
+    @contextlib.contextmanager
+    def _writer(self):
+        """Hold the lock that serializes segment writes across processes."""
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _segment_names(self):
+        try:
+            with open(self._manifest) as f:
+                return json.load(f)['segments']
+        except FileNotFoundError:
+            # Indexes written before the manifest existed
+            return sorted(
+                os.path.basename(name)[:-len('.hash.npy')]
+                for name in glob.glob(os.path.join(self.path, 'seg-*.hash.npy'))
+            )
+
+    def _refresh(self):
+        """Reload the segment list when another process has changed the manifest."""
+        try:
+            stat = os.stat(self._manifest)
+            stamp = (stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+        if stamp is not None and stamp == self._manifest_stamp:
+            return
+        current = {os.path.basename(segment.base): segment for segment in self._segments}
+        for _ in range(5):
+            try:
+                self._segments = [
+                    current.get(name) or Segment(os.path.join(self.path, name))
+                    for name in self._segment_names()
+                ]
+            except FileNotFoundError:
+                # A segment was merged away between reading the manifest and opening it
+                continue
+            self._manifest_stamp = stamp
+            return
+
+    def _write_manifest(self):
+        tmp = self._manifest + f".{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'segments': [os.path.basename(segment.base) for segment in self._segments]}, f)
+        os.replace(tmp, self._manifest)
+        stat = os.stat(self._manifest)
+        self._manifest_stamp = (stat.st_ino, stat.st_mtime_ns)
+
+    def lookup(self, samples):
+        """Return the indexed song matching the samples, or None."""
+        query_hashes, query_times = fingerprint(samples)
+        if not len(query_hashes):
+            return None
+
+        with self._lock:
+            self._refresh()
+            segments = list(self._segments)
+            if self._buffer:
+                segments.append(self._sorted_buffer())
+
+        tracks, offsets = [], []
+        for segment in segments:
+            segment_tracks, segment_offsets = segment.postings(query_hashes, query_times)
+            tracks.append(segment_tracks)
+            offsets.append(segment_offsets)
+        tracks, offsets = np.concatenate(tracks), np.concatenate(offsets)
+        if not len(tracks):
+            return None
+
+        # Matching audio lines up: most hits for the right track share one time offset
+        votes, counts = np.unique((tracks << 24) | ((offsets + (1 << 23)) & 0xFFFFFF), return_counts=True)
+        best = int(np.argmax(counts))
+        score = int(counts[best])
+        if score < FINGERPRINT_MIN_MATCHES or score < FINGERPRINT_MIN_RATIO * len(query_hashes):
+            return None
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT song FROM tracks WHERE id = ?", (int(votes[best] >> 24),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add(self, song, samples):
+        """Index the samples as an excerpt of `song`."""
+        hashes, times = fingerprint(samples)
+        if not len(hashes):
+            return
+
+        with self._lock:
+            track_id = self._track_id(song)
+            if track_id is None:
+                return
+            self._buffer.append((hashes, np.full(len(hashes), track_id, np.uint32), times))
+            self._buffered += len(hashes)
+            self._buffer_segment = None
+            if self._buffered >= self.buffer_limit:
+                self.flush()
+            elif self._flush_timer is None and self.flush_interval:
+                # Other processes only see fingerprints once they are in a segment
+                self._flush_timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except OSError as e:
+            event_log.event('fingerprint_flush_error', logging.WARNING, error=str(e))
+
+    def flush(self):
+        """Write the in-memory buffer out as a new segment and publish it in the manifest."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._buffer:
+                return
+            hashes, tracks, times = (np.concatenate(column) for column in zip(*self._buffer))
+            with self._writer():
+                self._refresh()
+                base = os.path.join(self.path, f"seg-{time.time_ns():020d}-{os.getpid()}")
+                self._segments.append(Segment.write(base, hashes, tracks, times))
+                self._buffer, self._buffered, self._buffer_segment = [], 0, None
+                merged = self._merge()
+                self._write_manifest()
+                # Processes still holding merged segments keep their mappings after the unlink
+                for segment in merged:
+                    segment.remove()
+
+    def _track_id(self, song):
+        song_key = f"{song['title'].lower()}\x00{song['artist'].lower()}"
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO tracks (song_key, song) VALUES (?, ?)",
+                (song_key, json.dumps(song))
+            )
+            track_id, clips = self._db.execute(
+                "SELECT id, clips FROM tracks WHERE song_key = ?", (song_key,)
+            ).fetchone()
+            if clips >= FINGERPRINT_MAX_CLIPS_PER_TRACK:
+                return None
+            self._db.execute("UPDATE tracks SET clips = clips + 1 WHERE id = ?", (track_id,))
+        return track_id
+
+    def _sorted_buffer(self):
+        if self._buffer_segment is None:
+            hashes, tracks, times = (np.concatenate(column) for column in zip(*self._buffer))
+            order = np.argsort(hashes, kind='stable')
+            self._buffer_segment = Segment(None, hashes[order], tracks[order], times[order])
+        return self._buffer_segment
+
+    def _merge(self):
+        """Merge segments in place, returning the merged-away ones for removal."""
+        # Size-tiered: merge the smallest segments while enough of them are of similar size
+        merged = []
+        while True:
+            segments = sorted(self._segments, key=len)
+            group = segments[:self.merge_factor]
+            if len(group) < self.merge_factor or len(group[-1]) > len(group[0]) * self.merge_factor:
+                return merged
+            if sum(len(segment) for segment in group) > self.max_merge:
+                return merged
+            hashes = np.concatenate([segment.hashes for segment in group])
+            tracks = np.concatenate([segment.tracks for segment in group])
+            times = np.concatenate([segment.times for segment in group])
+            base = os.path.join(self.path, f"seg-{time.time_ns():020d}-{os.getpid()}")
+            self._segments = [segment for segment in self._segments if segment not in group]
+            self._segments.append(Segment.write(base, hashes, tracks, times))
+            merged.extend(group)
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+def open_index():
+    """Open the index at FINGERPRINT_INDEX_PATH, or return None when unavailable."""
+    if not is_available():
+        return None
+    index = FingerprintIndex(os.getenv('FINGERPRINT_INDEX_PATH', 'fingerprint_index'))
+    atexit.register(index.close)
+    return index
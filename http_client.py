@@ -0,0 +1,280 @@
+import io
+import os
+import time
+import asyncio
+import uuid
+import random
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+# Statuses worth retrying: rate limiting and transient upstream failures
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+class CircuitBreaker:
+    """Fail fast after repeated upstream failures, then let a single probe through."""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call to the upstream is allowed right now."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError(f"{self.name} is unavailable, circuit breaker is open")
+
+    def record(self, success):
+        """Record the outcome of a call allowed by before_call."""
+        with self._lock:
+            self._probing = False
+            if success:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """End a call allowed by before_call that has no outcome, such as a cancelled one."""
+        with self._lock:
+            self._probing = False
+
+class MultipartBody:
+    """A multipart/form-data request body that streams its file part.
+
+    requests would read a `files=` upload into memory. Passed as `data=`, this
+    body is read in blocks straight from the file object. Its length is known
+    up front, so Content-Length is sent instead of chunked encoding. `seek(0)`
+    lets a retry send it again.
+    """
+
+    def __init__(self, fields, name, fileobj, filename='file', content_type='application/octet-stream'):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = ''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+            for key, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        )
+        if isinstance(fileobj, (bytes, bytearray, memoryview)):
+            fileobj = io.BytesIO(fileobj)
+        fileobj.seek(0, io.SEEK_END)
+        size = fileobj.tell()
+        self._parts = [io.BytesIO(head.encode()), fileobj, io.BytesIO(f'\r\n--{boundary}--\r\n'.encode())]
+        self.len = len(self._parts[0].getbuffer()) + size + len(self._parts[2].getbuffer())
+        self.seek(0)
+
+    def read(self, size=-1):
+        chunks = []
+        while self._current < len(self._parts) and size != 0:
+            chunk = self._parts[self._current].read(size)
+            if not chunk:
+                self._current += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if offset or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("MultipartBody can only be rewound")
+        for part in self._parts:
+            part.seek(0)
+        self._current = 0
+        return 0
+
+class HttpClient:
+    """Keep-alive session for one upstream with timeouts, retries and a circuit breaker."""
+
+    def __init__(self, name, connect_timeout=5, read_timeout=30, retries=3,
+                 backoff=0.5, max_backoff=10, pool_size=20,
+                 failure_threshold=5, reset_timeout=30, retry_statuses=RETRY_STATUSES):
+        self.name = name
+        self.retry_statuses = retry_statuses
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+        # One pool per host, sized for the number of handler threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying 429/5xx responses and connection errors with backoff."""
+        kwargs.setdefault('timeout', self.timeout)
+        body = kwargs.get('data')
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            if attempt and hasattr(body, 'seek'):
+                # The previous attempt consumed a streamed body
+                body.seek(0)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name)
+                metrics.UPSTREAM_REQUESTS.inc(self.name, type(e).__name__)
+                self.breaker.record(False)
+                if attempt >= self.retries or kwargs.get('stream'):
+                    raise
+                delay = self._backoff_delay(attempt)
+            except requests.RequestException as e:
+                # Broken or truncated responses count against the upstream too
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name)
+                metrics.UPSTREAM_REQUESTS.inc(self.name, type(e).__name__)
+                self.breaker.record(False)
+                raise
+            except BaseException:
+                # Whatever else ends the call, a half-open probe must not stay in flight
+                self.breaker.release()
+                raise
+            else:
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name)
+                metrics.UPSTREAM_REQUESTS.inc(self.name, str(response.status_code))
+                self.breaker.record(response.status_code < 500)
+                if response.status_code not in self.retry_statuses or attempt >= self.retries:
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                response.close()
+
+            attempt += 1
+            time.sleep(delay)
+
+    async def request_async(self, send):
+        """Await `send()` for an aiohttp response, with the same retries, backoff and
+        circuit breaker as request().
+
+        `send` is called again for every attempt, so it must build a fresh
+        request body each time. The caller releases the returned response.
+        """
+        # Only the asyncio runtime needs aiohttp
+        import aiohttp
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            started = time.perf_counter()
+            try:
+                response = await send()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name)
+                metrics.UPSTREAM_REQUESTS.inc(self.name, type(e).__name__)
+                self.breaker.record(False)
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff_delay(attempt)
+            except aiohttp.ClientError as e:
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name)
+                metrics.UPSTREAM_REQUESTS.inc(self.name, type(e).__name__)
+                self.breaker.record(False)
+                raise
+            except BaseException:
+                # A cancelled call has no outcome, but must not keep the probe in flight
+                self.breaker.release()
+                raise
+            else:
+                metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name)
+                metrics.UPSTREAM_REQUESTS.inc(self.name, str(response.status))
+                self.breaker.record(response.status < 500)
+                if response.status not in self.retry_statuses or attempt >= self.retries:
+                    return response
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                response.release()
+
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _backoff_delay(self, attempt):
+        # Full jitter keeps retrying handlers from hitting the upstream in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0), self.max_backoff)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Per-upstream overrides; everything else comes from the HTTP_* defaults
+UPSTREAM_READ_TIMEOUTS = {'audd': 60, 'genius': 15, 'telegram': 30}
+# Telegram's 429s carry a retry_after that the outbound dispatcher honours per chat
+UPSTREAM_RETRY_STATUSES = {'telegram': RETRY_STATUSES - {429}}
+
+def setting(name, key, default):
+    """Read an HTTP_<key> setting, overridden per upstream by <NAME>_HTTP_<key>."""
+    return float(os.getenv(f"{name.upper()}_HTTP_{key}", os.getenv('HTTP_' + key, default)))
+
+def get_client(name):
+    """Return the shared client for an upstream ('audd', 'genius' or 'telegram')."""
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = _clients[name] = HttpClient(
+                name,
+                connect_timeout=setting(name, 'CONNECT_TIMEOUT', 5),
+                read_timeout=setting(name, 'READ_TIMEOUT', UPSTREAM_READ_TIMEOUTS.get(name, 30)),
+                retries=int(setting(name, 'RETRIES', 3)),
+                backoff=setting(name, 'BACKOFF', 0.5),
+                max_backoff=setting(name, 'MAX_BACKOFF', 10),
+                pool_size=int(setting(name, 'POOL_SIZE', 20)),
+                failure_threshold=int(setting(name, 'CIRCUIT_FAILURES', 5)),
+                reset_timeout=setting(name, 'CIRCUIT_RESET', 30),
+                retry_statuses=UPSTREAM_RETRY_STATUSES.get(name, RETRY_STATUSES)
+            )
+        return client
+
+def telegram_request_sender(method, url, **kwargs):
+    """Send telebot API calls through the shared Telegram client (apihelper.CUSTOM_REQUEST_SENDER)."""
+    return get_client('telegram').request(method, url, **kwargs)
@@ -0,0 +1,283 @@
+import os
+import json
+import atexit
+import difflib
+import logging
+import sqlite3
+import threading
+import event_log
+
+# Local full-text index over the songs Genius has returned and the lyric lines
+# read from their pages. Text is stored normalized (lyrics_search.normalize_query);
+# SQLite FTS5 holds the postings and ranks with BM25, and a trigram index over
+# the vocabulary maps misheard or misspelled words onto indexed ones. Each lyric
+# line is its own row, so a phrase never matches across a line break.
+LYRICS_INDEX_PATH = os.getenv('LYRICS_INDEX_PATH', 'lyrics_index.db')
+LYRICS_INDEX_MIN_TERMS = int(os.getenv('LYRICS_INDEX_MIN_TERMS', '3'))
+# A phrase found in the lyrics of more songs than this is too common to answer
+LYRICS_INDEX_MAX_SONGS = int(os.getenv('LYRICS_INDEX_MAX_SONGS', '3'))
+LYRICS_INDEX_MMAP_SIZE = int(os.getenv('LYRICS_INDEX_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+# bm25() column weights: title, artist, lyrics
+RANK_WEIGHTS = (4.0, 2.0, 1.0)
+# Tokens allowed between the query's words, beyond the words themselves
+NEAR_SLACK = 2
+MAX_QUERY_TERMS = 12
+MAX_LINES_PER_SONG = 200
+# An unknown word is read as the closest indexed word at least this similar
+FUZZY_MIN_RATIO = 0.75
+FUZZY_MIN_LENGTH = 4
+FUZZY_CANDIDATES = 20
+
+# Words too common in lyrics to tell songs apart; they do not count towards
+# LYRICS_INDEX_MIN_TERMS. Apostrophes are already stripped by normalize_query.
+STOPWORDS = frozenset('''
+    a about all am an and are as at be been but by can cant could did didnt do
+    does dont for from get got had has have he her him his how i if im in into
+    is isnt it its ive just let lets me my no not now of oh on one or our out
+    she so that thats the their them then there they this to too up us was we
+    were what when where who why will with wont would yeah you youre your
+'''.split())
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def _near(terms):
+    return f"NEAR({' '.join(_quote(term) for term in terms)}, {len(terms) + NEAR_SLACK})"
+
+class LyricsIndex:
+    """On-disk inverted index answering lyrics queries without a Genius round trip.
+
+    A query needs `min_terms` words that are not stopwords. It is answered when
+    all of its words occur in a song's title and artist, or close together in
+    one lyric line of at most `max_songs` songs. Only when no line has them all
+    may one word be left out, as long as `min_terms` others remain. A phrase
+    found in more songs is ambiguous and left to Genius, as is anything less.
+    Writes go through one connection; each reading thread gets its own
+    memory-mapped connection.
+    """
+
+    def __init__(self, path, min_terms=LYRICS_INDEX_MIN_TERMS, max_songs=LYRICS_INDEX_MAX_SONGS,
+                 mmap_size=LYRICS_INDEX_MMAP_SIZE):
+        self.path = path
+        self.min_terms = min_terms
+        self.max_songs = max_songs
+        self.mmap_size = mmap_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self._conn = self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        has_lines = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'lines'"
+        ).fetchone() is not None
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS songs ("
+            " id INTEGER PRIMARY KEY,"
+            " url TEXT UNIQUE NOT NULL,"
+            " song TEXT NOT NULL);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5("
+            " title, artist, lyrics, tokenize='unicode61 remove_diacritics 2');"
+            "CREATE TABLE IF NOT EXISTS lines ("
+            " id INTEGER PRIMARY KEY,"
+            " song_id INTEGER NOT NULL,"
+            " line TEXT NOT NULL,"
+            " UNIQUE (song_id, line));"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5("
+            " line, content='lines', content_rowid='id', tokenize='unicode61 remove_diacritics 2');"
+            "CREATE TABLE IF NOT EXISTS vocab ("
+            " id INTEGER PRIMARY KEY,"
+            " term TEXT UNIQUE NOT NULL);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS vocab_fts USING fts5("
+            " term, content='vocab', content_rowid='id', tokenize='trigram');"
+        )
+        if not has_lines:
+            self._split_lyrics()
+
+    def _split_lyrics(self):
+        """Move lyrics stored in songs_fts by older versions into one row per line."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT rowid, lyrics FROM songs_fts WHERE lyrics != ''").fetchall()
+                for song_id, lyrics in rows:
+                    self._add_lines(song_id, lyrics.split('\n'))
+                    self._conn.execute("UPDATE songs_fts SET lyrics = '' WHERE rowid = ?", (song_id,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def search(self, query, limit=5):
+        """Return up to `limit` songs confidently matching a normalized query, or None."""
+        terms = list(dict.fromkeys(query.split()))[:MAX_QUERY_TERMS]
+        if self._content_terms(terms) < self.min_terms:
+            return None
+
+        db = self._reader()
+        terms = self._correct(db, terms)
+        # All words in the title and artist
+        rows = db.execute(
+            "SELECT songs.id, songs.song FROM songs_fts JOIN songs ON songs.id = songs_fts.rowid"
+            f" WHERE songs_fts MATCH ? ORDER BY bm25(songs_fts, {', '.join(map(str, RANK_WEIGHTS))})"
+            " LIMIT ?",
+            ('{title artist} : (' + ' AND '.join(_quote(term) for term in terms) + ')', limit)
+        ).fetchall()
+
+        # All words close together in one lyric line, or failing that all but one
+        shorter = [
+            terms[:i] + terms[i + 1:] for i in range(len(terms))
+            if self._content_terms(terms[:i] + terms[i + 1:]) >= self.min_terms
+        ]
+        lines = self._line_matches(db, [terms])
+        if not lines and shorter:
+            lines = self._line_matches(db, shorter)
+
+        songs = dict(rows)
+        # Confidence comes from how distinctive the phrase is, not from its bm25
+        # score, which depends on the size of the index
+        if len(lines) <= self.max_songs:
+            for song_id, song in lines:
+                songs.setdefault(song_id, song)
+        return [json.loads(song) for song in list(songs.values())[:limit]] or None
+
+    def _line_matches(self, db, phrases):
+        """Return (id, song) for up to max_songs + 1 songs with a line matching a phrase, best first."""
+        matches = {}
+        for song_id, song in db.execute(
+            "SELECT songs.id, songs.song FROM lines_fts"
+            " JOIN lines ON lines.id = lines_fts.rowid JOIN songs ON songs.id = lines.song_id"
+            " WHERE lines_fts MATCH ? ORDER BY bm25(lines_fts)",
+            (' OR '.join(_near(phrase) for phrase in phrases),)
+        ):
+            matches.setdefault(song_id, song)
+            if len(matches) > self.max_songs:
+                break
+        return list(matches.items())
+
+    @staticmethod
+    def _content_terms(terms):
+        return sum(term not in STOPWORDS for term in terms)
+
+    def _correct(self, db, terms):
+        """Replace words missing from the vocabulary with their closest indexed spelling."""
+        known = {
+            row[0] for row in db.execute(
+                f"SELECT term FROM vocab WHERE term IN ({', '.join('?' * len(terms))})", terms
+            )
+        }
+        corrected = []
+        for term in terms:
+            if term not in known and len(term) >= FUZZY_MIN_LENGTH:
+                grams = {term[i:i + 3] for i in range(len(term) - 2)}
+                candidates = db.execute(
+                    "SELECT term FROM vocab_fts WHERE vocab_fts MATCH ? ORDER BY rank LIMIT ?",
+                    (' OR '.join(_quote(gram) for gram in grams), FUZZY_CANDIDATES)
+                ).fetchall()
+                best, best_ratio = None, FUZZY_MIN_RATIO
+                for (candidate,) in candidates:
+                    ratio = difflib.SequenceMatcher(None, term, candidate).ratio()
+                    if ratio >= best_ratio:
+                        best, best_ratio = candidate, ratio
+                term = best or term
+            corrected.append(term)
+        return corrected
+
+    def add_songs(self, entries):
+        """Index (song, normalized title, normalized artist) entries not indexed yet."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                words = set()
+                for song, title, artist in entries:
+                    if self._conn.execute("SELECT 1 FROM songs WHERE url = ?", (song['url'],)).fetchone():
+                        continue
+                    song_id = self._conn.execute(
+                        "INSERT INTO songs (url, song) VALUES (?, ?)", (song['url'], json.dumps(song))
+                    ).lastrowid
+                    self._conn.execute(
+                        "INSERT INTO songs_fts (rowid, title, artist, lyrics) VALUES (?, ?, ?, '')",
+                        (song_id, title, artist)
+                    )
+                    words.update(title.split())
+                    words.update(artist.split())
+                self._add_vocab(words)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_lyrics(self, url, lines):
+        """Merge normalized lyric lines into an indexed song's lyrics."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT id FROM songs WHERE url = ?", (url,)).fetchone()
+                if row is not None:
+                    self._add_lines(row[0], lines)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _add_lines(self, song_id, lines):
+        count, last_id = self._conn.execute(
+            "SELECT count(*), (SELECT coalesce(max(id), 0) FROM lines) FROM lines WHERE song_id = ?",
+            (song_id,)
+        ).fetchone()
+        new = [line for line in dict.fromkeys(lines) if line][:max(0, MAX_LINES_PER_SONG - count)]
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO lines (song_id, line) VALUES (?, ?)", ((song_id, line) for line in new)
+        )
+        added = self._conn.execute(
+            "SELECT id, line FROM lines WHERE id > ?", (last_id,)
+        ).fetchall()
+        self._conn.executemany("INSERT INTO lines_fts (rowid, line) VALUES (?, ?)", added)
+        self._add_vocab({word for _, line in added for word in line.split()})
+
+    def _add_vocab(self, words):
+        if not words:
+            return
+        last_id = self._conn.execute("SELECT coalesce(max(id), 0) FROM vocab").fetchone()[0]
+        self._conn.executemany("INSERT OR IGNORE INTO vocab (term) VALUES (?)", ((word,) for word in words))
+        self._conn.execute(
+            "INSERT INTO vocab_fts (rowid, term) SELECT id, term FROM vocab WHERE id > ?", (last_id,)
+        )
+
+    def stats(self):
+        """Return the number of indexed songs and lyric lines and the vocabulary size."""
+        db = self._reader()
+        return {
+            'songs': db.execute("SELECT count(*) FROM songs").fetchone()[0],
+            'lines': db.execute("SELECT count(*) FROM lines").fetchone()[0],
+            'terms': db.execute("SELECT count(*) FROM vocab").fetchone()[0]
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_index():
+    """Open the index at LYRICS_INDEX_PATH, or return None when disabled or unsupported."""
+    if os.getenv('LYRICS_INDEX', '1') == '0':
+        return None
+    try:
+        index = LyricsIndex(LYRICS_INDEX_PATH)
+    except sqlite3.Error as e:
+        # FTS5 and the trigram tokenizer need SQLite 3.34 or newer
+        event_log.event('lyrics_index_unavailable', logging.WARNING, error=str(e))
+        return None
+    atexit.register(index.close)
+    return index
@@ -1,57 +1,427 @@
 import os
-import requests
-from dotenv import load_dotenv
+import re
+import codecs
+import functools
+import asyncio
+import logging
+import time
+import sqlite3
+import threading
+import unicodedata
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, wait
+import event_log
+import lyrics_index
+from http_client import get_client
+from recognition_cache import MemoryBackend
+from singleflight import SingleFlight, AsyncSingleFlight
+import metrics
+from startup import Lazy
 
-load_dotenv()
+LYRICS_PREVIEW_WORKERS = int(os.getenv('LYRICS_PREVIEW_WORKERS', '10'))
+LYRICS_PREVIEW_TIMEOUT = float(os.getenv('LYRICS_PREVIEW_TIMEOUT', '5'))
+
+# A line sharing this much of the query's words counts as the match
+PREVIEW_MATCH_SCORE = 0.8
+PREVIEW_MAX_BYTES = 1024 * 1024
+PREVIEW_CHUNK_SIZE = 16 * 1024
+PREVIEW_LINE_LENGTH = 80
+# Songs listed for a /lyrics query
+MAX_RESULTS = 5
+
+# Chat spellings rewritten to the word Genius indexes
+SPELLING_FIXES = {
+    'u': 'you',
+    'ya': 'you',
+    'ur': 'your',
+    'r': 'are',
+    'luv': 'love',
+    'cuz': 'because',
+    'coz': 'because',
+    'thru': 'through',
+    'tho': 'though',
+    'nite': 'night',
+    'tonite': 'tonight',
+    'pls': 'please',
+    'plz': 'please',
+}
+
+@functools.lru_cache(maxsize=4096)
+def _fold(c):
+    """Drop accents from a Latin letter; punctuation and symbols become spaces."""
+    category = unicodedata.category(c)
+    if category[0] in 'PS' or c == '_':
+        return ' '
+    # Marks in other scripts (kana dakuten, Hangul, Indic vowel signs) are part of the letter
+    if category[0] == 'L' and 'LATIN' in unicodedata.name(c, ''):
+        return ''.join(d for d in unicodedata.normalize('NFD', c) if not unicodedata.combining(d))
+    return c
+
+def normalize_query(query):
+    """Reduce a lyrics query to a canonical form so equivalent queries share a cache entry.
+
+    The result is a cache and coalescing key; Genius is sent what the user typed.
+    """
+    text = unicodedata.normalize('NFKC', query.lower())
+    text = re.sub(r"['’`]", '', text)
+    words = ''.join(_fold(c) for c in text).split()
+    return ' '.join(SPELLING_FIXES.get(word, word) for word in words)
+
+class LyricsCache:
+    """TTL and size-bounded cache of search results keyed by normalized query."""
+
+    def __init__(self, max_entries=5000, ttl=24 * 3600, name='lyrics'):
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._backend = MemoryBackend(max_entries)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        results = self._backend.get(key)
+        with self._lock:
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.CACHE_REQUESTS.inc(self.name, 'miss' if results is None else 'hit')
+        return results
+
+    def set(self, key, results):
+        self._backend.set(key, results, time.time() + self.ttl)
+
+    def stats(self):
+        """Return hit/miss counters and current size for sizing the cache."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._backend),
+            'max_entries': self._backend.max_entries
+        }
+
+class LyricsPageParser(HTMLParser):
+    """Collect lyric lines from a Genius song page as it streams in.
+
+    `found` turns True once a line matching the query and the line after it
+    have been read, so the rest of the page need not be downloaded.
+    """
+
+    def __init__(self, query):
+        super().__init__()
+        self.query = set(normalize_query(query).split())
+        self.lines = []
+        self.scores = []
+        self.found = False
+        self._depth = 0
+        self._line = []
+
+    def handle_starttag(self, tag, attrs):
+        if self._depth:
+            if tag == 'div':
+                self._depth += 1
+            elif tag == 'br':
+                self._end_line()
+        elif tag == 'div' and ('data-lyrics-container', 'true') in attrs:
+            self._depth = 1
+
+    def handle_endtag(self, tag):
+        if self._depth and tag == 'div':
+            self._depth -= 1
+            if not self._depth:
+                self._end_line()
+                # A match on a container's last line has no following line to wait for
+                if self.scores and self.scores[-1] >= PREVIEW_MATCH_SCORE:
+                    self.found = True
+
+    def handle_data(self, data):
+        if self._depth:
+            self._line.append(data)
+
+    def _end_line(self):
+        line = ' '.join(''.join(self._line).split())
+        self._line = []
+        # Skip blank lines and section headers like [Chorus]
+        if not line or line.startswith('['):
+            return
+        if self.scores and self.scores[-1] >= PREVIEW_MATCH_SCORE:
+            self.found = True
+        self.lines.append(line)
+        self.scores.append(self._score(line))
+
+    def _score(self, line):
+        if not self.query:
+            return 0.0
+        return len(self.query & set(normalize_query(line).split())) / len(self.query)
+
+    def preview(self):
+        """Return {'lines': [...], 'match': index of the matching line or None}, or None."""
+        if not self.lines:
+            return None
+        best = max(range(len(self.scores)), key=self.scores.__getitem__)
+        if not self.scores[best]:
+            return {'lines': [line[:PREVIEW_LINE_LENGTH] for line in self.lines[:2]], 'match': None}
+        start = max(0, best - 1)
+        return {
+            'lines': [line[:PREVIEW_LINE_LENGTH] for line in self.lines[start:best + 2]],
+            'match': best - start
+        }
+
+def read_lyrics(chunks, query):
+    """Parse page chunks until the matching lines are found and return the parser."""
+    parser = LyricsPageParser(query)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    received = 0
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        received += len(chunk)
+        if parser.found or received >= PREVIEW_MAX_BYTES:
+            break
+    return parser
 
 class LyricsSearch:
-    def __init__(self):
-        self.base_url = "https://api.genius.com"
+    def __init__(self, cache=None, index=None):
+        self.base_url = os.getenv('GENIUS_API_URL', 'https://api.genius.com')
         self.headers = {
             'Authorization': f'Bearer {os.getenv("GENIUS_ACCESS_TOKEN")}'
         }
+        self.cache = cache if cache is not None else LyricsCache(
+            max_entries=int(os.getenv('LYRICS_CACHE_SIZE', '5000')),
+            ttl=float(os.getenv('LYRICS_CACHE_TTL', 24 * 3600))
+        )
+        # Identical queries in flight at the same time share one Genius request
+        self.flight = SingleFlight()
+        self.async_flight = AsyncSingleFlight()
+        self.previews = LyricsCache(
+            max_entries=int(os.getenv('LYRICS_PREVIEW_CACHE_SIZE', '20000')),
+            ttl=float(os.getenv('LYRICS_CACHE_TTL', 24 * 3600)),
+            name='lyrics_preview'
+        )
+        self.preview_pool = ThreadPoolExecutor(max_workers=LYRICS_PREVIEW_WORKERS)
+        self._preview_limit = asyncio.Semaphore(LYRICS_PREVIEW_WORKERS)
+        # Songs and lyric lines seen so far answer repeat queries locally; writes
+        # are applied in order on one background thread. The index is opened on
+        # first use rather than at startup.
+        self._index = index if index is not None else Lazy('lyrics_index', lyrics_index.open_index)
+        self.index_writer = ThreadPoolExecutor(max_workers=1)
 
-    def search_song(self, query):
-        """Search for songs using lyrics or song title."""
+    @property
+    def index(self):
+        return self._index.get() if isinstance(self._index, Lazy) else self._index
+
+    def search_song(self, query, guard=None):
+        """Search for songs using lyrics or song title.
+
+        The local lyrics index is tried first; Genius is searched only when it
+        has no confident answer. Concurrent identical searches share one Genius
+        request. `guard` is called before that request is sent and may raise to
+        refuse it; cached, indexed and shared results are returned without
+        consulting it.
+        """
+        with metrics.span('lyrics_search'):
+            key = normalize_query(query) or query.strip()
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+            results = self._search_index(key)
+            if results:
+                self.cache.set(key, results)
+                return results
+            return self.flight.do(key, lambda: self._search_and_cache(key, query.strip(), guard))
+
+    def _search_index(self, key):
+        if self.index is None:
+            return None
+        try:
+            with metrics.span('lyrics_index'):
+                results = self.index.search(key, MAX_RESULTS)
+        except sqlite3.Error as e:
+            event_log.event('lyrics_index_error', logging.WARNING, error=str(e))
+            results = None
+        metrics.CACHE_REQUESTS.inc('lyrics_index', 'hit' if results else 'miss')
+        return results
+
+    def _index_write(self, method, *args):
+        try:
+            method(*args)
+        except sqlite3.Error as e:
+            event_log.event('lyrics_index_error', logging.WARNING, error=str(e))
+
+    def _index_songs(self, results):
+        if self.index is None or not results:
+            return
+        entries = [
+            (song, normalize_query(song['title']), normalize_query(song['artist']))
+            for song in results
+        ]
+        self.index_writer.submit(self._index_write, self.index.add_songs, entries)
+
+    def _index_lyrics(self, url, lines):
+        if self.index is None or not lines:
+            return
+        lines = [normalize_query(line) for line in lines]
+        self.index_writer.submit(self._index_write, self.index.add_lyrics, url, lines)
+
+    def _search_and_cache(self, key, query, guard):
+        if guard is not None:
+            guard()
+        with metrics.span('genius_search'):
+            results = self._search_genius(query)
+        if results:
+            self.cache.set(key, results)
+            self._index_songs(results)
+        return results
+
+    def _search_genius(self, query):
         search_url = f"{self.base_url}/search"
         params = {'q': query}
 
         try:
-            response = requests.get(search_url, headers=self.headers, params=params)
+            response = get_client('genius').get(search_url, headers=self.headers, params=params)
             response.raise_for_status()
-            data = response.json()
+            return self._parse_results(response.json())
 
-            if 'response' not in data:
-                return None
+        except Exception as e:
+            event_log.event('lyrics_search_error', logging.WARNING, error=str(e))
+            return None
 
-            hits = data['response']['hits']
-            if not hits:
-                return None
+    async def search_song_async(self, session, query, guard=None):
+        """Search for songs using an aiohttp session instead of blocking requests."""
+        key = normalize_query(query) or query.strip()
+        results = self.cache.get(key)
+        if results is not None:
+            return results
+        results = await asyncio.to_thread(self._search_index, key)
+        if results:
+            self.cache.set(key, results)
+            return results
+        return await self.async_flight.do(
+            key, lambda: self._search_and_cache_async(session, key, query.strip(), guard)
+        )
 
-            results = []
-            for hit in hits[:5]:  # Get top 5 results
-                song = hit['result']
-                results.append({
-                    'title': song['title'],
-                    'artist': song['primary_artist']['name'],
-                    'url': song['url'],
-                    'thumbnail': song['song_art_image_thumbnail_url']
-                })
+    async def _search_and_cache_async(self, session, key, query, guard):
+        if guard is not None:
+            # Rate limit backends may block on SQLite
+            await asyncio.to_thread(guard)
 
+        search_url = f"{self.base_url}/search"
+        params = {'q': query}
+
+        try:
+            with metrics.span('genius_search'):
+                response = await get_client('genius').request_async(
+                    lambda: session.get(search_url, headers=self.headers, params=params)
+                )
+                async with response:
+                    response.raise_for_status()
+                    results = self._parse_results(await response.json())
+            if results:
+                self.cache.set(key, results)
+                self._index_songs(results)
             return results
 
         except Exception as e:
-            print(f"Error in lyrics search: {str(e)}")
+            event_log.event('lyrics_search_error', logging.WARNING, error=str(e))
             return None
 
-    def get_lyrics_preview(self, url):
-        """Get a preview of the lyrics from the song's page."""
+    def _parse_results(self, data):
+        """Extract the top MAX_RESULTS songs from a Genius search response."""
+        if 'response' not in data:
+            return None
+
+        hits = data['response']['hits']
+        if not hits:
+            return None
+
+        results = []
+        for hit in hits[:MAX_RESULTS]:
+            song = hit['result']
+            results.append({
+                'title': song['title'],
+                'artist': song['primary_artist']['name'],
+                'url': song['url'],
+                'thumbnail': song['song_art_image_thumbnail_url']
+            })
+
+        return results
+
+    def get_lyrics_preview(self, url, query=''):
+        """Get the lines of a song's lyrics that best match the query."""
+        key = f"{url}\x00{normalize_query(query)}"
+        preview = self.previews.get(key)
+        if preview is not None:
+            return preview
+
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            # Note: This is a simplified version. In a production environment,
-            # you would want to properly parse the HTML and extract the lyrics.
-            return "Lyrics preview unavailable. Click the link to view full lyrics."
+            with metrics.span('lyrics_preview'):
+                response = get_client('genius').get(url, stream=True)
+                try:
+                    response.raise_for_status()
+                    parser = read_lyrics(response.iter_content(PREVIEW_CHUNK_SIZE), query)
+                finally:
+                    response.close()
+        except Exception as e:
+            event_log.event('lyrics_preview_error', logging.WARNING, url=url, error=str(e))
+            return None
+
+        self._index_lyrics(url, parser.lines)
+        preview = parser.preview()
+        if preview is not None:
+            self.previews.set(key, preview)
+        return preview
+
+    def get_previews(self, results, query):
+        """Fetch previews for every result concurrently; pages slower than the timeout give None."""
+        futures = [
+            self.preview_pool.submit(self.get_lyrics_preview, song['url'], query)
+            for song in results
+        ]
+        done, _ = wait(futures, timeout=LYRICS_PREVIEW_TIMEOUT)
+        return [future.result() if future in done else None for future in futures]
+
+    async def get_lyrics_preview_async(self, session, url, query=''):
+        """Asyncio variant of get_lyrics_preview."""
+        key = f"{url}\x00{normalize_query(query)}"
+        preview = self.previews.get(key)
+        if preview is not None:
+            return preview
+
+        try:
+            async with self._preview_limit:
+                with metrics.span('lyrics_preview'):
+                    async with session.get(url) as response:
+                        response.raise_for_status()
+                        parser = LyricsPageParser(query)
+                        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                        received = 0
+                        async for chunk in response.content.iter_chunked(PREVIEW_CHUNK_SIZE):
+                            parser.feed(decoder.decode(chunk))
+                            received += len(chunk)
+                            if parser.found or received >= PREVIEW_MAX_BYTES:
+                                # Drop the connection instead of reading the rest of the page
+                                response.close()
+                                break
         except Exception as e:
-            print(f"Error getting lyrics: {str(e)}")
+            event_log.event('lyrics_preview_error', logging.WARNING, url=url, error=str(e))
             return None
+
+        self._index_lyrics(url, parser.lines)
+        preview = parser.preview()
+        if preview is not None:
+            self.previews.set(key, preview)
+        return preview
+
+    async def get_previews_async(self, session, results, query):
+        """Asyncio variant of get_previews."""
+        if not results:
+            return []
+        tasks = [
+            asyncio.ensure_future(self.get_lyrics_preview_async(session, song['url'], query))
+            for song in results
+        ]
+        done, pending = await asyncio.wait(tasks, timeout=LYRICS_PREVIEW_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        return [task.result() if task in done else None for task in tasks]
@@ -1,422 +1,422 @@
-import os
+# Loads .env and starts the startup clock, so it comes before everything else
+import startup
+import logging
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-import requests
-from dotenv import load_dotenv
+import io
 import json
 from datetime import datetime
-from lyrics_search import LyricsSearch
-import time
-
-# Load environment variables
-load_dotenv()
-
-# Initialize bot and services
-BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-AUDD_API_KEY = os.getenv('AUDD_API_KEY')
-bot = telebot.TeleBot(BOT_TOKEN)
-lyrics_search = LyricsSearch()
-
-# Store user statistics
-user_stats = {}
-
-def log_user_action(user, action):
-    """Log user actions with timestamp."""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{timestamp}] 👤 User: {user.first_name} (ID: {user.id})")
-    print(f"[{timestamp}] 🎯 Action: {action}")
-    print("-" * 50)
-
-def init_user_stats(user_id):
-    if user_id not in user_stats:
-        user_stats[user_id] = {
-            'searches': 0,
-            'successful_matches': 0,
-            'history': [],
-            'joined_date': datetime.now().strftime('%Y-%m-%d')
-        }
-
-def create_menu_keyboard():
-    """Create an inline keyboard for the main menu."""
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton("📊 Statistics", callback_data="stats"),
-        InlineKeyboardButton("📜 History", callback_data="history"),
-        InlineKeyboardButton("ℹ️ Help", callback_data="help"),
-        InlineKeyboardButton("👾 About", callback_data="about")
-    ]
-    keyboard.add(*buttons)
-    return keyboard
+import metrics
+from http_client import get_client, telegram_request_sender, MultipartBody
+from downloads import FileTooLarge, check_media
+from scheduler import UpdateScheduler, ScheduledTeleBot
+from rate_limit import RateLimited, QuotaExhausted
+from singleflight import SingleFlight
+from outbound import OutboundDispatcher
+import audio_preprocess
+import multi_window
+from recognition_cache import MISS, file_key, file_content_key
+import messages
+import threading
+import contextlib
+from services import (
+    BOT_TOKEN, AUDD_API_KEY, AUDD_API_URL, TELEGRAM_API_URL, telegram_files,
+    lyrics_search, recognition_cache, fingerprint_index, index_writer, local_lookup,
+    local_lookup_windows, decode_samples,
+    user_store, analytics, log_user_action, rate_limiter, genius_guard, limit_text, file_too_large_text
+)
+
+# Initialize the polling bot
+telebot.apihelper.API_URL = TELEGRAM_API_URL + '/bot{0}/{1}'
+telebot.apihelper.FILE_URL = TELEGRAM_API_URL + '/file/bot{0}/{1}'
+# Chat messages and callback answers are paced to Telegram's flood limits
+outbound = startup.timed('outbound', OutboundDispatcher.from_env, telegram_request_sender)
+telebot.apihelper.CUSTOM_REQUEST_SENDER = outbound.request if outbound else telegram_request_sender
+scheduler = startup.timed('scheduler', UpdateScheduler.from_env)
+bot = startup.timed('bot', ScheduledTeleBot, BOT_TOKEN, scheduler)
+recognition_flight = SingleFlight()
+
+def notify_queue_position(update, position):
+    """Tell a user their heavy request is waiting for a free worker."""
+    bot.reply_to(update.message, messages.QUEUE_POSITION_TEXT.format(position=position))
+
+def notify_queue_full(update):
+    """Tell a user their request was dropped because the queue is full."""
+    if update.message is not None:
+        bot.reply_to(update.message, messages.QUEUE_FULL_TEXT)
+    elif update.callback_query is not None:
+        bot.answer_callback_query(update.callback_query.id, messages.QUEUE_FULL_TEXT)
+
+scheduler.on_queued = notify_queue_position
+scheduler.on_rejected = notify_queue_full
 
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     # Initialize user stats
-    init_user_stats(message.from_user.id)
+    user_store.ensure_user(message.from_user.id)
     
     # Log user start
     log_user_action(message.from_user, "started using the bot")
     
-    welcome_text = (
-        "🎵 *Welcome to Music Recognition Bot!*\n\n"
-        "I'm your personal music detective! Here's what I can do:\n\n"
-        "🎧 *Identify Songs From:*\n"
-        "• Audio files 🎵\n"
-        "• Voice messages 🎤\n"
-        "• Video files 🎥\n"
-        "• Song lyrics 📝\n\n"
-        "*Quick Start:*\n"
-        "1️⃣ Send any audio/voice/video\n"
-        "2️⃣ Or use /lyrics to search by text\n"
-        "3️⃣ Get instant song matches!\n\n"
-        "Use the menu below to explore more features! 👇"
-    )
     bot.send_message(
         message.chat.id,
-        welcome_text,
+        messages.WELCOME_TEXT,
         parse_mode="Markdown",
-        reply_markup=create_menu_keyboard()
+        reply_markup=messages.MENU_KEYBOARD
     )
 
 @bot.message_handler(commands=['help'])
 def send_help(message):
     log_user_action(message.from_user, "requested help")
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton("🔍 Try Lyrics Search", callback_data="lyrics_help"),
-        InlineKeyboardButton("📊 View Stats", callback_data="stats"),
-        InlineKeyboardButton("📜 View History", callback_data="history"),
-        InlineKeyboardButton("ℹ️ About Bot", callback_data="about")
-    ]
-    keyboard.add(*buttons)
-
-    help_text = (
-        "*🤖 Bot Commands & Features*\n\n"
-        "*Main Commands:*\n"
-        "• /start - Launch the bot\n"
-        "• /stats - Your usage statistics\n"
-        "• /history - Recent searches\n"
-        "• /about - Bot information\n"
-        "• /help - Show this help\n\n"
-        "*Music Recognition:*\n"
-        "• Send any audio file 🎵\n"
-        "• Record a voice message 🎤\n"
-        "• Share a video clip 🎥\n\n"
-        "*Lyrics Search:*\n"
-        "• Use /lyrics + text 📝\n"
-        "Example: `/lyrics we will rock you`\n\n"
-        "_Select an option below:_ 👇"
-    )
     bot.reply_to(
         message,
-        help_text,
+        messages.HELP_TEXT,
         parse_mode="Markdown",
-        reply_markup=keyboard
+        reply_markup=messages.HELP_KEYBOARD
     )
 
 @bot.message_handler(commands=['about'])
 def send_about(message):
     log_user_action(message.from_user, "viewed about info")
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton("🎵 Start Using", callback_data="new_search"),
-        InlineKeyboardButton("❓ Help", callback_data="help"),
-        InlineKeyboardButton("⭐️ View Stats", callback_data="stats"),
-        InlineKeyboardButton("📜 History", callback_data="history")
-    ]
-    keyboard.add(*buttons)
-
-    about_text = (
-        "*🎵 Music Recognition Bot*\n\n"
-        "*Features:*\n"
-        "• Instant song recognition 🎧\n"
-        "• Support for multiple file types 📁\n"
-        "• Lyrics search functionality 📝\n"
-        "• Personal usage statistics 📊\n"
-        "• Search history tracking 📜\n\n"
-        "*Technologies:*\n"
-        "• AuDD Music Recognition API 🎵\n"
-        "• Genius Lyrics API 📚\n"
-        "• Spotify Integration 🎧\n"
-        "• Apple Music Integration 🎵\n\n"
-        "_Created with ❤️ by Your Bot Creator_\n\n"
-        "What would you like to do? 👇"
-    )
     bot.reply_to(
         message,
-        about_text,
+        messages.ABOUT_TEXT,
         parse_mode="Markdown",
-        reply_markup=keyboard
+        reply_markup=messages.ABOUT_KEYBOARD
     )
 
 @bot.message_handler(commands=['stats'])
 def send_stats(message):
     log_user_action(message.from_user, "checked their stats")
-    user_id = message.from_user.id
-    init_user_stats(user_id)
-    stats = user_stats[user_id]
-    
-    success_rate = (stats['successful_matches'] / stats['searches'] * 100) if stats['searches'] > 0 else 0
-    
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton("📜 View History", callback_data="history"),
-        InlineKeyboardButton("🔍 New Search", callback_data="new_search")
-    ]
-    keyboard.add(*buttons)
-    
-    stats_text = (
-        "*📊 Your Music Detective Stats*\n\n"
-        "*Activity Overview:*\n"
-        f"• Total Searches: `{stats['searches']}`\n"
-        f"• Successful Matches: `{stats['successful_matches']}`\n"
-        f"• Success Rate: `{success_rate:.1f}%`\n"
-        f"• Member Since: `{stats['joined_date']}`\n\n"
-        "_Select an option below:_ 👇"
-    )
     bot.reply_to(
         message,
-        stats_text,
+        messages.format_stats(user_store.get_stats(message.from_user.id)),
         parse_mode="Markdown",
-        reply_markup=keyboard
+        reply_markup=messages.STATS_KEYBOARD
     )
 
 @bot.message_handler(commands=['history'])
 def send_history(message):
     log_user_action(message.from_user, "viewed their history")
-    user_id = message.from_user.id
-    init_user_stats(user_id)
-    history = user_stats[user_id]['history']
-    
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton("🔍 New Search", callback_data="new_search"),
-        InlineKeyboardButton("📊 View Stats", callback_data="stats")
-    ]
-    keyboard.add(*buttons)
-    
+    history = user_store.get_history(message.from_user.id, limit=10)
+
     if not history:
         bot.reply_to(
             message,
-            "*No Search History Yet* 🎵\n\n"
-            "Start by:\n"
-            "• Sending an audio file\n"
-            "• Recording a voice message\n"
-            "• Using /lyrics to search\n\n"
-            "_Try your first search!_ 👇",
+            messages.NO_HISTORY_TEXT,
             parse_mode="Markdown",
-            reply_markup=keyboard
+            reply_markup=messages.HISTORY_KEYBOARD
         )
         return
-    
-    history_text = (
-        "*🕒 Your Recent Music Discoveries*\n\n"
-        "_Last 10 searches:_\n\n"
+
+    bot.reply_to(
+        message,
+        messages.format_history(history),
+        parse_mode="Markdown",
+        reply_markup=messages.HISTORY_KEYBOARD
     )
-    for item in history[-10:]:  # Show last 10 searches
-        history_text += f"• `{item['title']}` - _{item['artist']}_\n"
-    
-    history_text += "\n_What would you like to do next?_ 👇"
-    
+
+@bot.message_handler(commands=['top'])
+def send_top(message):
+    log_user_action(message.from_user, "viewed the top charts")
     bot.reply_to(
         message,
-        history_text,
+        messages.format_top(
+            analytics.top_tracks(), analytics.top_artists(5), analytics.hit_rates(), analytics.worker
+        ),
         parse_mode="Markdown",
-        reply_markup=keyboard
+        reply_markup=messages.TOP_KEYBOARD
     )
 
-def create_loading_animation(message):
-    """Create a loading animation while processing."""
-    loading_texts = [
-        "🎵 Analyzing your file",
-        "🎵 Analyzing your file.",
-        "🎵 Analyzing your file..",
-        "🎵 Analyzing your file..."
-    ]
-    msg = bot.reply_to(message, loading_texts[0])
-    
-    for i in range(2):  # Show animation for 2 cycles
-        for text in loading_texts[1:]:
-            time.sleep(0.5)
-            try:
-                bot.edit_message_text(text, chat_id=msg.chat.id, message_id=msg.message_id)
-            except:
-                pass
-    
-    return msg
+class LoadingAnimation:
+    """Animate a progress message in the background while a file is processed."""
+
+    interval = 0.5
+
+    def __init__(self, message, text="🎵 Analyzing your file"):
+        self.text = text
+        with metrics.span('progress_message'):
+            self.msg = bot.reply_to(message, text)
+        self._stopped = threading.Event()
+        # Held from checking _stopped until a frame is queued
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stage(self, text):
+        """Switch the animated text to the current pipeline stage."""
+        self.text = text
+
+    def stop(self):
+        """Stop animating; returns once no further frame can be queued.
+
+        A frame still waiting in the outbound queue is taken over by the next
+        edit of the message, the result, rather than sent before it.
+        """
+        with self._lock:
+            self._stopped.set()
+
+    def _run(self):
+        dots = 1
+        while not self._stopped.wait(self.interval):
+            if not self._frame(self.text + "." * dots):
+                return
+            dots = dots % 3 + 1
+
+    def _frame(self, text):
+        held = True
+
+        def release():
+            nonlocal held
+            if held:
+                held = False
+                self._lock.release()
+
+        self._lock.acquire()
+        try:
+            if self._stopped.is_set():
+                return False
+            # Without the dispatcher the lock is held until the frame is sent
+            with outbound.when_queued(release) if outbound else contextlib.nullcontext():
+                bot.edit_message_text(text, chat_id=self.msg.chat.id, message_id=self.msg.message_id)
+        except Exception:
+            pass
+        finally:
+            release()
+        return True
+
+def fetch_clip(media, file_info):
+    """Return a file object to recognize: a short mono excerpt, or the whole file without ffmpeg."""
+    if not audio_preprocess.is_available():
+        return telegram_files.spool(file_info.file_path, file_info.file_size)
+    return io.BytesIO(audio_preprocess.extract_clip(
+        telegram_files.stream(file_info.file_path, file_info.file_size),
+        mime_type=getattr(media, 'mime_type', None),
+        offset=audio_preprocess.clip_offset(media.duration)
+    ))
+
+def recognize_song(content):
+    """Upload a clip (bytes or a file object) to AuDD and return its JSON result."""
+    # Close to the daily quota only caches and the local index are used
+    rate_limiter.check_quota('audd')
+    rate_limiter.record_call('audd')
+    body = MultipartBody({'api_token': AUDD_API_KEY, 'return': 'apple_music,spotify'}, 'file', content)
+    with metrics.span('audd'):
+        response = get_client('audd').post(
+            AUDD_API_URL, data=body, headers={'Content-Type': body.content_type}
+        )
+        return response.json()
+
+def recognize_file(media, file_info, animation):
+    """Recognize a Telegram file, returning its content cache key and the song.
+
+    Re-uploads of the same file get a new file_unique_id but identical content,
+    so the content key is checked before anything else. Trending tracks are then
+    usually found in the local fingerprint index; AuDD is called only after that.
+    The song is MISS when AuDD returned an error, which must not be cached.
+    """
+    if multi_window.should_split(media.duration):
+        # Long files are kept on disk and several windows are tried in parallel
+        chunks = telegram_files.stream(file_info.file_path, file_info.file_size)
+        with audio_preprocess.spool_to_tempfile(chunks) as tmp:
+            hash_key = file_content_key(tmp)
+            song = recognition_cache.get(hash_key)
+            if song is not MISS:
+                return hash_key, song
+            # The local index is checked against the windows AuDD would hear
+            starts = multi_window.pick_file_windows(tmp.name)
+            song = local_lookup_windows(tmp.name, starts)
+            if song:
+                return hash_key, song
+            animation.stage("🎵 Identifying the song")
+            with metrics.span('multi_window'):
+                result, _, clip = multi_window.recognize_file(tmp.name, recognize_song, starts=starts)
+            # Only the window AuDD matched is indexed under the song
+            samples = decode_samples(clip) if clip is not None else None
+    else:
+        with metrics.span('fetch_clip'):
+            content = fetch_clip(media, file_info)
+        with content:
+            hash_key = file_content_key(content)
+            song = recognition_cache.get(hash_key)
+            if song is not MISS:
+                return hash_key, song
+            samples, song = local_lookup(content)
+            if song:
+                return hash_key, song
+            # Recognize music using AuDD API
+            animation.stage("🎵 Identifying the song")
+            result = recognize_song(content)
+
+    if result['status'] != 'success':
+        return hash_key, MISS
+    song = result.get('result')
+    if song and samples is not None:
+        index_writer.submit(fingerprint_index.get().add, song, samples)
+    return hash_key, song
+
+def recognize_upload(message, media, unique_key, animation):
+    """Fetch and recognize an uploaded file, caching the song under both of its keys."""
+    # The global bucket is spent once for everyone waiting on this recognition
+    rate_limiter.check('audd', message.from_user.id, message.chat.id, scopes=('global',))
+
+    # Download file
+    animation.stage("🎵 Fetching your file")
+    with metrics.span('get_file'):
+        file_info = bot.get_file(media.file_id)
+    hash_key, song = recognize_file(media, file_info, animation)
+    if song is MISS:
+        return None
+    recognition_cache.set([unique_key, hash_key], song)
+    return song
+
+def send_recognition_reply(message, processing_msg, text, **kwargs):
+    """Edit the progress message with the result, or reply directly when there is none."""
+    with metrics.span('reply'):
+        if processing_msg is None:
+            bot.reply_to(message, text, **kwargs)
+        else:
+            bot.edit_message_text(
+                text,
+                chat_id=processing_msg.chat.id,
+                message_id=processing_msg.message_id,
+                **kwargs
+            )
 
 @bot.message_handler(content_types=['audio', 'voice', 'video'])
+@metrics.instrument('handle_audio')
 def handle_audio(message):
     try:
         # Log file processing
         file_type = 'audio' if message.audio else 'voice' if message.voice else 'video'
-        log_user_action(message.from_user, f"submitted a {file_type} file for recognition")
-        
-        # Show loading animation
-        processing_msg = create_loading_animation(message)
-        
-        # Get file info
-        if message.audio:
-            file_info = bot.get_file(message.audio.file_id)
-        elif message.voice:
-            file_info = bot.get_file(message.voice.file_id)
-        else:  # video
-            file_info = bot.get_file(message.video.file_id)
-        
-        # Download file
-        file_path = file_info.file_path
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        
-        # Recognize music using AuDD API
-        response = requests.post('https://api.audd.io/', data={
-            'api_token': AUDD_API_KEY,
-            'url': file_url,
-            'return': 'apple_music,spotify'
-        })
-        
-        result = response.json()
-        
-        # Update user stats
+        log_user_action(message.from_user, "submitted a file for recognition", file_type=file_type)
+        media = message.audio or message.voice or message.video
+
+        # Forwarded copies of a file share its file_unique_id
+        unique_key = file_key(media.file_unique_id)
+        song = recognition_cache.get(unique_key)
+        processing_msg = None
+
+        if song is MISS:
+            # Oversized files are refused before they cost a token or a download
+            check_media(media)
+            # Each sender's own buckets are checked before joining a shared
+            # recognition, so one user's limit is never reported to the others
+            rate_limiter.check('audd', message.from_user.id, message.chat.id, scopes=('user', 'chat'))
+
+            # Animate progress while the file is fetched and recognized
+            with LoadingAnimation(message) as animation:
+                processing_msg = animation.msg
+
+                # Everyone sending this file meanwhile waits for the first recognition
+                song = recognition_flight.do(
+                    unique_key,
+                    lambda: recognize_upload(message, media, unique_key, animation)
+                )
+        else:
+            log_user_action(message.from_user, "answered from recognition cache")
+
         user_id = message.from_user.id
-        init_user_stats(user_id)
-        user_stats[user_id]['searches'] += 1
-        
-        if result['status'] == 'success' and result.get('result'):
+        analytics.record(file_type, song)
+
+        if song:
             # Successful match
-            song = result['result']
-            user_stats[user_id]['successful_matches'] += 1
-            
+            user_store.record_search(user_id, song, matched=True)
+
             # Log successful recognition
-            log_user_action(message.from_user, f"found song: {song['title']} by {song['artist']}")
-            
-            # Add to history
-            user_stats[user_id]['history'].append({
-                'title': song['title'],
-                'artist': song['artist']
-            })
-            
-            # Create inline keyboard for streaming links
-            keyboard = InlineKeyboardMarkup(row_width=2)
-            buttons = []
-            if 'spotify' in song:
-                buttons.append(InlineKeyboardButton(
-                    "🎧 Listen on Spotify",
-                    url=song['spotify']['external_urls']['spotify']
-                ))
-            if 'apple_music' in song:
-                buttons.append(InlineKeyboardButton(
-                    "🎵 Listen on Apple Music",
-                    url=song['apple_music']['url']
-                ))
-            buttons.append(InlineKeyboardButton("🔍 New Search", callback_data="new_search"))
-            keyboard.add(*buttons)
-            
-            # Format response with emojis and markdown
-            response_text = (
-                f"*✨ Found Your Song!*\n\n"
-                f"*🎵 Title:* `{song['title']}`\n"
-                f"*👤 Artist:* `{song['artist']}`\n"
-                f"*💿 Album:* `{song.get('album', 'N/A')}`\n"
-                f"*📅 Released:* `{song.get('release_date', 'N/A')}`\n\n"
-                f"_Click the buttons below to listen:_ 👇"
-            )
-            
-            bot.edit_message_text(
+            log_user_action(message.from_user, "found song", title=song['title'], artist=song['artist'])
+
+            response_text, keyboard = messages.format_song(song)
+            send_recognition_reply(
+                message,
+                processing_msg,
                 response_text,
-                chat_id=processing_msg.chat.id,
-                message_id=processing_msg.message_id,
                 parse_mode="Markdown",
                 reply_markup=keyboard
             )
         else:
+            user_store.record_search(user_id)
+
             # Log failed recognition
             log_user_action(message.from_user, "no song match found")
-            
-            bot.edit_message_text(
-                "Sorry, I couldn't identify that song. Please try again with a different part of the song.",
-                chat_id=processing_msg.chat.id,
-                message_id=processing_msg.message_id
-            )
-    
+
+            send_recognition_reply(message, processing_msg, messages.NO_MATCH_TEXT)
+
+    except (RateLimited, QuotaExhausted) as e:
+        log_user_action(message.from_user, "was refused", level=logging.WARNING, reason=str(e))
+        send_recognition_reply(message, processing_msg, limit_text(e))
+
+    except FileTooLarge as e:
+        log_user_action(message.from_user, "sent a file over the limits", level=logging.WARNING, reason=str(e))
+        send_recognition_reply(message, processing_msg, file_too_large_text())
+
     except Exception as e:
-        log_user_action(message.from_user, f"encountered an error: {str(e)}")
-        bot.reply_to(
-            message,
-            "Sorry, something went wrong while processing your request. Please try again later."
-        )
-        print(f"Error: {str(e)}")
+        log_user_action(message.from_user, "encountered an error", level=logging.ERROR, error=str(e))
+        bot.reply_to(message, messages.RECOGNITION_ERROR_TEXT)
 
 @bot.message_handler(commands=['lyrics'])
+@metrics.instrument('handle_lyrics_search')
 def handle_lyrics_search(message):
     try:
         # Get the search query
         query = message.text.replace('/lyrics', '').strip()
         
         # Log lyrics search attempt
-        log_user_action(message.from_user, f"searched lyrics: '{query}'" if query else "attempted lyrics search without query")
+        log_user_action(message.from_user, "searched lyrics" if query else "attempted lyrics search without query", query=query)
         
         if not query:
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("📝 Try an Example", callback_data="lyrics_example"))
             bot.reply_to(
                 message,
-                "*How to Search by Lyrics* 🎵\n\n"
-                "Type /lyrics followed by some lyrics you remember.\n\n"
-                "Example: `/lyrics we will rock you`\n\n"
-                "_Click the button below to try an example!_ 👇",
+                messages.LYRICS_USAGE_TEXT,
                 parse_mode="Markdown",
-                reply_markup=keyboard
+                reply_markup=messages.LYRICS_EXAMPLE_KEYBOARD
             )
             return
 
         # Show searching animation
         loading_msg = bot.reply_to(
             message,
-            "🔍 *Searching for matching songs...*",
+            messages.LYRICS_SEARCHING_TEXT,
             parse_mode="Markdown"
         )
 
         # Search for songs
-        results = lyrics_search.search_song(query)
+        try:
+            results = lyrics_search.search_song(query, guard=genius_guard(message))
+        except (RateLimited, QuotaExhausted) as e:
+            log_user_action(message.from_user, "was refused", level=logging.WARNING, reason=str(e))
+            bot.edit_message_text(
+                limit_text(e),
+                chat_id=loading_msg.chat.id,
+                message_id=loading_msg.message_id
+            )
+            return
         
         if not results:
             # Log no results found
             log_user_action(message.from_user, "no lyrics matches found")
+            analytics.record('lyrics')
             
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton("🔄 Try Another Search", callback_data="lyrics_help"))
             bot.edit_message_text(
-                "*No Songs Found* 😕\n\n"
-                "Try:\n"
-                "• Using different lyrics\n"
-                "• Checking for typos\n"
-                "• Using a longer portion of the lyrics\n\n"
-                "_Click below to try another search!_ 👇",
+                messages.NO_LYRICS_MATCH_TEXT,
                 chat_id=loading_msg.chat.id,
                 message_id=loading_msg.message_id,
                 parse_mode="Markdown",
-                reply_markup=keyboard
+                reply_markup=messages.LYRICS_RETRY_KEYBOARD
             )
             return
 
         # Log successful search
-        log_user_action(message.from_user, f"found {len(results)} songs matching lyrics")
-
-        # Create inline keyboard for results
-        keyboard = InlineKeyboardMarkup(row_width=1)
-        for song in results:
-            keyboard.add(InlineKeyboardButton(
-                f"🎵 {song['title']} - {song['artist']}",
-                url=song['url']
-            ))
-        keyboard.add(InlineKeyboardButton("🔍 New Lyrics Search", callback_data="lyrics_help"))
-
-        # Format results with markdown
-        response = (
-            f"*✨ Found {len(results)} Matching Songs!*\n\n"
-            f"*Your Lyrics:* `{query}`\n\n"
-            "_Click on a song to see full lyrics:_ 👇"
-        )
+        log_user_action(message.from_user, "found songs matching lyrics", results=len(results))
 
+        # Song pages are fetched in parallel to show the matching lines
+        previews = lyrics_search.get_previews(results, query)
+        response, keyboard = messages.format_lyrics_results(query, results, previews)
         bot.edit_message_text(
             response,
             chat_id=loading_msg.chat.id,
@@ -424,30 +424,21 @@ def handle_lyrics_search(message):
             parse_mode="Markdown",
             reply_markup=keyboard
         )
-        
-        # Update user stats
-        user_id = message.from_user.id
-        init_user_stats(user_id)
-        user_stats[user_id]['searches'] += 1
-        
-        # Add first result to history
-        if results:
-            user_stats[user_id]['history'].append({
-                'title': results[0]['title'],
-                'artist': results[0]['artist']
-            })
+
+        # Update user stats and add first result to history
+        user_store.record_search(message.from_user.id, results[0])
+        analytics.record('lyrics', results[0])
 
     except Exception as e:
-        log_user_action(message.from_user, f"lyrics search error: {str(e)}")
-        bot.reply_to(message, "Sorry, something went wrong while searching for lyrics. Please try again later.")
-        print(f"Error in lyrics search: {str(e)}")
+        log_user_action(message.from_user, "lyrics search error", level=logging.ERROR, error=str(e))
+        bot.reply_to(message, messages.LYRICS_ERROR_TEXT)
 
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback_query(call):
     """Handle inline keyboard button clicks."""
     try:
         # Log button click
-        log_user_action(call.from_user, f"clicked button: {call.data}")
+        log_user_action(call.from_user, "clicked button", event='button_click', button=call.data)
         
         if call.data == "stats":
             send_stats(call.message)
@@ -460,67 +451,39 @@ def handle_callback_query(call):
         elif call.data == "lyrics_help":
             bot.send_message(
                 call.message.chat.id,
-                "*Search by Lyrics* 🎵\n\n"
-                "Type /lyrics followed by some lyrics you remember.\n\n"
-                "Example: `/lyrics we will rock you`",
+                messages.LYRICS_HELP_TEXT,
                 parse_mode="Markdown"
             )
         elif call.data == "lyrics_example":
             bot.send_message(
                 call.message.chat.id,
-                "/lyrics we will rock you"
+                messages.LYRICS_EXAMPLE_TEXT
             )
         elif call.data == "new_search":
-            text = (
-                "*Ready for Another Song!* 🎵\n\n"
-                "You can:\n"
-                "• Send an audio file 🎵\n"
-                "• Send a voice message 🎤\n"
-                "• Send a video file 🎥\n"
-                "• Use /lyrics to search by lyrics 📝\n"
-            )
             bot.send_message(
                 call.message.chat.id,
-                text,
+                messages.NEW_SEARCH_TEXT,
                 parse_mode="Markdown",
-                reply_markup=create_menu_keyboard()
+                reply_markup=messages.MENU_KEYBOARD
             )
         
         # Remove the loading animation from inline button
         bot.answer_callback_query(call.id)
     
     except Exception as e:
-        print(f"Callback error: {str(e)}")
-        bot.answer_callback_query(call.id, "An error occurred. Please try again.")
+        log_user_action(call.from_user, "callback error", level=logging.ERROR, button=call.data, error=str(e))
+        bot.answer_callback_query(call.id, messages.CALLBACK_ERROR_TEXT)
 
 @bot.message_handler(func=lambda message: True)
 def echo_all(message):
     # Log unknown command/message
-    log_user_action(message.from_user, f"sent unrecognized message: {message.text}")
+    log_user_action(message.from_user, "sent unrecognized message", text=message.text)
     
-    keyboard = InlineKeyboardMarkup(row_width=2)
-    buttons = [
-        InlineKeyboardButton("📖 View Commands", callback_data="help"),
-        InlineKeyboardButton("🔍 Search Lyrics", callback_data="lyrics_help"),
-        InlineKeyboardButton("📊 My Stats", callback_data="stats"),
-        InlineKeyboardButton("ℹ️ About", callback_data="about")
-    ]
-    keyboard.add(*buttons)
-    
-    text = (
-        "*How Can I Help You?* 🤔\n\n"
-        "Send me:\n"
-        "• Audio file 🎵\n"
-        "• Voice message 🎤\n"
-        "• Video file 🎥\n"
-        "• Use /lyrics + text 📝\n\n"
-        "_Choose an option below or send me a file!_ 👇"
-    )
     bot.reply_to(
         message,
-        text,
+        messages.UNKNOWN_MESSAGE_TEXT,
         parse_mode="Markdown",
-        reply_markup=keyboard
+        reply_markup=messages.UNKNOWN_KEYBOARD
     )
 
 def main():
@@ -531,7 +494,11 @@ def main():
     print(f"Start Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 50 + "\n")
     
-    # Start bot
+    metrics.start_server()
+    startup.ready('threaded')
+    startup.warm_up()
+
+    # Start bot; updates are dispatched to the fast and heavy lanes
     bot.infinity_polling()
 
 if __name__ == "__main__":
@@ -0,0 +1,344 @@
+import re
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+# Reply texts and keyboards shared by the polling and asyncio runtimes
+
+WELCOME_TEXT = (
+    "🎵 *Welcome to Music Recognition Bot!*\n\n"
+    "I'm your personal music detective! Here's what I can do:\n\n"
+    "🎧 *Identify Songs From:*\n"
+    "• Audio files 🎵\n"
+    "• Voice messages 🎤\n"
+    "• Video files 🎥\n"
+    "• Song lyrics 📝\n\n"
+    "*Quick Start:*\n"
+    "1️⃣ Send any audio/voice/video\n"
+    "2️⃣ Or use /lyrics to search by text\n"
+    "3️⃣ Get instant song matches!\n\n"
+    "Use the menu below to explore more features! 👇"
+)
+
+HELP_TEXT = (
+    "*🤖 Bot Commands & Features*\n\n"
+    "*Main Commands:*\n"
+    "• /start - Launch the bot\n"
+    "• /stats - Your usage statistics\n"
+    "• /history - Recent searches\n"
+    "• /top - Most found songs and artists\n"
+    "• /about - Bot information\n"
+    "• /help - Show this help\n\n"
+    "*Music Recognition:*\n"
+    "• Send any audio file 🎵\n"
+    "• Record a voice message 🎤\n"
+    "• Share a video clip 🎥\n\n"
+    "*Lyrics Search:*\n"
+    "• Use /lyrics + text 📝\n"
+    "Example: `/lyrics we will rock you`\n\n"
+    "_Select an option below:_ 👇"
+)
+
+ABOUT_TEXT = (
+    "*🎵 Music Recognition Bot*\n\n"
+    "*Features:*\n"
+    "• Instant song recognition 🎧\n"
+    "• Support for multiple file types 📁\n"
+    "• Lyrics search functionality 📝\n"
+    "• Personal usage statistics 📊\n"
+    "• Search history tracking 📜\n\n"
+    "*Technologies:*\n"
+    "• AuDD Music Recognition API 🎵\n"
+    "• Genius Lyrics API 📚\n"
+    "• Spotify Integration 🎧\n"
+    "• Apple Music Integration 🎵\n\n"
+    "_Created with ❤️ by Your Bot Creator_\n\n"
+    "What would you like to do? 👇"
+)
+
+NO_HISTORY_TEXT = (
+    "*No Search History Yet* 🎵\n\n"
+    "Start by:\n"
+    "• Sending an audio file\n"
+    "• Recording a voice message\n"
+    "• Using /lyrics to search\n\n"
+    "_Try your first search!_ 👇"
+)
+
+NO_MATCH_TEXT = "Sorry, I couldn't identify that song. Please try again with a different part of the song."
+
+RECOGNITION_ERROR_TEXT = "Sorry, something went wrong while processing your request. Please try again later."
+
+LYRICS_USAGE_TEXT = (
+    "*How to Search by Lyrics* 🎵\n\n"
+    "Type /lyrics followed by some lyrics you remember.\n\n"
+    "Example: `/lyrics we will rock you`\n\n"
+    "_Click the button below to try an example!_ 👇"
+)
+
+LYRICS_SEARCHING_TEXT = "🔍 *Searching for matching songs...*"
+
+NO_LYRICS_MATCH_TEXT = (
+    "*No Songs Found* 😕\n\n"
+    "Try:\n"
+    "• Using different lyrics\n"
+    "• Checking for typos\n"
+    "• Using a longer portion of the lyrics\n\n"
+    "_Click below to try another search!_ 👇"
+)
+
+LYRICS_ERROR_TEXT = "Sorry, something went wrong while searching for lyrics. Please try again later."
+
+LYRICS_HELP_TEXT = (
+    "*Search by Lyrics* 🎵\n\n"
+    "Type /lyrics followed by some lyrics you remember.\n\n"
+    "Example: `/lyrics we will rock you`"
+)
+
+LYRICS_EXAMPLE_TEXT = "/lyrics we will rock you"
+
+NEW_SEARCH_TEXT = (
+    "*Ready for Another Song!* 🎵\n\n"
+    "You can:\n"
+    "• Send an audio file 🎵\n"
+    "• Send a voice message 🎤\n"
+    "• Send a video file 🎥\n"
+    "• Use /lyrics to search by lyrics 📝\n"
+)
+
+UNKNOWN_MESSAGE_TEXT = (
+    "*How Can I Help You?* 🤔\n\n"
+    "Send me:\n"
+    "• Audio file 🎵\n"
+    "• Voice message 🎤\n"
+    "• Video file 🎥\n"
+    "• Use /lyrics + text 📝\n\n"
+    "_Choose an option below or send me a file!_ 👇"
+)
+
+CALLBACK_ERROR_TEXT = "An error occurred. Please try again."
+
+QUEUE_POSITION_TEXT = "⏳ The queue is busy, you're number {position} in line. I'll get to your request shortly!"
+
+QUEUE_FULL_TEXT = "😓 I'm overloaded right now. Please try again in a minute."
+
+RATE_LIMITED_TEXT = "⏳ You're sending requests a little too fast. Please try again in {seconds} seconds."
+
+QUOTA_EXHAUSTED_TEXT = "😴 I've used up today's lookups, so I can only answer songs I already know. Please try again tomorrow."
+
+FILE_TOO_LARGE_TEXT = "📁 That file is too big for me. Please send one under {megabytes} MB and {minutes} minutes."
+
+def _keyboard(buttons, row_width=2):
+    keyboard = InlineKeyboardMarkup(row_width=row_width)
+    keyboard.add(*buttons)
+    return keyboard
+
+class FrozenKeyboard(InlineKeyboardMarkup):
+    """An inline keyboard built once at import and shared by every reply.
+
+    telebot serializes reply_markup with to_json() on each send; a frozen
+    keyboard returns JSON computed when it was built.
+    """
+
+    def __init__(self, buttons, row_width=2):
+        super().__init__(row_width=row_width)
+        super().add(*buttons)
+        self._json = super().to_json()
+
+    def add(self, *args, row_width=None):
+        raise TypeError("FrozenKeyboard is shared and cannot be changed")
+
+    def to_json(self):
+        return self._json
+
+_NEW_SEARCH_BUTTON = InlineKeyboardButton("🔍 New Search", callback_data="new_search")
+_NEW_LYRICS_SEARCH_BUTTON = InlineKeyboardButton("🔍 New Lyrics Search", callback_data="lyrics_help")
+
+MENU_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("📊 Statistics", callback_data="stats"),
+    InlineKeyboardButton("📜 History", callback_data="history"),
+    InlineKeyboardButton("ℹ️ Help", callback_data="help"),
+    InlineKeyboardButton("👾 About", callback_data="about")
+])
+
+HELP_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("🔍 Try Lyrics Search", callback_data="lyrics_help"),
+    InlineKeyboardButton("📊 View Stats", callback_data="stats"),
+    InlineKeyboardButton("📜 View History", callback_data="history"),
+    InlineKeyboardButton("ℹ️ About Bot", callback_data="about")
+])
+
+ABOUT_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("🎵 Start Using", callback_data="new_search"),
+    InlineKeyboardButton("❓ Help", callback_data="help"),
+    InlineKeyboardButton("⭐️ View Stats", callback_data="stats"),
+    InlineKeyboardButton("📜 History", callback_data="history")
+])
+
+STATS_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("📜 View History", callback_data="history"),
+    _NEW_SEARCH_BUTTON
+])
+
+HISTORY_KEYBOARD = FrozenKeyboard([
+    _NEW_SEARCH_BUTTON,
+    InlineKeyboardButton("📊 View Stats", callback_data="stats")
+])
+
+TOP_KEYBOARD = FrozenKeyboard([
+    _NEW_SEARCH_BUTTON,
+    InlineKeyboardButton("📊 My Stats", callback_data="stats")
+])
+
+UNKNOWN_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("📖 View Commands", callback_data="help"),
+    InlineKeyboardButton("🔍 Search Lyrics", callback_data="lyrics_help"),
+    InlineKeyboardButton("📊 My Stats", callback_data="stats"),
+    InlineKeyboardButton("ℹ️ About", callback_data="about")
+])
+
+LYRICS_EXAMPLE_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("📝 Try an Example", callback_data="lyrics_example")
+])
+
+LYRICS_RETRY_KEYBOARD = FrozenKeyboard([
+    InlineKeyboardButton("🔄 Try Another Search", callback_data="lyrics_help")
+])
+
+def format_stats(stats):
+    """Format a user's statistics message."""
+    success_rate = (stats['successful_matches'] / stats['searches'] * 100) if stats['searches'] > 0 else 0
+    return (
+        "*📊 Your Music Detective Stats*\n\n"
+        "*Activity Overview:*\n"
+        f"• Total Searches: `{stats['searches']}`\n"
+        f"• Successful Matches: `{stats['successful_matches']}`\n"
+        f"• Success Rate: `{success_rate:.1f}%`\n"
+        f"• Member Since: `{stats['joined_date']}`\n\n"
+        "_Select an option below:_ 👇"
+    )
+
+_HISTORY_HEADER = (
+    "*🕒 Your Recent Music Discoveries*\n\n"
+    "_Last 10 searches:_\n\n"
+)
+_HISTORY_FOOTER = "\n_What would you like to do next?_ 👇"
+
+def format_history(history):
+    """Format the last 10 entries of a user's search history."""
+    lines = [_HISTORY_HEADER]
+    lines.extend(f"• `{item['title']}` - _{item['artist']}_\n" for item in history[-10:])
+    lines.append(_HISTORY_FOOTER)
+    return ''.join(lines)
+
+_TOP_HEADER = "*🏆 Top Music Discoveries*\n\n"
+_TOP_FOOTER = "\n_Select an option below:_ 👇"
+_TOP_WORKER_NOTE = "\n_Counts since the last restart cover only the chats served by worker {index} of {count}._\n"
+_SEARCH_KIND_LABELS = {
+    'audio': "Audio files",
+    'voice': "Voice messages",
+    'video': "Videos",
+    'lyrics': "Lyrics searches"
+}
+
+def format_top(tracks, artists, hit_rates, worker=None):
+    """Format the bot-wide top tracks and artists and the match rate by file type.
+
+    `worker` is (index, count) when the counts come from one webhook worker.
+    """
+    lines = [_TOP_HEADER]
+    if not tracks:
+        lines.append("_No songs found yet._\n")
+    else:
+        lines.append("*Top Songs:*\n")
+        lines.extend(
+            f"{rank}. `{_plain(track['title'])}` - _{_plain(track['artist'])}_ ({track['count']})\n"
+            for rank, track in enumerate(tracks, 1)
+        )
+    if artists:
+        lines.append("\n*Top Artists:*\n")
+        lines.extend(
+            f"{rank}. _{_plain(artist['artist'])}_ ({artist['count']})\n"
+            for rank, artist in enumerate(artists, 1)
+        )
+    if hit_rates:
+        lines.append("\n*Match Rate:*\n")
+        lines.extend(
+            f"• {_SEARCH_KIND_LABELS.get(kind, kind)}: `{rate['rate'] * 100:.1f}%` of {rate['searches']}\n"
+            for kind, rate in hit_rates.items()
+        )
+    if worker:
+        lines.append(_TOP_WORKER_NOTE.format(index=worker[0] + 1, count=worker[1]))
+    lines.append(_TOP_FOOTER)
+    return ''.join(lines)
+
+def format_song(song):
+    """Format a recognized song as reply text and streaming links keyboard."""
+    # Create inline keyboard for streaming links
+    buttons = []
+    if 'spotify' in song:
+        buttons.append(InlineKeyboardButton(
+            "🎧 Listen on Spotify",
+            url=song['spotify']['external_urls']['spotify']
+        ))
+    if 'apple_music' in song:
+        buttons.append(InlineKeyboardButton(
+            "🎵 Listen on Apple Music",
+            url=song['apple_music']['url']
+        ))
+    buttons.append(_NEW_SEARCH_BUTTON)
+
+    # Format response with emojis and markdown
+    response_text = (
+        f"*✨ Found Your Song!*\n\n"
+        f"*🎵 Title:* `{song['title']}`\n"
+        f"*👤 Artist:* `{song['artist']}`\n"
+        f"*💿 Album:* `{song.get('album', 'N/A')}`\n"
+        f"*📅 Released:* `{song.get('release_date', 'N/A')}`\n\n"
+        f"_Click the buttons below to listen:_ 👇"
+    )
+    return response_text, _keyboard(buttons)
+
+def _plain(text):
+    """Strip characters that Telegram's Markdown would treat as formatting."""
+    return re.sub(r'[_*`\[\]]', '', text)
+
+def _format_preview(preview):
+    lines = []
+    for index, line in enumerate(preview['lines']):
+        if index == preview['match']:
+            lines.append(f"   ➤ *{_plain(line)}*")
+        else:
+            lines.append(f"   _{_plain(line)}_")
+    return '\n'.join(lines)
+
+def format_lyrics_results(query, results, previews=None):
+    """Format lyrics search results as reply text and song links keyboard.
+
+    With `previews` (one per result, None where unavailable) the text lists
+    each song with its best-matching lyric line highlighted.
+    """
+    # Create inline keyboard for results
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for song in results:
+        keyboard.add(InlineKeyboardButton(
+            f"🎵 {song['title']} - {song['artist']}",
+            url=song['url']
+        ))
+    keyboard.add(_NEW_LYRICS_SEARCH_BUTTON)
+
+    # Format results with markdown
+    matches = ''
+    if previews and any(previews):
+        entries = []
+        for number, (song, preview) in enumerate(zip(results, previews), 1):
+            entry = f"*{number}. {_plain(song['title'])}* - {_plain(song['artist'])}"
+            if preview:
+                entry += '\n' + _format_preview(preview)
+            entries.append(entry)
+        matches = '\n\n'.join(entries) + '\n\n'
+    response = (
+        f"*✨ Found {len(results)} Matching Songs!*\n\n"
+        f"*Your Lyrics:* `{_plain(query)}`\n\n"
+        f"{matches}"
+        "_Click on a song to see full lyrics:_ 👇"
+    )
+    return response, keyboard
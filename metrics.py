@@ -0,0 +1,225 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import event_log
+
+# In-process metrics in the Prometheus text format. Recording is a lock and a
+# few arithmetic operations; all formatting happens when /metrics is scraped.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_TRACE = os.getenv('METRICS_TRACE', '0') == '1'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.samples():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._function = None
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function):
+        """Read the value at scrape time: a number, or a {label tuple: value} dict."""
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        values = self._function()
+        return list(values.items()) if isinstance(values, dict) else [((), values)]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames + ('le',), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+STAGE_SECONDS = Histogram(
+    'tunedetective_stage_seconds', "Time spent in each handler stage", ('stage',)
+)
+UPSTREAM_REQUESTS = Counter(
+    'tunedetective_upstream_requests_total', "Upstream HTTP attempts by outcome", ('upstream', 'status')
+)
+UPSTREAM_SECONDS = Histogram(
+    'tunedetective_upstream_seconds', "Upstream HTTP attempt latency", ('upstream',)
+)
+CACHE_REQUESTS = Counter(
+    'tunedetective_cache_requests_total', "Cache lookups by result", ('cache', 'result')
+)
+IN_FLIGHT = Gauge(
+    'tunedetective_in_flight', "Requests currently being handled", ('handler',)
+)
+LANE_WAIT_SECONDS = Histogram(
+    'tunedetective_lane_wait_seconds', "Time updates wait in a scheduler lane", ('lane',)
+)
+LANE_DEPTH = Gauge(
+    'tunedetective_lane_depth', "Updates queued in a scheduler lane", ('lane',)
+)
+OUTBOUND_REQUESTS = Counter(
+    'tunedetective_outbound_requests_total', "Paced Bot API calls by outcome", ('method', 'result')
+)
+OUTBOUND_WAIT_SECONDS = Histogram(
+    'tunedetective_outbound_wait_seconds', "Time Bot API calls wait for their chat's turn", ('method',)
+)
+
+class span:
+    """Time a block as one stage; with METRICS_TRACE=1 each span is also logged with the update's correlation id."""
+
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(elapsed, self.stage)
+        if METRICS_TRACE:
+            event_log.event(
+                'span', logging.INFO, stage=self.stage, seconds=round(elapsed, 6),
+                error=exc_type.__name__ if exc_type else None
+            )
+
+class in_flight:
+    """Count a handler as in flight for the duration of the block."""
+
+    __slots__ = ('handler',)
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        IN_FLIGHT.inc(self.handler)
+        return self
+
+    def __exit__(self, *exc_info):
+        IN_FLIGHT.dec(self.handler)
+
+def instrument(name):
+    """Decorator timing a (sync or async) handler as one stage and counting it in flight."""
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with in_flight(name), span(name):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with in_flight(name), span(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics from a daemon thread; a port of 0 leaves the endpoint off."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
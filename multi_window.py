@@ -0,0 +1,189 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import subprocess
+from array import array
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import event_log
+import audio_preprocess
+
+# Long clips often open with an intro or speech. Instead of one excerpt from a
+# fixed offset, several windows around the loudest passages are recognized in
+# parallel and the first match wins.
+MULTI_WINDOW_MIN_DURATION = float(os.getenv('MULTI_WINDOW_MIN_DURATION', '45'))
+MULTI_WINDOW_COUNT = int(os.getenv('MULTI_WINDOW_COUNT', '3'))
+MULTI_WINDOW_FAN_OUT = int(os.getenv('MULTI_WINDOW_FAN_OUT', '2'))
+
+# Loudness is measured on a heavily downsampled decode; peaks are all we need
+PROFILE_SAMPLE_RATE = 2000
+
+def should_split(duration):
+    """Return True when a file is long enough to be worth several windows."""
+    return (
+        audio_preprocess.is_available()
+        and MULTI_WINDOW_COUNT > 1
+        and bool(duration)
+        and duration >= MULTI_WINDOW_MIN_DURATION
+    )
+
+def is_confident(result):
+    """Return True for an AuDD result that identified a song."""
+    return result.get('status') == 'success' and bool(result.get('result'))
+
+def loudness_profile(path):
+    """Return the mean energy of each second of the file's first audio stream."""
+    cmd = [
+        audio_preprocess.FFMPEG, '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-i', path, '-map', '0:a:0', '-vn', '-sn', '-dn',
+        '-ac', '1', '-ar', str(PROFILE_SAMPLE_RATE), '-f', 's16le', 'pipe:1'
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    profile = []
+    frame_bytes = PROFILE_SAMPLE_RATE * 2
+    try:
+        while True:
+            frame = proc.stdout.read(frame_bytes)
+            if len(frame) < 2:
+                break
+            samples = array('h', frame[:len(frame) - len(frame) % 2])
+            profile.append(sum(s * s for s in samples) / len(samples))
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    return profile
+
+def pick_windows(profile, window=audio_preprocess.CLIP_SECONDS, count=MULTI_WINDOW_COUNT):
+    """Choose up to `count` non-overlapping window starts, loudest first."""
+    size = max(1, int(window))
+    if len(profile) <= size:
+        return [0]
+
+    # Energy of every window position via a running sum
+    energy = [sum(profile[:size])]
+    for start in range(1, len(profile) - size + 1):
+        energy.append(energy[-1] - profile[start - 1] + profile[start + size - 1])
+
+    starts = []
+    for start in sorted(range(len(energy)), key=energy.__getitem__, reverse=True):
+        if all(abs(start - chosen) >= size for chosen in starts):
+            starts.append(start)
+            if len(starts) == count:
+                break
+    return starts
+
+def pick_file_windows(path):
+    """Return the window starts for a local file, loudest first."""
+    return pick_windows(loudness_profile(path))
+
+class WindowStats:
+    """Running per-rank latency and hit counts, to tune window count against cost."""
+
+    def __init__(self):
+        self._ranks = {}
+        self._lock = threading.Lock()
+
+    def record(self, rank, start, latency, hit):
+        with self._lock:
+            stats = self._ranks.setdefault(rank, {'calls': 0, 'hits': 0, 'latency': 0.0})
+            stats['calls'] += 1
+            stats['hits'] += int(hit)
+            stats['latency'] += latency
+            hit_rate = stats['hits'] / stats['calls'] * 100
+        event_log.event(
+            'multi_window', logging.INFO, rank=rank, start=start,
+            seconds=round(latency, 3), hit=hit, rank_hit_rate=round(hit_rate, 1)
+        )
+
+    def summary(self):
+        with self._lock:
+            return {
+                rank: {
+                    'calls': stats['calls'],
+                    'hit_rate': stats['hits'] / stats['calls'],
+                    'avg_latency': stats['latency'] / stats['calls']
+                }
+                for rank, stats in sorted(self._ranks.items())
+            }
+
+window_stats = WindowStats()
+
+def _combine(results, errors):
+    """Pick the overall result when no window matched."""
+    for result in results:
+        if result.get('status') == 'success':
+            return {'status': 'success', 'result': None}
+    if results:
+        return results[-1]
+    raise errors[0]
+
+def recognize_file(path, recognize, fan_out=MULTI_WINDOW_FAN_OUT, starts=None):
+    """Recognize the loudest windows of a local file concurrently.
+
+    Returns (result, start, clip): the first confident result with the offset
+    and clip of the window that produced it, or the combined result with None
+    for both when no window matched.
+    """
+    if starts is None:
+        starts = pick_file_windows(path)
+
+    def attempt(rank, start):
+        began = time.perf_counter()
+        clip = audio_preprocess.transcode_file(path, start)
+        result = recognize(clip)
+        window_stats.record(rank, start, time.perf_counter() - began, is_confident(result))
+        return result, start, clip
+
+    results, errors = [], []
+    executor = ThreadPoolExecutor(max_workers=max(1, fan_out))
+    try:
+        pending = {executor.submit(attempt, rank, start) for rank, start in enumerate(starts)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result, start, clip = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if is_confident(result):
+                    return result, start, clip
+                results.append(result)
+    finally:
+        # Windows that have not started yet are dropped; running ones finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+    return _combine(results, errors), None, None
+
+async def recognize_file_async(path, recognize, fan_out=MULTI_WINDOW_FAN_OUT, starts=None):
+    """Asyncio variant of recognize_file; `recognize` is a coroutine function."""
+    if starts is None:
+        starts = await asyncio.to_thread(pick_file_windows, path)
+    limit = asyncio.Semaphore(max(1, fan_out))
+
+    async def attempt(rank, start):
+        async with limit:
+            began = time.perf_counter()
+            clip = await asyncio.to_thread(audio_preprocess.transcode_file, path, start)
+            result = await recognize(clip)
+            window_stats.record(rank, start, time.perf_counter() - began, is_confident(result))
+            return result, start, clip
+
+    results, errors = [], []
+    pending = {asyncio.create_task(attempt(rank, start)) for rank, start in enumerate(starts)}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    result, start, clip = task.result()
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if is_confident(result):
+                    return result, start, clip
+                results.append(result)
+    finally:
+        for task in pending:
+            task.cancel()
+    return _combine(results, errors), None, None
@@ -0,0 +1,332 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+import contextlib
+from collections import deque
+import event_log
+import metrics
+
+# Outbound Bot API calls are queued per chat and paced to Telegram's flood
+# limits: about one message a second in a private chat, 20 a minute in a
+# group and 30 a second overall. A queued edit of a message is replaced by a
+# newer edit of the same message, 429 answers are retried after their
+# retry_after, and callback answers are sent before anything else.
+OUTBOUND_DISPATCH = os.getenv('OUTBOUND_DISPATCH', '1') != '0'
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv('OUTBOUND_GROUP_PER_MINUTE', '20'))
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+CALLBACK_ANSWER = 'answerCallbackQuery'
+EDIT_METHODS = {'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup'}
+CHAT_METHOD_PREFIXES = ('send', 'edit', 'delete', 'forward', 'copy')
+
+# Callback answers jump the queue; everything else keeps its order
+PRIORITY_CALLBACK = 0
+PRIORITY_MESSAGE = 1
+
+class OutboundCall:
+    """One queued Bot API call; `send` performs it and may be replaced by a newer edit."""
+
+    __slots__ = ('method', 'chat', 'priority', 'key', 'send', 'attempts', 'queued_at', 'done', 'result', 'error')
+
+    def __init__(self, method, chat, priority, key, send):
+        self.method = method
+        self.chat = chat
+        self.priority = priority
+        self.key = key
+        self.send = send
+        self.attempts = 0
+        self.queued_at = time.perf_counter()
+        self.done = None
+        self.result = None
+        self.error = None
+
+def make_call(method, params, send):
+    """Return an OutboundCall for a Bot API method, or None when it is not paced."""
+    if method == CALLBACK_ANSWER:
+        return OutboundCall(method, ('callback', params.get('callback_query_id')), PRIORITY_CALLBACK, None, send)
+    chat_id = params.get('chat_id')
+    if chat_id is None or not method.startswith(CHAT_METHOD_PREFIXES):
+        return None
+    key = (method, chat_id, params.get('message_id')) if method in EDIT_METHODS else None
+    return OutboundCall(method, chat_id, PRIORITY_MESSAGE, key, send)
+
+class OutboundQueue:
+    """Per-chat FIFO queues released at the rate Telegram allows; callers do the locking.
+
+    Pacing uses the generic cell rate algorithm: each chat, and the bot as a
+    whole, has a theoretical arrival time that advances by one interval per
+    call and may run up to `burst - 1` intervals ahead of the clock.
+    """
+
+    def __init__(self, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 group_per_minute=OUTBOUND_GROUP_PER_MINUTE, global_rate=OUTBOUND_GLOBAL_RATE, max_chats=10000):
+        self.chat_interval = 1 / chat_rate
+        self.chat_burst = chat_burst
+        self.group_interval = 60 / group_per_minute
+        self.global_rate = global_rate
+        self.max_chats = max_chats
+        self._chats = {}
+        self._busy = set()
+        self._tat = {}
+        self._global_tat = 0.0
+        self._waiting = []
+        self._ready = []
+        self._edits = {}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return sum(len(calls) for calls in self._chats.values())
+
+    def _interval(self, chat):
+        if isinstance(chat, tuple):
+            return 0.0
+        # Groups and channels have negative ids or @usernames
+        return self.group_interval if str(chat)[:1] in '-@' else self.chat_interval
+
+    def _ready_at(self, chat):
+        tat = self._tat.get(chat)
+        if tat is None:
+            return 0.0
+        return tat - (self.chat_burst - 1) * self._interval(chat)
+
+    def _schedule(self, chat, now):
+        ready_at = self._ready_at(chat)
+        if ready_at <= now:
+            heapq.heappush(self._ready, (self._chats[chat][0].priority, next(self._seq), chat))
+        else:
+            heapq.heappush(self._waiting, (ready_at, next(self._seq), chat))
+
+    def push(self, call, now):
+        """Queue a call and return the call its caller should wait for.
+
+        An edit of a message with an edit already queued replaces that edit's
+        content; both callers then wait for the same, newest, request.
+        """
+        if call.key is not None:
+            queued = self._edits.get(call.key)
+            if queued is not None:
+                queued.send = call.send
+                return queued
+            self._edits[call.key] = call
+        calls = self._chats.get(call.chat)
+        if calls is None:
+            calls = self._chats[call.chat] = deque()
+        calls.append(call)
+        if len(calls) == 1 and call.chat not in self._busy:
+            self._schedule(call.chat, now)
+        return call
+
+    def pop(self, now):
+        """Return (call, 0) for the next call allowed to go out, or (None, seconds to wait or None)."""
+        while self._waiting and self._waiting[0][0] <= now:
+            _, _, chat = heapq.heappop(self._waiting)
+            heapq.heappush(self._ready, (self._chats[chat][0].priority, next(self._seq), chat))
+        next_waiting = self._waiting[0][0] - now if self._waiting else None
+        if not self._ready:
+            return None, next_waiting
+        global_interval = 1 / self.global_rate
+        global_ready = self._global_tat - (self.global_rate - 1) * global_interval
+        if global_ready > now:
+            wait = global_ready - now
+            return None, wait if next_waiting is None else min(wait, next_waiting)
+
+        _, _, chat = heapq.heappop(self._ready)
+        calls = self._chats[chat]
+        call = calls.popleft()
+        if not calls:
+            del self._chats[chat]
+        if call.key is not None and self._edits.get(call.key) is call:
+            # Edits arriving from now on are sent after this one
+            del self._edits[call.key]
+        self._busy.add(chat)
+        interval = self._interval(chat)
+        if interval:
+            self._tat[chat] = max(self._tat.get(chat, now), now) + interval
+        self._global_tat = max(self._global_tat, now) + global_interval
+        return call, 0
+
+    def done(self, call, now, retry_after=None):
+        """Release the call's chat; with `retry_after` the call goes back to the front of it."""
+        chat = call.chat
+        self._busy.discard(chat)
+        if retry_after is not None:
+            call.attempts += 1
+            self._tat[chat] = now + retry_after + (self.chat_burst - 1) * self._interval(chat)
+            self._chats.setdefault(chat, deque()).appendleft(call)
+        elif isinstance(chat, tuple):
+            self._tat.pop(chat, None)
+        if chat in self._chats:
+            self._schedule(chat, now)
+        if len(self._tat) > self.max_chats:
+            # A chat whose arrival time has passed is indistinguishable from a new one
+            for stale in [chat for chat, tat in self._tat.items() if tat <= now and chat not in self._busy]:
+                del self._tat[stale]
+
+def flood_wait(response):
+    """Return the retry_after of a 429 requests response, or None for any other response."""
+    if response.status_code != 429:
+        return None
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return float(response.headers.get('Retry-After') or 1)
+
+class OutboundDispatcher:
+    """Send paced Bot API calls from worker threads; usable as apihelper.CUSTOM_REQUEST_SENDER."""
+
+    def __init__(self, send, workers=OUTBOUND_WORKERS, max_retries=OUTBOUND_MAX_RETRIES, **limits):
+        self._send = send
+        self.max_retries = max_retries
+        self.queue = OutboundQueue(**limits)
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        for index in range(workers):
+            threading.Thread(target=self._run, name=f"outbound-{index}", daemon=True).start()
+
+    @classmethod
+    def from_env(cls, send):
+        """Build a dispatcher around `send`, or return None when OUTBOUND_DISPATCH=0."""
+        return cls(send) if OUTBOUND_DISPATCH else None
+
+    @contextlib.contextmanager
+    def when_queued(self, callback):
+        """Call `callback` once a paced call made by this thread in the block is queued.
+
+        The call itself still waits to be sent. A caller can use this to know
+        that a newer edit of the same message will take the queued one over.
+        """
+        self._local.when_queued = callback
+        try:
+            yield
+        finally:
+            self._local.when_queued = None
+
+    def request(self, method, url, **kwargs):
+        """Queue a chat message or callback answer and wait for its response; send anything else directly."""
+        api_method = url.rsplit('/', 1)[-1]
+        call = make_call(api_method, kwargs.get('params') or {}, lambda: self._send(method, url, **kwargs))
+        if call is None:
+            return self._send(method, url, **kwargs)
+        call.done = threading.Event()
+        with self._cond:
+            queued = self.queue.push(call, time.monotonic())
+            self._cond.notify()
+        if queued is not call:
+            metrics.OUTBOUND_REQUESTS.inc(api_method, 'coalesced')
+        callback = getattr(self._local, 'when_queued', None)
+        if callback is not None:
+            self._local.when_queued = None
+            callback()
+        queued.done.wait()
+        if queued.error is not None:
+            raise queued.error
+        return queued.result
+
+    def _run(self):
+        while True:
+            with self._cond:
+                call, wait = self.queue.pop(time.monotonic())
+                while call is None:
+                    self._cond.wait(wait)
+                    call, wait = self.queue.pop(time.monotonic())
+            if not call.attempts:
+                metrics.OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - call.queued_at, call.method)
+
+            retry_after = None
+            try:
+                result = call.send()
+            except Exception as e:
+                call.error = e
+                metrics.OUTBOUND_REQUESTS.inc(call.method, 'error')
+            else:
+                retry_after = flood_wait(result)
+                if retry_after is not None and call.attempts < self.max_retries:
+                    event_log.event('flood_wait', logging.WARNING, method=call.method, retry_after=retry_after)
+                    metrics.OUTBOUND_REQUESTS.inc(call.method, 'retried')
+                    result.close()
+                else:
+                    retry_after = None
+                    call.result = result
+                    metrics.OUTBOUND_REQUESTS.inc(call.method, 'sent')
+
+            with self._cond:
+                self.queue.done(call, time.monotonic(), retry_after)
+                self._cond.notify_all()
+            if retry_after is None:
+                call.done.set()
+
+class AsyncOutboundDispatcher:
+    """Asyncio variant of OutboundDispatcher, wrapping telebot's asyncio request function."""
+
+    def __init__(self, max_retries=OUTBOUND_MAX_RETRIES, **limits):
+        self.max_retries = max_retries
+        self.queue = OutboundQueue(**limits)
+        self._wakeup = None
+        self._runner = None
+
+    @classmethod
+    def from_env(cls):
+        """Build a dispatcher, or return None when OUTBOUND_DISPATCH=0."""
+        return cls() if OUTBOUND_DISPATCH else None
+
+    async def call(self, method, params, send):
+        """Queue a chat message or callback answer (`send` returns a coroutine) and return its result."""
+        call = make_call(method, params or {}, send)
+        if call is None:
+            return await send()
+        call.done = asyncio.get_running_loop().create_future()
+        queued = self.queue.push(call, time.monotonic())
+        if queued is not call:
+            metrics.OUTBOUND_REQUESTS.inc(method, 'coalesced')
+        self._wake()
+        return await asyncio.shield(queued.done)
+
+    def _wake(self):
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            call, wait = self.queue.pop(time.monotonic())
+            if call is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if not call.attempts:
+                metrics.OUTBOUND_WAIT_SECONDS.observe(time.perf_counter() - call.queued_at, call.method)
+            asyncio.ensure_future(self._send(call))
+
+    async def _send(self, call):
+        retry_after = None
+        try:
+            result = await call.send()
+        except Exception as e:
+            # telebot raises ApiTelegramException, with the 429's retry_after in result_json
+            parameters = (getattr(e, 'result_json', None) or {}).get('parameters') or {}
+            if getattr(e, 'error_code', None) == 429 and call.attempts < self.max_retries:
+                retry_after = float(parameters.get('retry_after', 1))
+                event_log.event('flood_wait', logging.WARNING, method=call.method, retry_after=retry_after)
+                metrics.OUTBOUND_REQUESTS.inc(call.method, 'retried')
+            else:
+                metrics.OUTBOUND_REQUESTS.inc(call.method, 'error')
+                if not call.done.done():
+                    call.done.set_exception(e)
+        else:
+            metrics.OUTBOUND_REQUESTS.inc(call.method, 'sent')
+            if not call.done.done():
+                call.done.set_result(result)
+        self.queue.done(call, time.monotonic(), retry_after)
+        self._wake()
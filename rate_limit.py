@@ -0,0 +1,203 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# Token buckets per user, per chat and globally for each paid upstream, plus
+# daily quota accounting against the API plan. Everything is O(1) per check.
+SCOPES = ('user', 'chat', 'global')
+
+DEFAULT_LIMITS = {
+    # (tokens per minute, burst) for each scope
+    'audd': {'user': (5, 3), 'chat': (10, 5), 'global': (120, 30)},
+    'genius': {'user': (10, 5), 'chat': (20, 10), 'global': (300, 60)},
+}
+
+class RateLimited(Exception):
+    """Raised when a caller is over one of its token buckets."""
+
+    def __init__(self, upstream, scope, retry_after):
+        super().__init__(f"{upstream} {scope} rate limit, retry in {retry_after:.0f}s")
+        self.upstream = upstream
+        self.scope = scope
+        self.retry_after = retry_after
+
+class QuotaExhausted(Exception):
+    """Raised instead of calling an upstream whose daily quota is (nearly) used up."""
+
+    def __init__(self, upstream, used, limit):
+        super().__init__(f"{upstream} daily quota at {used}/{limit}")
+        self.upstream = upstream
+        self.used = used
+        self.limit = limit
+
+class MemoryRateBackend:
+    """Buckets and counters for a single process, bounded by LRU eviction of idle keys."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def take(self, keys, now):
+        """Take one token from every (key, rate, capacity) bucket, or from none of them.
+
+        Returns (0.0, None) on success, otherwise the longest wait and the key of
+        the bucket that imposes it.
+        """
+        with self._lock:
+            states = []
+            retry_after, blocked = 0.0, None
+            for key, rate, capacity in keys:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                states.append((key, tokens))
+                if tokens < 1 and (1 - tokens) / rate > retry_after:
+                    retry_after, blocked = (1 - tokens) / rate, key
+            if blocked:
+                return retry_after, blocked
+
+            # A bucket evicted while idle would have refilled anyway
+            for key, tokens in states:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return 0.0, None
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = self._counters.get(key, 0) + amount
+            self._counters[key] = value
+            return value
+
+    def get(self, key):
+        return self._counters.get(key, 0)
+
+class SQLiteRateBackend:
+    """Buckets and counters shared by every process using the same database file."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL);"
+            "CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER);"
+        )
+
+    def take(self, keys, now):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                states = []
+                retry_after, blocked = 0.0, None
+                for key, rate, capacity in keys:
+                    row = self._conn.execute(
+                        "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+                    ).fetchone()
+                    tokens, updated = row if row else (capacity, now)
+                    tokens = min(capacity, tokens + (now - updated) * rate)
+                    states.append((key, tokens))
+                    if tokens < 1 and (1 - tokens) / rate > retry_after:
+                        retry_after, blocked = (1 - tokens) / rate, key
+                if not blocked:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                        [(key, tokens - 1, now) for key, tokens in states]
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return retry_after, blocked
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            return self._conn.execute(
+                "INSERT INTO counters VALUES (?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = value + excluded.value "
+                "RETURNING value",
+                (key, amount)
+            ).fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+class RateLimiter:
+    """Per-user, per-chat and global token buckets plus daily quotas for each upstream."""
+
+    def __init__(self, backend, limits=None, daily_quotas=None, degrade_at=0.9):
+        self.backend = backend
+        self.limits = limits or DEFAULT_LIMITS
+        self.daily_quotas = daily_quotas or {}
+        self.degrade_at = degrade_at
+
+    @classmethod
+    def from_env(cls):
+        """Build the limiter from RATE_LIMIT_* and <UPSTREAM>_* environment variables."""
+        if os.getenv('RATE_LIMIT_BACKEND', 'memory') == 'sqlite':
+            backend = SQLiteRateBackend(os.getenv('RATE_LIMIT_PATH', 'rate_limits.db'))
+        else:
+            backend = MemoryRateBackend()
+
+        limits = {}
+        for upstream, scopes in DEFAULT_LIMITS.items():
+            limits[upstream] = {}
+            for scope, (per_minute, burst) in scopes.items():
+                prefix = f"{upstream.upper()}_{scope.upper()}"
+                limits[upstream][scope] = (
+                    float(os.getenv(f"{prefix}_PER_MINUTE", per_minute)),
+                    float(os.getenv(f"{prefix}_BURST", burst))
+                )
+
+        daily_quotas = {
+            upstream: int(os.getenv(f"{upstream.upper()}_DAILY_QUOTA", '0'))
+            for upstream in DEFAULT_LIMITS
+        }
+        return cls(
+            backend,
+            limits,
+            {upstream: quota for upstream, quota in daily_quotas.items() if quota > 0},
+            float(os.getenv('QUOTA_DEGRADE_AT', '0.9'))
+        )
+
+    def check(self, upstream, user_id, chat_id, scopes=SCOPES):
+        """Take a token from each of the `scopes` buckets (user, chat and global), or raise RateLimited."""
+        limits = self.limits[upstream]
+        ids = {'user': user_id, 'chat': chat_id, 'global': ''}
+        keys = [
+            (f"{upstream}:{scope}:{ids[scope]}", limits[scope][0] / 60, limits[scope][1])
+            for scope in scopes
+        ]
+        retry_after, blocked = self.backend.take(keys, time.time())
+        if blocked:
+            raise RateLimited(upstream, blocked.split(':')[1], retry_after)
+
+    def _quota_key(self, upstream):
+        return f"quota:{upstream}:{datetime.now(timezone.utc).strftime('%Y-%m-%d')}"
+
+    def record_call(self, upstream, count=1):
+        """Count paid upstream calls against today's (UTC) quota."""
+        return self.backend.incr(self._quota_key(upstream), count)
+
+    def quota_used(self, upstream):
+        return self.backend.get(self._quota_key(upstream))
+
+    def check_quota(self, upstream):
+        """Raise QuotaExhausted once today's usage reaches the degrade threshold.
+
+        Past that point requests are served only from caches and local indexes,
+        keeping the remainder of the plan as headroom.
+        """
+        limit = self.daily_quotas.get(upstream)
+        if not limit:
+            return
+        used = self.quota_used(upstream)
+        if used >= limit * self.degrade_at:
+            raise QuotaExhausted(upstream, used, limit)
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import metrics
+
+# Returned by RecognitionCache.get when a key is absent or expired. A cached
+# None is a negative result: AuDD looked at the file and found no match.
+MISS = object()
+
+def file_key(file_unique_id):
+    """Cache key for a Telegram file, stable across forwards of the same file."""
+    return f"file:{file_unique_id}"
+
+def content_key(content):
+    """Cache key for downloaded file bytes."""
+    return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+def file_content_key(fileobj, chunk_size=1024 * 1024):
+    """Cache key for the contents of an open file, read in chunks from the start."""
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+class MemoryBackend:
+    """In-process LRU store of (expires_at, value) pairs."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteBackend:
+    """On-disk LRU store that survives restarts and can be shared between processes."""
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS recognition_cache ("
+            "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS recognition_cache_accessed "
+            "ON recognition_cache (accessed_at)"
+        )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM recognition_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM recognition_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE recognition_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO recognition_cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, time.time())
+            )
+            overflow = len(self) - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM recognition_cache WHERE key IN ("
+                    "SELECT key FROM recognition_cache ORDER BY accessed_at LIMIT ?)",
+                    (overflow,)
+                )
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM recognition_cache").fetchone()[0]
+
+class RecognitionCache:
+    """TTL cache of AuDD results with separate lifetimes for matches and misses."""
+
+    def __init__(self, backend, ttl=7 * 24 * 3600, negative_ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    @classmethod
+    def from_env(cls):
+        """Build the cache from RECOGNITION_CACHE_* environment variables."""
+        max_entries = int(os.getenv('RECOGNITION_CACHE_SIZE', '10000'))
+        if os.getenv('RECOGNITION_CACHE_BACKEND', 'memory') == 'sqlite':
+            path = os.getenv('RECOGNITION_CACHE_PATH', 'recognition_cache.db')
+            backend = SQLiteBackend(path, max_entries)
+        else:
+            backend = MemoryBackend(max_entries)
+        return cls(
+            backend,
+            ttl=float(os.getenv('RECOGNITION_CACHE_TTL', 7 * 24 * 3600)),
+            negative_ttl=float(os.getenv('RECOGNITION_CACHE_NEGATIVE_TTL', 3600))
+        )
+
+    def get(self, *keys):
+        """Return the song cached under the first live key, None for a cached miss, or MISS."""
+        for key in keys:
+            entry = self.backend.get(key)
+            if entry is not None:
+                metrics.CACHE_REQUESTS.inc('recognition', 'hit' if entry['song'] else 'negative')
+                return entry['song']
+        metrics.CACHE_REQUESTS.inc('recognition', 'miss')
+        return MISS
+
+    def set(self, keys, song):
+        """Cache a song (or None when AuDD found no match) under every given key."""
+        ttl = self.ttl if song is not None else self.negative_ttl
+        expires_at = time.time() + ttl
+        for key in keys:
+            self.backend.set(key, {'song': song}, expires_at)
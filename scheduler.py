@@ -0,0 +1,189 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+import telebot
+import event_log
+import metrics
+
+# Update scheduling: quick commands and button presses run on a fast lane that
+# slow recognition work can never occupy. Audio, video and lyrics searches go
+# to a heavy lane with its own workers, depth limit and position notices.
+FAST = 'fast'
+HEAVY = 'heavy'
+
+HEAVY_CONTENT_TYPES = ('audio', 'voice', 'video', 'document')
+
+class LaneFull(Exception):
+    """Raised when a lane already holds its maximum number of queued updates."""
+
+class Lane:
+    """Worker threads draining one queue, keeping each chat's updates in order."""
+
+    def __init__(self, name, workers, max_depth, wait_samples=1000):
+        self.name = name
+        self.workers = workers
+        self.max_depth = max_depth
+        self.depth = 0
+        self.active = 0
+        self.processed = 0
+        self._waits = deque(maxlen=wait_samples)
+        self._queue = queue.Queue()
+        self._parked = {}
+        self._lock = threading.Lock()
+        for index in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-lane-{index}", daemon=True).start()
+
+    def submit(self, chat_id, task):
+        """Queue a task and return its 1-based position in the lane; raises LaneFull."""
+        with self._lock:
+            if self.depth >= self.max_depth:
+                raise LaneFull(self.name)
+            self.depth += 1
+            position = self.depth
+            item = (chat_id, task, time.perf_counter())
+            # A chat with a task in flight waits for it instead of running alongside it
+            if chat_id in self._parked:
+                self._parked[chat_id].append(item)
+            else:
+                self._parked[chat_id] = deque()
+                self._queue.put(item)
+        return position
+
+    @property
+    def saturated(self):
+        """True while every worker is busy, so newly queued tasks have to wait."""
+        return self.active >= self.workers
+
+    def stats(self):
+        """Return the current depth and queue wait times in seconds over recent updates."""
+        with self._lock:
+            waits = sorted(self._waits)
+            depth, active, processed = self.depth, self.active, self.processed
+        if not waits:
+            return {'depth': depth, 'active': active, 'processed': processed,
+                    'wait_avg': 0.0, 'wait_p95': 0.0, 'wait_max': 0.0}
+        return {
+            'depth': depth,
+            'active': active,
+            'processed': processed,
+            'wait_avg': sum(waits) / len(waits),
+            'wait_p95': waits[min(len(waits) - 1, int(len(waits) * 0.95))],
+            'wait_max': waits[-1]
+        }
+
+    def _run(self):
+        while True:
+            chat_id, task, queued_at = self._queue.get()
+            waited = time.perf_counter() - queued_at
+            metrics.LANE_WAIT_SECONDS.observe(waited, self.name)
+            with self._lock:
+                self.depth -= 1
+                self.active += 1
+                self._waits.append(waited)
+            try:
+                task()
+            except Exception as e:
+                event_log.event('lane_error', logging.ERROR, lane=self.name, error=str(e))
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.processed += 1
+                    parked = self._parked[chat_id]
+                    if parked:
+                        self._queue.put(parked.popleft())
+                    else:
+                        del self._parked[chat_id]
+
+def update_chat_id(update):
+    """Return the chat an update belongs to, falling back to the sender."""
+    message = update.message or update.edited_message or update.channel_post
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+def classify(update):
+    """Return the lane for an update: media and lyrics searches are heavy, the rest fast."""
+    message = update.message
+    if message is None:
+        return FAST
+    if message.content_type in HEAVY_CONTENT_TYPES:
+        return HEAVY
+    if message.content_type == 'text' and message.text.startswith('/lyrics'):
+        return HEAVY
+    return FAST
+
+class UpdateScheduler:
+    """Route updates to the fast or heavy lane and report back-pressure to users."""
+
+    def __init__(self, fast_workers=4, heavy_workers=8, fast_depth=500, heavy_depth=200,
+                 on_queued=None, on_rejected=None):
+        self.lanes = {
+            FAST: Lane(FAST, fast_workers, fast_depth),
+            HEAVY: Lane(HEAVY, heavy_workers, heavy_depth)
+        }
+        self.on_queued = on_queued
+        self.on_rejected = on_rejected
+        metrics.LANE_DEPTH.set_function(
+            lambda: {(name,): lane.depth for name, lane in self.lanes.items()}
+        )
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        return cls(
+            fast_workers=int(os.getenv('FAST_LANE_WORKERS', '4')),
+            heavy_workers=int(os.getenv('HEAVY_LANE_WORKERS', '8')),
+            fast_depth=int(os.getenv('FAST_LANE_DEPTH', '500')),
+            heavy_depth=int(os.getenv('HEAVY_LANE_DEPTH', '200')),
+            **kwargs
+        )
+
+    def submit(self, update, task):
+        lane_name = classify(update)
+        lane = self.lanes[lane_name]
+        chat_id = update_chat_id(update)
+        try:
+            position = lane.submit(chat_id, task)
+        except LaneFull:
+            event_log.event('update_rejected', logging.WARNING, lane=lane_name, update_id=update.update_id)
+            self._notify(self.on_rejected, chat_id, update)
+            return
+
+        # Anyone who will wait for a free heavy worker is told where they are in line
+        if lane_name == HEAVY and lane.saturated:
+            self._notify(self.on_queued, chat_id, update, position)
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    def _notify(self, callback, chat_id, update, *args):
+        if callback is None:
+            return
+        try:
+            self.lanes[FAST].submit(chat_id, lambda: callback(update, *args))
+        except LaneFull:
+            pass
+
+class ScheduledTeleBot(telebot.TeleBot):
+    """TeleBot whose updates are dispatched through an UpdateScheduler instead of one worker pool."""
+
+    def __init__(self, token, scheduler, **kwargs):
+        super().__init__(token, threaded=False, **kwargs)
+        self.scheduler = scheduler
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Acknowledge right away so polling does not fetch the update again
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            self.scheduler.submit(update, lambda update=update: self._process_update(update))
+
+    def _process_update(self, update):
+        event_log.bind(update.update_id)
+        telebot.TeleBot.process_new_updates(self, [update])
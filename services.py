@@ -0,0 +1,134 @@
+import os
+# Loads .env before any service reads its settings
+import startup
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import event_log
+import metrics
+import messages
+import audio_preprocess
+from lyrics_search import LyricsSearch
+from downloads import TelegramFiles, MAX_FILE_SIZE, MAX_DURATION
+from storage import open_user_store
+from analytics import Analytics, ANALYTICS_SEED
+from rate_limit import RateLimiter, RateLimited
+from recognition_cache import RecognitionCache
+
+# Services shared by the polling, asyncio and webhook runtimes. Importing this
+# module builds no bot and patches nothing in telebot, so each runtime sets up
+# its own Telegram client and only pays for what it uses.
+BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+AUDD_API_KEY = os.getenv('AUDD_API_KEY')
+AUDD_API_URL = os.getenv('AUDD_API_URL', 'https://api.audd.io/')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+lyrics_search = startup.timed('lyrics_search', LyricsSearch)
+recognition_cache = startup.timed('recognition_cache', RecognitionCache.from_env)
+index_writer = ThreadPoolExecutor(max_workers=1)
+rate_limiter = startup.timed('rate_limiter', RateLimiter.from_env)
+telegram_files = TelegramFiles(TELEGRAM_API_URL, BOT_TOKEN)
+
+def open_fingerprint_index():
+    # fingerprint imports numpy, which is left out of startup
+    import fingerprint
+    return fingerprint.open_index()
+
+# Built on the first recognition or by the warm-up after startup
+fingerprint_index = startup.Lazy('fingerprint_index', open_fingerprint_index)
+
+# Persistent user statistics and search history
+user_store = startup.timed('user_store', open_user_store)
+
+# Bot-wide top charts and match rates
+analytics = startup.timed('analytics', Analytics.from_env)
+
+def snapshot_history():
+    """Fix the stored history the top charts will be seeded from, or return None."""
+    if not (ANALYTICS_SEED and startup.STARTUP_WARM_UP):
+        return None
+    try:
+        return user_store.iter_history()
+    except sqlite3.Error as e:
+        event_log.event('analytics_seed_error', logging.WARNING, error=str(e))
+        return None
+
+# Taken before any update is dispatched, so searches recorded live and flushed
+# while the seeding runs are not counted twice
+seed_history = snapshot_history()
+
+def seed_analytics():
+    """Count the stored history in the top charts, which would otherwise start empty."""
+    global seed_history
+    history, seed_history = seed_history, None
+    if history is None:
+        return 0
+    try:
+        return analytics.seed(history)
+    except sqlite3.Error as e:
+        event_log.event('analytics_seed_error', logging.WARNING, error=str(e))
+        return 0
+
+# Run by the warm-up; /top shows the live counts until it is done
+analytics_seed = startup.Lazy('analytics_seed', seed_analytics)
+
+def log_user_action(user, action, event='user_action', level=logging.INFO, **fields):
+    """Log a user action as a structured event."""
+    event_log.event(event, level, user_id=user.id, user=user.first_name, action=action, **fields)
+
+def genius_guard(message):
+    """Return a LyricsSearch guard that spends the sender's Genius tokens and daily quota."""
+    def guard():
+        rate_limiter.check('genius', message.from_user.id, message.chat.id)
+        rate_limiter.check_quota('genius')
+        rate_limiter.record_call('genius')
+    return guard
+
+def file_too_large_text():
+    """Return the reply for a file over the download caps."""
+    return messages.FILE_TOO_LARGE_TEXT.format(
+        megabytes=MAX_FILE_SIZE // (1024 * 1024),
+        minutes=MAX_DURATION // 60
+    )
+
+def limit_text(error):
+    """Return the reply for a request refused by the rate limiter."""
+    if isinstance(error, RateLimited):
+        return messages.RATE_LIMITED_TEXT.format(seconds=max(1, round(error.retry_after)))
+    return messages.QUOTA_EXHAUSTED_TEXT
+
+def decode_samples(source, offset=0, duration=None):
+    """Decode audio for the local fingerprint index, or return None when it is unavailable."""
+    if fingerprint_index.get() is None:
+        return None
+    import fingerprint
+    if hasattr(source, 'read'):
+        # The decoder takes a path or bytes
+        source.seek(0)
+        source = source.read()
+    if duration is None:
+        return fingerprint.decode_pcm(source, offset=offset)
+    return fingerprint.decode_pcm(source, duration, offset)
+
+def local_lookup(source, offset=0, duration=None):
+    """Check the local fingerprint index, returning the decoded samples and any matching song."""
+    index = fingerprint_index.get()
+    if index is None:
+        return None, None
+    with metrics.span('local_lookup'):
+        samples = decode_samples(source, offset, duration)
+        song = index.lookup(samples)
+    metrics.CACHE_REQUESTS.inc('fingerprint', 'hit' if song else 'miss')
+    return samples, song
+
+def local_lookup_windows(path, starts):
+    """Check the local fingerprint index against each candidate window of a long file.
+
+    The windows are the ones AuDD would be asked about, so the lookup sees the
+    same audio that songs are indexed from rather than the file's intro.
+    """
+    for start in starts:
+        _, song = local_lookup(path, start, audio_preprocess.CLIP_SECONDS)
+        if song:
+            return song
+    return None
@@ -0,0 +1,98 @@
+import os
+import asyncio
+import threading
+
+# Request coalescing: while a lookup for a key is in flight, identical lookups
+# wait for it instead of starting their own upstream call. Keys are the same
+# ones the caches use, so once the call finishes later requests hit the cache.
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '90'))
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Run at most one call per key at a time; concurrent callers share its outcome."""
+
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the identical call already running.
+
+        Exceptions raised by the running call are raised in every caller sharing
+        it. Callers that join a running call give up with TimeoutError after
+        `timeout` seconds; the call itself keeps going.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.followers += 1
+                leader = False
+
+        if not leader:
+            if not call.event.wait(self.timeout):
+                raise TimeoutError(f"Timed out waiting for in-flight request {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {'in_flight': len(self._calls), 'leaders': self.leaders, 'followers': self.followers}
+
+class AsyncSingleFlight:
+    """Asyncio variant of SingleFlight; `fn` returns a coroutine."""
+
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT):
+        self.timeout = timeout
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            # The call runs as its own task so a cancelled caller does not cancel it for the rest
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for in-flight request {key}") from None
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception retrieved even if every caller has already timed out
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self):
+        return {'in_flight': len(self._calls), 'leaders': self.leaders, 'followers': self.followers}
@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import logging
+import threading
+import importlib.abc
+from dotenv import load_dotenv
+
+# Imported first by every entry point: loads .env once, before any module reads
+# its settings, and keeps the startup clock. Heavy optional components (numpy,
+# the on-disk indexes) are wrapped in Lazy and built on first use or by
+# warm_up() once the bot is already answering. With STARTUP_PROFILE=1 the
+# import of every module and the construction of every component is timed.
+_started = time.perf_counter()
+load_dotenv()
+
+STARTUP_PROFILE = os.getenv('STARTUP_PROFILE', '0') == '1'
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', '2'))
+STARTUP_WARM_UP = os.getenv('STARTUP_WARM_UP', '1') != '0'
+
+_imports = {}
+_components = {}
+_lazy = []
+
+class _TimedLoader:
+    """Delegate to a module's loader, recording how long its module body takes to run."""
+
+    def __init__(self, loader, stack):
+        self._loader = loader
+        self._stack = stack
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        started = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            children = self._stack.pop()
+            elapsed = time.perf_counter() - started
+            if self._stack:
+                self._stack[-1] += elapsed
+            _imports[module.__name__] = (elapsed, elapsed - children)
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """Meta path finder that wraps every other finder's loader in a _TimedLoader."""
+
+    def __init__(self):
+        self._stack = []
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(spec.loader, self._stack)
+            return spec
+        return None
+
+if STARTUP_PROFILE:
+    sys.meta_path.insert(0, _ImportTimer())
+
+def timed(name, factory, *args, **kwargs):
+    """Construct a component, recording how long it took."""
+    started = time.perf_counter()
+    try:
+        return factory(*args, **kwargs)
+    finally:
+        _components[name] = time.perf_counter() - started
+
+class Lazy:
+    """A component built on first use, or by warm_up(), instead of at import."""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self._factory = factory
+        self._value = None
+        self._built = False
+        self._lock = threading.Lock()
+        _lazy.append(self)
+
+    @property
+    def built(self):
+        return self._built
+
+    def get(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self._value = timed(self.name, self._factory)
+                    self._built = True
+        return self._value
+
+def warm_up():
+    """Build every lazy component on a background thread while the bot already serves updates."""
+    import event_log
+
+    def run():
+        for component in list(_lazy):
+            try:
+                component.get()
+            except Exception as e:
+                event_log.event('warm_up_error', logging.WARNING, component=component.name, error=str(e))
+
+    if STARTUP_WARM_UP:
+        threading.Thread(target=run, name='warm-up', daemon=True).start()
+
+def ready(runtime):
+    """Record that the bot can answer updates; warn when that took longer than STARTUP_BUDGET."""
+    import event_log
+
+    seconds = time.perf_counter() - _started
+    over_budget = seconds > STARTUP_BUDGET
+    slowest = sorted(_components.items(), key=lambda item: item[1], reverse=True)[:5]
+    event_log.event(
+        'startup', logging.WARNING if over_budget else logging.INFO,
+        runtime=runtime, seconds=round(seconds, 3), budget=STARTUP_BUDGET,
+        slowest={name: round(elapsed, 3) for name, elapsed in slowest},
+        deferred=[component.name for component in _lazy if not component.built]
+    )
+    if STARTUP_PROFILE:
+        print(report(seconds), file=sys.stderr)
+    return seconds
+
+def report(seconds=None, limit=25):
+    """Format import and initialization times, slowest first."""
+    if seconds is None:
+        seconds = time.perf_counter() - _started
+    lines = [f"Startup took {seconds * 1000:.1f} ms (budget {STARTUP_BUDGET * 1000:.0f} ms)", ""]
+    if _imports:
+        lines.append(f"{'import':<40} {'total ms':>10} {'self ms':>10}")
+        imports = sorted(_imports.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (total, own) in imports[:limit]:
+            lines.append(f"{name:<40} {total * 1000:>10.1f} {own * 1000:>10.1f}")
+        lines.append("")
+    lines.append(f"{'component':<40} {'ms':>10}")
+    for name, elapsed in sorted(_components.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"{name:<40} {elapsed * 1000:>10.1f}")
+    for component in _lazy:
+        if not component.built:
+            lines.append(f"{component.name:<40} {'deferred':>10}")
+    return '\n'.join(lines)
@@ -0,0 +1,303 @@
+import os
+import atexit
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+import event_log
+
+class UserStore:
+    """Per-user statistics and search history."""
+
+    def ensure_user(self, user_id):
+        """Create the user's record if it does not exist yet."""
+        raise NotImplementedError
+
+    def get_stats(self, user_id):
+        """Return a dict with searches, successful_matches and joined_date."""
+        raise NotImplementedError
+
+    def get_history(self, user_id, limit=10):
+        """Return up to `limit` most recent history entries, oldest first."""
+        raise NotImplementedError
+
+    def record_search(self, user_id, song=None, matched=False):
+        """Count a search, optionally as a successful match, and add the song to the history."""
+        raise NotImplementedError
+
+    def iter_history(self):
+        """Return an iterator over every user's history entries as dicts with user_id, title and artist.
+
+        The entries are those recorded when this is called; searches recorded
+        while iterating are not included. Entries are streamed user by user,
+        oldest first.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+def _new_user(history_limit):
+    return {
+        'searches': 0,
+        'successful_matches': 0,
+        'history': deque(maxlen=history_limit),
+        'joined_date': datetime.now().strftime('%Y-%m-%d')
+    }
+
+def _stats_view(user):
+    return {
+        'searches': user['searches'],
+        'successful_matches': user['successful_matches'],
+        'joined_date': user['joined_date']
+    }
+
+def _history_view(user, limit):
+    history = list(user['history'])
+    return history[-limit:] if limit else history
+
+class MemoryUserStore(UserStore):
+    """Process-local store; history is still capped, but nothing survives a restart."""
+
+    def __init__(self, history_limit=50):
+        self.history_limit = history_limit
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def _user(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _new_user(self.history_limit)
+        return user
+
+    def ensure_user(self, user_id):
+        with self._lock:
+            self._user(user_id)
+
+    def get_stats(self, user_id):
+        with self._lock:
+            return _stats_view(self._user(user_id))
+
+    def get_history(self, user_id, limit=10):
+        with self._lock:
+            return _history_view(self._user(user_id), limit)
+
+    def record_search(self, user_id, song=None, matched=False):
+        with self._lock:
+            user = self._user(user_id)
+            user['searches'] += 1
+            if matched:
+                user['successful_matches'] += 1
+            if song:
+                user['history'].append({'title': song['title'], 'artist': song['artist']})
+
+    def iter_history(self):
+        with self._lock:
+            entries = [
+                {'user_id': user_id, **item}
+                for user_id, user in self._users.items() for item in user['history']
+            ]
+        return iter(entries)
+
+class SQLiteUserStore(UserStore):
+    """SQLite (WAL) store with write-behind batching and a small hot cache of recent users.
+
+    Writes update the cached user immediately and are queued as per-user deltas;
+    a background thread applies all queued deltas in one transaction every
+    `flush_interval` seconds. History is a per-user ring of `history_limit` rows.
+    """
+
+    def __init__(self, path, history_limit=50, cache_size=1000, flush_interval=2.0):
+        self.path = path
+        self.history_limit = history_limit
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY,"
+            " searches INTEGER NOT NULL DEFAULT 0,"
+            " successful_matches INTEGER NOT NULL DEFAULT 0,"
+            " joined_date TEXT NOT NULL,"
+            " history_seq INTEGER NOT NULL DEFAULT 0);"
+            "CREATE TABLE IF NOT EXISTS history ("
+            " user_id INTEGER NOT NULL,"
+            " slot INTEGER NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " title TEXT NOT NULL,"
+            " artist TEXT NOT NULL,"
+            " PRIMARY KEY (user_id, slot)) WITHOUT ROWID;"
+        )
+
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def ensure_user(self, user_id):
+        with self._lock:
+            user = self._user(user_id)
+            if user.get('new'):
+                self._pending_for(user_id, user)
+
+    def get_stats(self, user_id):
+        with self._lock:
+            return _stats_view(self._user(user_id))
+
+    def get_history(self, user_id, limit=10):
+        with self._lock:
+            return _history_view(self._user(user_id), limit)
+
+    def record_search(self, user_id, song=None, matched=False):
+        with self._lock:
+            user = self._user(user_id)
+            pending = self._pending_for(user_id, user)
+            user['searches'] += 1
+            pending['searches'] += 1
+            if matched:
+                user['successful_matches'] += 1
+                pending['successful_matches'] += 1
+            if song:
+                item = {'title': song['title'], 'artist': song['artist']}
+                user['history'].append(item)
+                pending['history'].append(item)
+                pending['appended'] += 1
+
+    def flush(self):
+        """Write all queued deltas in a single transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            with self._conn:
+                for user_id, delta in pending.items():
+                    self._apply(user_id, delta)
+
+    def iter_history(self):
+        self.flush()
+        return iter_history(self.path)
+
+    def close(self):
+        if not self._closed.is_set():
+            self._closed.set()
+            self._flusher.join()
+            self.flush()
+            self._conn.close()
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                event_log.event('user_store_flush_error', logging.ERROR, error=str(e))
+
+    def _pending_for(self, user_id, user):
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = self._pending[user_id] = {
+                'searches': 0,
+                'successful_matches': 0,
+                'joined_date': user['joined_date'],
+                'history': deque(maxlen=self.history_limit),
+                'appended': 0
+            }
+            user.pop('new', None)
+        return pending
+
+    def _apply(self, user_id, delta):
+        self._conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, joined_date) VALUES (?, ?)",
+            (user_id, delta['joined_date'])
+        )
+        seq = self._conn.execute(
+            "UPDATE users SET searches = searches + ?,"
+            " successful_matches = successful_matches + ?,"
+            " history_seq = history_seq + ?"
+            " WHERE user_id = ? RETURNING history_seq",
+            (delta['searches'], delta['successful_matches'], delta['appended'], user_id)
+        ).fetchone()[0]
+        # Only the newest history_limit items survive; each overwrites its ring slot
+        first = seq - len(delta['history'])
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO history (user_id, slot, seq, title, artist)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (user_id, (first + i) % self.history_limit, first + i, item['title'], item['artist'])
+                for i, item in enumerate(delta['history'])
+            ]
+        )
+
+    def _user(self, user_id):
+        user = self._cache.get(user_id)
+        if user is not None:
+            self._cache.move_to_end(user_id)
+            return user
+
+        if user_id in self._pending:
+            self.flush()
+        user = self._load(user_id)
+        self._cache[user_id] = user
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return user
+
+    def _load(self, user_id):
+        row = self._conn.execute(
+            "SELECT searches, successful_matches, joined_date FROM users WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        user = _new_user(self.history_limit)
+        if row is None:
+            user['new'] = True
+            return user
+
+        user['searches'], user['successful_matches'], user['joined_date'] = row
+        user['history'].extend(
+            {'title': title, 'artist': artist}
+            for title, artist in self._conn.execute(
+                "SELECT title, artist FROM history WHERE user_id = ? ORDER BY seq",
+                (user_id,)
+            )
+        )
+        return user
+
+def iter_history(path):
+    """Stream the history stored in a SQLite user store file, see UserStore.iter_history."""
+    # A connection of its own reads a consistent WAL snapshot alongside the
+    # writer. The query takes its first step here, which fixes the snapshot;
+    # the rows may be read on another thread, one thread at a time.
+    conn = sqlite3.connect(path, check_same_thread=False)
+    try:
+        cursor = conn.execute("SELECT user_id, title, artist FROM history ORDER BY user_id, seq")
+    except BaseException:
+        conn.close()
+        raise
+    return _history_rows(conn, cursor)
+
+def _history_rows(conn, cursor):
+    try:
+        for user_id, title, artist in cursor:
+            yield {'user_id': user_id, 'title': title, 'artist': artist}
+    finally:
+        conn.close()
+
+def open_user_store():
+    """Open the store selected by the USER_STORE_* environment variables."""
+    history_limit = int(os.getenv('USER_HISTORY_LIMIT', '50'))
+    if os.getenv('USER_STORE_BACKEND', 'sqlite') == 'memory':
+        return MemoryUserStore(history_limit)
+
+    store = SQLiteUserStore(
+        os.getenv('USER_STORE_PATH', 'user_stats.db'),
+        history_limit=history_limit,
+        cache_size=int(os.getenv('USER_STORE_CACHE_SIZE', '1000')),
+        flush_interval=float(os.getenv('USER_STORE_FLUSH_INTERVAL', '2.0'))
+    )
+    atexit.register(store.close)
+    return store
@@ -0,0 +1,109 @@
+"""Measure the per-update CPU cost of rendering replies for callback-heavy traffic.
+
+Each simulated update is a callback query (or, with --mix, a recognized song)
+parsed the way telebot parses it. Its reply text and reply_markup are then
+rendered and serialized the way telebot serializes them before a send. The
+same work is timed twice: with the shared frozen keyboards, and with every
+keyboard rebuilt for each reply as the handlers used to do.
+
+    python tools/bench_render.py --updates 200000
+    python tools/bench_render.py --updates 50000 --mix callback=3,song=1
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telebot import types
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+import messages
+from fake_services import _song
+from fake_telegram import callback_update
+
+STATS = {'searches': 42, 'successful_matches': 37, 'joined_date': '2024-01-01'}
+HISTORY = [{'title': f"Song {n}", 'artist': f"Artist {n}"} for n in range(10)]
+SONG = dict(_song('bench'), album='Bench Album')
+
+def _rebuilt(keyboard):
+    """A fresh copy of a frozen keyboard, like the per-call builders produced."""
+    copy = InlineKeyboardMarkup(row_width=keyboard.row_width)
+    copy.add(*[
+        InlineKeyboardButton(button.text, url=button.url, callback_data=button.callback_data)
+        for row in keyboard.keyboard for button in row
+    ])
+    return copy
+
+def _replies(keyboard):
+    return {
+        'stats': lambda: (messages.format_stats(STATS), keyboard(messages.STATS_KEYBOARD)),
+        'history': lambda: (messages.format_history(HISTORY), keyboard(messages.HISTORY_KEYBOARD)),
+        'help': lambda: (messages.HELP_TEXT, keyboard(messages.HELP_KEYBOARD)),
+        'about': lambda: (messages.ABOUT_TEXT, keyboard(messages.ABOUT_KEYBOARD)),
+        'new_search': lambda: (messages.NEW_SEARCH_TEXT, keyboard(messages.MENU_KEYBOARD)),
+        'song': lambda: messages.format_song(SONG),
+    }
+
+def _serialize(text, markup):
+    # What apihelper does with the arguments of send_message/edit_message_text
+    markup = markup.to_json() if isinstance(markup, types.JsonSerializable) else markup
+    return {'text': text, 'parse_mode': 'Markdown', 'reply_markup': markup}
+
+def run(updates, replies):
+    """Return CPU seconds spent parsing, rendering and serializing the updates."""
+    started = time.process_time()
+    for payload in updates:
+        update = types.Update.de_json(payload)
+        data = update.callback_query.data
+        text, markup = replies[data]()
+        _serialize(text, markup)
+    return time.process_time() - started
+
+def parse_mix(text):
+    kinds, weights = [], []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kinds.append(kind.strip())
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=100000)
+    parser.add_argument('--mix', default='callback=1', help="callback and song weights, e.g. callback=3,song=1")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    kinds, weights = parse_mix(args.mix)
+    callbacks = ['stats', 'history', 'help', 'about', 'new_search']
+    updates = []
+    for chat_id in range(args.updates):
+        kind = random.choices(kinds, weights)[0]
+        data = random.choice(callbacks) if kind == 'callback' else 'song'
+        updates.append(callback_update(chat_id + 1, data))
+
+    # Parsing alone is the floor neither variant can go below
+    parse_only = time.process_time()
+    for payload in updates:
+        types.Update.de_json(payload)
+    parse_only = time.process_time() - parse_only
+
+    rebuilt = run(updates, _replies(_rebuilt))
+    frozen = run(updates, _replies(lambda keyboard: keyboard))
+
+    per_update = 1e6 / args.updates
+    print(f"updates:          {args.updates}")
+    print(f"parse only:       {parse_only * per_update:8.2f} us/update")
+    print(f"rebuilt keyboards:{rebuilt * per_update:8.2f} us/update "
+          f"(render {(rebuilt - parse_only) * per_update:.2f})")
+    print(f"frozen keyboards: {frozen * per_update:8.2f} us/update "
+          f"(render {(frozen - parse_only) * per_update:.2f})")
+    if frozen > parse_only:
+        print(f"render speedup:   {(rebuilt - parse_only) / (frozen - parse_only):8.1f}x")
+
+if __name__ == "__main__":
+    main()
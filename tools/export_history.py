@@ -0,0 +1,62 @@
+"""Export every user's search history from the SQLite user store as CSV or JSON Lines.
+
+Rows are streamed from the database to the output one at a time, so the
+export runs in constant memory however large the history is. The store can be
+exported while the bot is running; searches it has not flushed yet (at most
+USER_STORE_FLUSH_INTERVAL seconds old) are not included.
+
+    python tools/export_history.py --format csv --output history.csv
+    python tools/export_history.py --format jsonl | gzip > history.jsonl.gz
+"""
+import os
+import sys
+import csv
+import json
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Loads .env, which may set USER_STORE_PATH
+import startup
+from storage import iter_history
+
+FIELDS = ('user_id', 'title', 'artist')
+
+def write_csv(entries, out):
+    writer = csv.DictWriter(out, fieldnames=FIELDS)
+    writer.writeheader()
+    count = 0
+    for entry in entries:
+        writer.writerow(entry)
+        count += 1
+    return count
+
+def write_jsonl(entries, out):
+    count = 0
+    for entry in entries:
+        out.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default=os.getenv('USER_STORE_PATH', 'user_stats.db'))
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+    parser.add_argument('--output', help="file to write; standard output by default")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"no user store at {args.db}")
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        count = WRITERS[args.format](iter_history(args.db), out)
+    finally:
+        if args.output:
+            out.close()
+    print(f"Exported {count} history entries", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Local stand-ins for the AuDD and Genius APIs, with configurable latency and errors.
+
+Run both fakes:
+
+    python tools/fake_services.py --audd-port 8082 --genius-port 8083 --latency-ms 300 --error-rate 0.02
+
+Point the bot at them:
+
+    AUDD_API_URL=http://127.0.0.1:8082/ GENIUS_API_URL=http://127.0.0.1:8083 python main.py
+"""
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class Behaviour:
+    """Latency and failure distribution of a fake upstream.
+
+    Latency is drawn from a normal distribution (clamped at zero); a fraction
+    `error_rate` of requests fails with `error_status`.
+    """
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, error_status=500):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def apply(self):
+        """Sleep for one latency sample and return an error status to send, or None."""
+        delay = random.gauss(self.latency_ms, self.jitter_ms) if self.jitter_ms else self.latency_ms
+        if delay > 0:
+            time.sleep(delay / 1000)
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.requests += 1
+            self.errors += failed
+        return self.error_status if failed else None
+
+    def stats(self):
+        return {'requests': self.requests, 'errors': self.errors}
+
+    @classmethod
+    def add_arguments(cls, parser, prefix=''):
+        option = f"--{prefix}-" if prefix else '--'
+        parser.add_argument(f"{option}latency-ms", type=float, default=0)
+        parser.add_argument(f"{option}jitter-ms", type=float, default=0)
+        parser.add_argument(f"{option}error-rate", type=float, default=0.0)
+        parser.add_argument(f"{option}error-status", type=int, default=500)
+
+    @classmethod
+    def from_arguments(cls, args, prefix=''):
+        name = f"{prefix}_" if prefix else ''
+        return cls(
+            getattr(args, f"{name}latency_ms"),
+            getattr(args, f"{name}jitter_ms"),
+            getattr(args, f"{name}error_rate"),
+            getattr(args, f"{name}error_status")
+        )
+
+def _song(seed):
+    """A deterministic fake song for a seed string."""
+    number = int(hashlib.sha1(seed.encode()).hexdigest()[:6], 16) % 500
+    return {
+        'title': f"Song {number}",
+        'artist': f"Artist {number % 50}",
+        'album': f"Album {number % 120}",
+        'release_date': '2020-01-01',
+        'song_link': f"https://lis.tn/{number}",
+        'apple_music': {'url': f"https://music.apple.com/song/{number}"},
+        'spotify': {'external_urls': {'spotify': f"https://open.spotify.com/track/{number}"}}
+    }
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    behaviour = Behaviour()
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeAudD(_FakeHandler):
+    """Answer recognition uploads; `match_rate` of them identify a song derived from the upload."""
+
+    behaviour = Behaviour()
+    match_rate = 0.8
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status = self.behaviour.apply()
+        if status:
+            self._send_json(status, {'status': 'error', 'error': {'error_code': status}})
+            return
+        digest = hashlib.sha1(body).hexdigest()
+        # Deterministic per upload, so repeated files get the same answer
+        matched = int(digest[:8], 16) / 0xFFFFFFFF < self.match_rate
+        self._send_json(200, {'status': 'success', 'result': _song(digest) if matched else None})
+
+class FakeGenius(_FakeHandler):
+    """Answer /search with five hits, and song pages with a short lyrics snippet."""
+
+    behaviour = Behaviour()
+
+    def do_GET(self):
+        status = self.behaviour.apply()
+        if status:
+            self._send_json(status, {'meta': {'status': status}})
+            return
+        url = urlparse(self.path)
+        if url.path == '/search':
+            query = parse_qs(url.query).get('q', [''])[0]
+            self._send_json(200, {'response': {'hits': [
+                {'result': {
+                    'title': _song(f"{query}{rank}")['title'],
+                    'primary_artist': {'name': _song(f"{query}{rank}")['artist']},
+                    'url': f"http://{self.headers.get('Host')}/songs/{rank}",
+                    'song_art_image_thumbnail_url': f"http://{self.headers.get('Host')}/art/{rank}.jpg"
+                }}
+                for rank in range(5)
+            ]}})
+            return
+
+        body = (
+            "<html><body><div data-lyrics-container=\"true\">"
+            "First line of the song<br/>Second line of the song<br/>Third line"
+            "</div></body></html>"
+        ).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start(handler, behaviour, host='127.0.0.1', port=0):
+    """Serve a fake with the given behaviour from a daemon thread; returns the server."""
+    handler = type(handler.__name__, (handler,), {'behaviour': behaviour})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--audd-port', type=int, default=8082)
+    parser.add_argument('--genius-port', type=int, default=8083)
+    parser.add_argument('--match-rate', type=float, default=0.8)
+    Behaviour.add_arguments(parser)
+    args = parser.parse_args()
+
+    FakeAudD.match_rate = args.match_rate
+    behaviour = Behaviour.from_arguments(args)
+    audd = start(FakeAudD, behaviour, args.host, args.audd_port)
+    genius = start(FakeGenius, behaviour, args.host, args.genius_port)
+    print(f"Fake AuDD on http://{args.host}:{audd.server_address[1]}/")
+    print(f"Fake Genius on http://{args.host}:{genius.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Local stand-in for Telegram, for exercising the webhook runtime end to end.
+
+Run a stub Bot API that answers every method the bot calls:
+
+    python tools/fake_telegram.py serve --port 8081
+
+Start the webhook runtime against it:
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python webhook.py
+
+Then POST canned updates to the webhook:
+
+    python tools/fake_telegram.py post --url http://127.0.0.1:8443/telegram --count 100 --chats 10
+
+Updates put on FakeBotAPI.updates are served to polling bots through
+getUpdates; tools/loadtest.py uses that to drive main.py and async_bot.py.
+"""
+import io
+import json
+import math
+import time
+import wave
+import queue
+import random
+import struct
+import hashlib
+import argparse
+import itertools
+import threading
+import urllib.request
+from urllib.parse import urlparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from fake_services import Behaviour
+
+_message_ids = itertools.count(1000)
+_update_ids = itertools.count(1)
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+def _chat(chat_id):
+    return {'id': chat_id, 'type': 'private', 'first_name': f"User{chat_id}"}
+
+def make_message(chat_id, text=None, **extra):
+    message = {
+        'message_id': next(_message_ids),
+        'date': int(time.time()),
+        'chat': _chat(chat_id),
+        'from': _user(chat_id)
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    message.update(extra)
+    return message
+
+def command_update(chat_id, text):
+    return {'update_id': next(_update_ids), 'message': make_message(chat_id, text)}
+
+def callback_update(chat_id, data):
+    return {
+        'update_id': next(_update_ids),
+        'callback_query': {
+            'id': str(next(_message_ids)),
+            'from': _user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': make_message(chat_id, "menu")
+        }
+    }
+
+def audio_update(chat_id, kind='voice', duration=8):
+    file_id = f"{kind}-file-{random.randint(1, 20)}"
+    media = {'file_id': file_id, 'file_unique_id': file_id, 'duration': duration}
+    if kind == 'voice':
+        media['mime_type'] = 'audio/ogg'
+    elif kind == 'audio':
+        media['mime_type'] = 'audio/mpeg'
+    else:
+        media.update({'mime_type': 'video/mp4', 'width': 640, 'height': 360})
+    return {'update_id': next(_update_ids), 'message': make_message(chat_id, **{kind: media})}
+
+def tone_wav(seed, seconds=10, rate=8000):
+    """A short WAV of two tones whose pitch depends on the seed, so each file id sounds different."""
+    number = int(hashlib.sha1(seed.encode()).hexdigest()[:6], 16)
+    low, high = 200 + number % 400, 900 + number % 700
+    frames = b''.join(
+        struct.pack('<h', int(8000 * (math.sin(2 * math.pi * low * i / rate) + math.sin(2 * math.pi * high * i / rate))))
+        for i in range(int(seconds * rate))
+    )
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(rate)
+        out.writeframes(frames)
+    return buffer.getvalue()
+
+CANNED_UPDATES = [
+    lambda chat_id: command_update(chat_id, '/start'),
+    lambda chat_id: command_update(chat_id, '/help'),
+    lambda chat_id: command_update(chat_id, '/stats'),
+    lambda chat_id: command_update(chat_id, '/history'),
+    lambda chat_id: command_update(chat_id, '/lyrics we will rock you'),
+    lambda chat_id: callback_update(chat_id, 'stats'),
+    lambda chat_id: callback_update(chat_id, 'help'),
+    lambda chat_id: callback_update(chat_id, 'new_search'),
+]
+
+class FakeBotAPI(BaseHTTPRequestHandler):
+    """Answer /bot<token>/<method> and /file/bot<token>/<path> with plausible results.
+
+    `updates` feeds getUpdates, `behaviour` adds latency and errors to API
+    methods, and `recorder(method, params)` is told about every method call.
+    """
+
+    updates = queue.Queue()
+    behaviour = Behaviour()
+    recorder = None
+    _files = {}
+
+    def do_GET(self):
+        if self.path.startswith('/file/'):
+            file_id = self.path.rsplit('/', 1)[-1].split('.')[0]
+            if file_id not in self._files:
+                self._files[file_id] = tone_wav(file_id)
+            self._send(200, self._files[file_id], 'audio/wav')
+        else:
+            # AsyncTeleBot sends getFile and friends as a GET with a form body
+            self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply(self._method(), self._params(body))
+
+    def _method(self):
+        return self.path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+
+    def _params(self, body):
+        """Merge query string and form or JSON body parameters."""
+        params = dict(parse_qsl(urlparse(self.path).query))
+        content_type = self.headers.get('Content-Type', '')
+        if body and 'json' in content_type:
+            params.update(json.loads(body))
+        elif body and 'x-www-form-urlencoded' in content_type:
+            params.update(parse_qsl(body.decode()))
+        return params
+
+    def _reply(self, method, params):
+        if self.recorder is not None:
+            self.recorder(method, params)
+        if method == 'getUpdates':
+            self._send_updates(float(params.get('timeout', 0) or 0))
+            return
+
+        status = self.behaviour.apply()
+        if status:
+            error = {'ok': False, 'error_code': status, 'description': 'Fake failure'}
+            if status == 429:
+                error['parameters'] = {'retry_after': 1}
+            self._send(status, json.dumps(error).encode(), 'application/json')
+            return
+
+        chat_id = int(params.get('chat_id', 1))
+        if method in ('sendMessage', 'editMessageText'):
+            result = make_message(chat_id, params.get('text', "ok"))
+        elif method == 'getFile':
+            file_id = params.get('file_id', 'f')
+            result = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': 160044, 'file_path': f"media/{file_id}.wav"}
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'TuneDetective', 'username': 'tune_bot'}
+        else:
+            result = True
+        self._send(200, json.dumps({'ok': True, 'result': result}).encode(), 'application/json')
+
+    def _send_updates(self, timeout):
+        # Long polling, capped so a stopping bot is not kept waiting
+        batch = []
+        try:
+            batch.append(self.updates.get(timeout=min(timeout, 1.0)))
+            while len(batch) < 100:
+                batch.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        self._send(200, json.dumps({'ok': True, 'result': batch}).encode(), 'application/json')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start(host='127.0.0.1', port=0, handler=FakeBotAPI):
+    """Serve the fake Bot API from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve(host, port, handler=FakeBotAPI):
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Fake Telegram Bot API on http://{host}:{port}")
+    server.serve_forever()
+
+def post_updates(url, updates, secret=None):
+    """POST each update to the webhook and return the HTTP status codes."""
+    statuses = []
+    for update in updates:
+        request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST')
+        request.add_header('Content-Type', 'application/json')
+        if secret:
+            request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                statuses.append(response.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+    return statuses
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help="run the stub Bot API")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8081)
+    post_parser = commands.add_parser('post', help="POST canned updates to a webhook")
+    post_parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    post_parser.add_argument('--count', type=int, default=20)
+    post_parser.add_argument('--chats', type=int, default=5)
+    post_parser.add_argument('--secret')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.host, args.port)
+        return
+
+    updates = [
+        random.choice(CANNED_UPDATES)(100 + i % args.chats)
+        for i in range(args.count)
+    ]
+    started = time.perf_counter()
+    statuses = post_updates(args.url, updates, args.secret)
+    elapsed = time.perf_counter() - started
+    accepted = statuses.count(200)
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s: {accepted} accepted, {len(updates) - accepted} rejected")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+"""Replay a synthetic update stream against the bot and report throughput, latency and memory.
+
+Fake Telegram, AuDD and Genius servers are started in this process, the bot
+is started as a child process pointed at them, and updates are delivered at a
+fixed rate. An update's latency is the time from delivery to the bot's last
+Bot API call for it (each update gets its own chat, so calls can be matched).
+
+    python tools/loadtest.py --mode polling --rate 20 --duration 30
+    python tools/loadtest.py --mode webhook --rate 50 --duration 60 --audd-latency-ms 400 --output run.json
+    python tools/loadtest.py --mode asyncio --rate 50 --duration 60 --baseline run.json
+
+With --baseline the run fails (exit code 1) when throughput drops or p95/p99
+latency grows by more than --tolerance compared to the saved run. Any run
+fails when the bot logs a startup error, such as a failed /top seed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import urllib.request
+
+import fake_services
+import fake_telegram
+from fake_services import Behaviour, FakeAudD, FakeGenius
+from fake_telegram import FakeBotAPI, command_update, callback_update, audio_update
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = {'polling': 'main.py', 'asyncio': 'async_bot.py', 'webhook': 'webhook.py'}
+
+LYRICS_QUERIES = [
+    'we will rock you', 'is this the real life', 'hello from the other side',
+    'never gonna give you up', 'i will always love you', 'take on me',
+    'dont stop believin', 'billie jean is not my lover', 'smells like teen spirit',
+    'sweet child o mine', 'every breath you take', 'hey jude dont make it bad',
+]
+
+UPDATE_KINDS = {
+    'voice': lambda chat_id: audio_update(chat_id, 'voice', duration=8),
+    'audio': lambda chat_id: audio_update(chat_id, 'audio', duration=random.choice((20, 180))),
+    'video': lambda chat_id: audio_update(chat_id, 'video', duration=30),
+    'lyrics': lambda chat_id: command_update(chat_id, '/lyrics ' + random.choice(LYRICS_QUERIES)),
+    'callback': lambda chat_id: callback_update(chat_id, random.choice(('help', 'stats', 'about', 'new_search'))),
+    'command': lambda chat_id: command_update(chat_id, random.choice(('/start', '/help', '/stats', '/history'))),
+}
+
+DEFAULT_MIX = 'voice=3,audio=2,video=1,lyrics=2,callback=3,command=3'
+
+# Logged only when startup itself is broken, never by injected upstream failures
+STARTUP_ERRORS = {'analytics_seed_error', 'warm_up_error'}
+
+def parse_mix(text):
+    """Parse 'kind=weight,...' into ([kinds], [weights])."""
+    kinds, weights = [], []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in UPDATE_KINDS:
+            raise SystemExit(f"Unknown update kind {kind!r}; choose from {', '.join(UPDATE_KINDS)}")
+        kinds.append(kind.strip())
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[max(0, min(len(values) - 1, int(q * len(values) + 0.5) - 1))]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def peak_rss_mb(pid):
+    """Peak resident memory of a process and its children in MB (Linux only)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as stat:
+                    children.setdefault(int(stat.read().rsplit(')', 1)[1].split()[1]), []).append(int(entry))
+            except OSError:
+                pass
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return round(total / 1024, 1) if total else None
+
+class Tracker:
+    """Match Bot API calls to the updates that caused them."""
+
+    def __init__(self):
+        self.sent = {}
+        self.kinds = {}
+        self.last_call = {}
+        self.callbacks = {}
+        self.polling = threading.Event()
+        self._lock = threading.Lock()
+
+    def delivered(self, chat_id, kind, update):
+        with self._lock:
+            self.sent[chat_id] = time.perf_counter()
+            self.kinds[chat_id] = kind
+            if 'callback_query' in update:
+                self.callbacks[update['callback_query']['id']] = chat_id
+
+    def record(self, method, params):
+        if method == 'getUpdates':
+            self.polling.set()
+            return
+        now = time.perf_counter()
+        with self._lock:
+            chat_id = params.get('chat_id')
+            key = int(chat_id) if chat_id is not None else self.callbacks.get(params.get('callback_query_id'))
+            if key in self.sent:
+                self.last_call[key] = now
+
+    def quiet_for(self):
+        with self._lock:
+            latest = max(self.last_call.values(), default=0)
+        return time.perf_counter() - latest if latest else 0
+
+    def latencies(self, kind=None):
+        with self._lock:
+            return sorted(
+                self.last_call[chat_id] - sent
+                for chat_id, sent in self.sent.items()
+                if chat_id in self.last_call and (kind is None or self.kinds[chat_id] == kind)
+            )
+
+def bot_environment(args, workdir, ports):
+    env = dict(os.environ)
+    env.update({
+        'TELEGRAM_BOT_TOKEN': '123456:loadtest',
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{ports['telegram']}",
+        'AUDD_API_URL': f"http://127.0.0.1:{ports['audd']}/",
+        'GENIUS_API_URL': f"http://127.0.0.1:{ports['genius']}",
+        'AUDD_API_KEY': 'loadtest',
+        'GENIUS_ACCESS_TOKEN': 'loadtest',
+        'USER_STORE_PATH': os.path.join(workdir, 'users.db'),
+        'RECOGNITION_CACHE_PATH': os.path.join(workdir, 'recognition_cache.db'),
+        'FINGERPRINT_INDEX_PATH': os.path.join(workdir, 'fingerprint_index'),
+        'LYRICS_INDEX_PATH': os.path.join(workdir, 'lyrics_index.db'),
+        'RATE_LIMIT_PATH': os.path.join(workdir, 'rate_limits.db'),
+        'LOG_FILE': os.path.join(workdir, 'bot.log'),
+        'WEBHOOK_HOST': '127.0.0.1',
+        'WEBHOOK_PORT': str(ports['webhook']),
+        'WEBHOOK_URL': '',
+        'WEBHOOK_SECRET': '',
+        'PYTHONUNBUFFERED': '1',
+    })
+    # The limiter would otherwise refuse most of a synthetic burst
+    for upstream in ('AUDD', 'GENIUS'):
+        for scope in ('USER', 'CHAT', 'GLOBAL'):
+            env.setdefault(f"{upstream}_{scope}_PER_MINUTE", '1000000')
+            env.setdefault(f"{upstream}_{scope}_BURST", '1000000')
+    return env
+
+def wait_until_ready(mode, tracker, ports, timeout):
+    deadline = time.monotonic() + timeout
+    if mode != 'webhook':
+        return tracker.polling.wait(timeout)
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', ports['webhook']), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def deliver(mode, update, ports):
+    """Hand one update to the bot; returns False when the webhook refused it."""
+    if mode != 'webhook':
+        FakeBotAPI.updates.put(update)
+        return True
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{ports['webhook']}/telegram",
+        data=json.dumps(update).encode(),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+def run(args):
+    random.seed(args.seed)
+    kinds, weights = parse_mix(args.mix)
+    tracker = Tracker()
+
+    FakeAudD.match_rate = args.match_rate
+    FakeBotAPI.recorder = tracker.record
+    FakeBotAPI.behaviour = Behaviour.from_arguments(args, 'telegram')
+    telegram = fake_telegram.start()
+    audd_behaviour = Behaviour.from_arguments(args, 'audd')
+    genius_behaviour = Behaviour.from_arguments(args, 'genius')
+    audd = fake_services.start(FakeAudD, audd_behaviour)
+    genius = fake_services.start(FakeGenius, genius_behaviour)
+    ports = {
+        'telegram': telegram.server_address[1],
+        'audd': audd.server_address[1],
+        'genius': genius.server_address[1],
+        'webhook': free_port(),
+    }
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    with open(os.path.join(workdir, 'bot.out'), 'wb') as output:
+        bot = subprocess.Popen(
+            [sys.executable, SCRIPTS[args.mode]],
+            cwd=ROOT, env=bot_environment(args, workdir, ports),
+            stdout=output, stderr=subprocess.STDOUT
+        )
+    try:
+        if not wait_until_ready(args.mode, tracker, ports, args.startup_timeout):
+            raise SystemExit(f"Bot did not start within {args.startup_timeout}s, see {workdir}/bot.out")
+        time.sleep(args.warmup)
+
+        total = int(args.rate * args.duration)
+        chat_ids = itertools.count(1_000_000)
+        rejected = 0
+        started = time.perf_counter()
+        for index in range(total):
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = random.choices(kinds, weights)[0]
+            chat_id = next(chat_ids)
+            update = UPDATE_KINDS[kind](chat_id)
+            tracker.delivered(chat_id, kind, update)
+            if not deliver(args.mode, update, ports):
+                rejected += 1
+        send_time = time.perf_counter() - started
+
+        # Drain: wait for every update to be answered, or for the bot to go quiet
+        deadline = time.monotonic() + args.drain
+        while time.monotonic() < deadline:
+            if len(tracker.last_call) >= total - rejected or (tracker.last_call and tracker.quiet_for() > args.settle):
+                break
+            time.sleep(0.2)
+        memory = peak_rss_mb(bot.pid)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+
+    latencies = tracker.latencies()
+    finished = max(tracker.last_call.values(), default=started) - started
+    report = {
+        'mode': args.mode,
+        'rate': args.rate,
+        'duration': args.duration,
+        'mix': args.mix,
+        'sent': total,
+        'rejected': rejected,
+        'answered': len(latencies),
+        'unanswered': total - rejected - len(latencies),
+        'send_seconds': round(send_time, 2),
+        'throughput': round(len(latencies) / finished, 2) if finished > 0 else 0.0,
+        'latency_ms': summarize(latencies),
+        'latency_ms_by_kind': {kind: summarize(tracker.latencies(kind)) for kind in kinds},
+        'peak_rss_mb': memory,
+        'upstreams': {
+            'telegram': FakeBotAPI.behaviour.stats(),
+            'audd': audd_behaviour.stats(),
+            'genius': genius_behaviour.stats(),
+        },
+        'startup_errors': startup_errors(os.path.join(workdir, 'bot.log')),
+        'workdir': workdir,
+    }
+    return report
+
+def startup_errors(log_path):
+    """Return the startup error events in the bot's log, such as a failed /top seed."""
+    errors = []
+    if not os.path.exists(log_path):
+        return errors
+    with open(log_path, encoding='utf-8') as log:
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('event') in STARTUP_ERRORS:
+                errors.append(entry)
+    return errors
+
+def summarize(latencies):
+    return {
+        name: round(value * 1000, 1) if value is not None else None
+        for name, value in (
+            ('p50', percentile(latencies, 0.50)),
+            ('p95', percentile(latencies, 0.95)),
+            ('p99', percentile(latencies, 0.99)),
+            ('max', latencies[-1] if latencies else None),
+        )
+    }
+
+def print_report(report):
+    latency = report['latency_ms']
+    print(f"\nMode {report['mode']}: {report['sent']} updates at {report['rate']}/s over {report['send_seconds']}s")
+    print(f"Answered {report['answered']}, unanswered {report['unanswered']}, rejected {report['rejected']}")
+    print(f"Throughput {report['throughput']} updates/s, peak RSS {report['peak_rss_mb']} MB")
+    print(f"Latency ms: p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    for kind, stats in report['latency_ms_by_kind'].items():
+        print(f"  {kind:<9} p50 {stats['p50']}  p95 {stats['p95']}  p99 {stats['p99']}")
+    for name, stats in report['upstreams'].items():
+        print(f"  {name:<9} {stats['requests']} requests, {stats['errors']} injected errors")
+    for error in report['startup_errors']:
+        print(f"STARTUP ERROR: {error['event']}: {error.get('error')}")
+    print(f"Bot output and logs in {report['workdir']}")
+
+def compare(report, baseline, tolerance):
+    """Return the regressions of a report against a baseline report."""
+    regressions = []
+    if baseline['throughput'] and report['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput']} < {baseline['throughput']}")
+    for name in ('p95', 'p99'):
+        old, new = baseline['latency_ms'][name], report['latency_ms'][name]
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(f"{name} latency {new}ms > {old}ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=sorted(SCRIPTS), default='polling')
+    parser.add_argument('--rate', type=float, default=10, help="updates per second")
+    parser.add_argument('--duration', type=float, default=20, help="seconds of traffic")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="update kinds and weights")
+    parser.add_argument('--match-rate', type=float, default=0.8, help="share of uploads AuDD identifies")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    parser.add_argument('--warmup', type=float, default=1, help="seconds to wait after the bot is up")
+    parser.add_argument('--drain', type=float, default=60, help="max seconds to wait for answers")
+    parser.add_argument('--settle', type=float, default=5, help="stop draining after this many quiet seconds")
+    parser.add_argument('--output', help="write the report as JSON")
+    parser.add_argument('--baseline', help="JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    for upstream in ('telegram', 'audd', 'genius'):
+        Behaviour.add_arguments(parser, upstream)
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2)
+
+    failed = bool(report['startup_errors'])
+    if args.baseline:
+        with open(args.baseline) as saved:
+            regressions = compare(report, json.load(saved), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
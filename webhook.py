@@ -0,0 +1,181 @@
+import os
+# Loads .env before any module reads its settings
+import startup
+import json
+import logging
+import threading
+import multiprocessing
+import queue as queue_module
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import event_log
+
+# Webhook runtime: a lightweight HTTP server receives Telegram updates and
+# hands them to a pool of worker processes. Updates are sharded by chat, so
+# every update for one chat is handled by the same worker, in arrival order.
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', str(os.cpu_count() or 2)))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+def update_shard_key(update):
+    """Return the id updates are sharded on: the chat, falling back to the sender."""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if field in update:
+            return update[field]['chat']['id']
+    callback = update.get('callback_query')
+    if callback:
+        if callback.get('message'):
+            return callback['message']['chat']['id']
+        return callback['from']['id']
+    for value in update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return update.get('update_id', 0)
+
+def worker_main(index, updates):
+    """Process updates from one shard queue with the regular handlers."""
+    import main as app
+
+    # The bot's scheduler keeps each chat's updates in order within a lane
+    from telebot.types import Update
+
+    # Telegram's global flood limit is per bot, so the workers split it
+    if app.outbound is not None:
+        app.outbound.queue.global_rate /= WEBHOOK_WORKERS
+
+    # Each worker counts /top analytics for its own shard of chats
+    app.analytics.worker = (index, WEBHOOK_WORKERS)
+
+    # Each worker serves its own /metrics on METRICS_PORT + index
+    if app.metrics.METRICS_PORT:
+        app.metrics.start_server(app.metrics.METRICS_PORT + index)
+
+    startup.ready(f'webhook-{index}')
+    startup.warm_up()
+    event_log.event('worker_ready', logging.INFO, worker=index, pid=os.getpid())
+    while True:
+        raw = updates.get()
+        if raw is None:
+            break
+        try:
+            app.bot.process_new_updates([Update.de_json(raw)])
+        except Exception as e:
+            event_log.event('worker_error', logging.ERROR, worker=index, error=str(e))
+
+class WorkerPool:
+    """Worker processes, one bounded queue each, restarted if they die."""
+
+    def __init__(self, size, queue_size):
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(queue_size) for _ in range(size)]
+        self.processes = [None] * size
+        self._stopping = threading.Event()
+
+    def start(self):
+        for index in range(len(self.queues)):
+            self._spawn(index)
+        threading.Thread(target=self._supervise, daemon=True).start()
+
+    def submit(self, shard_key, raw, timeout=1.0):
+        """Queue a raw update on its chat's worker; raises queue.Full when that worker is backed up."""
+        self.queues[shard_key % len(self.queues)].put(raw, timeout=timeout)
+
+    def stop(self):
+        self._stopping.set()
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=worker_main, args=(index, self.queues[index]), daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+
+    def _supervise(self):
+        while not self._stopping.wait(2):
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self._stopping.is_set():
+                    event_log.event(
+                        'worker_restarted', logging.WARNING, worker=index, exit_code=process.exitcode
+                    )
+                    self._spawn(index)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept Telegram update POSTs and queue them without doing any bot work."""
+
+    pool = None
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if WEBHOOK_SECRET and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        raw = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        try:
+            shard_key = update_shard_key(json.loads(raw))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        try:
+            self.pool.submit(shard_key, raw)
+        except queue_module.Full:
+            # Telegram redelivers the update later
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def register_webhook():
+    """Point Telegram at WEBHOOK_URL, if one is configured."""
+    if not WEBHOOK_URL:
+        return
+    import telebot
+    bot = telebot.TeleBot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org') + '/bot{0}/{1}'
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+
+def main():
+    print("\n" + "=" * 50)
+    print("🎵 Music Recognition Bot Starting (webhook)...")
+    print("=" * 50)
+    print(f"Start Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"Listening on http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} with {WEBHOOK_WORKERS} workers")
+    print("=" * 50 + "\n")
+
+    pool = WorkerPool(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    pool.start()
+    WebhookHandler.pool = pool
+    register_webhook()
+
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.stop()
+
+if __name__ == "__main__":
+    main()